@@ -0,0 +1,98 @@
+"""
+Compare the python and the PostGIS aggregation engines.
+
+The benchmark aggregates the discrete or continuous value counts and
+statistics of parsed raster layers with both engines, for query shapes that
+differ by the number of tiles, the clipped share of the layer extent and the
+number of layers. The faster engine is reported for every shape, and the
+smallest number of tiles from which the PostGIS engine was faster is suggested
+for the ``RASTER_AGGREGATION_DATABASE_TILES`` setting of the auto engine. Run
+it from the repository root with a settings module for a database with parsed
+layers, passing the ids of the layers:
+
+    DJANGO_SETTINGS_MODULE=tests.testproj.settings python -m benchmarks.aggregation_engines 1 2
+"""
+import string
+import sys
+import timeit
+
+import django
+from django.contrib.gis.geos import Polygon
+from django.test.utils import override_settings
+from raster.const import AGGREGATION_ENGINE_POSTGIS, AGGREGATION_ENGINE_PYTHON
+from raster.tiles.const import WEB_MERCATOR_SRID
+
+# Fractions of the layer extent that are covered by the clip geometry
+AREAS = (None, 1, 1 / 4, 1 / 16)
+
+# Number of zoom levels below the highest zoom level of the layers
+ZOOM_STEPS = 3
+
+NUMBER = 3
+
+
+def clip_geometry(layers, area):
+    """
+    Return a box in the center of the common extent of the layers that covers
+    the fraction of the extent.
+    """
+    extents = [layer.extent() for layer in layers]
+    xmin, ymin = max(extent[0] for extent in extents), max(extent[1] for extent in extents)
+    xmax, ymax = min(extent[2] for extent in extents), min(extent[3] for extent in extents)
+    margin = (1 - area ** 0.5) / 2
+    dx, dy = margin * (xmax - xmin), margin * (ymax - ymin)
+    geom = Polygon.from_bbox((xmin + dx, ymin + dy, xmax - dx, ymax - dy))
+    geom.srid = WEB_MERCATOR_SRID
+    return geom
+
+
+@override_settings(RASTER_AGGREGATION_CACHE=None)
+def run(layer_ids):
+    # The aggregator requires the app registry
+    from raster.models import RasterLayer
+    from raster.valuecount import Aggregator
+
+    layers = list(RasterLayer.objects.filter(id__in=layer_ids))
+    layer_dict = dict(zip(string.ascii_lowercase, [layer.id for layer in layers]))
+    max_zoom = min(layer.metadata.max_zoom for layer in layers)
+
+    print('{:>6} {:>6} {:>6} {:>6} {:>10} {:>10} {:>8}'.format(
+        'Layers', 'Zoom', 'Tiles', 'Area', 'Python ms', 'PostGIS ms', 'Faster'
+    ))
+    database_tiles = []
+    python_tiles = []
+    for count in range(1, len(layers) + 1):
+        formulas = list(layer_dict)[:count]
+        for zoom in range(max_zoom, max(max_zoom - ZOOM_STEPS, -1), -1):
+            for area in AREAS:
+                geom = clip_geometry(layers[:count], area) if area else None
+                timings = []
+                for engine in (AGGREGATION_ENGINE_PYTHON, AGGREGATION_ENGINE_POSTGIS):
+                    aggregator = Aggregator(
+                        layer_dict=layer_dict, formula=formulas[0], zoom=zoom,
+                        geom=geom.clone() if geom else None, all_touched=False, engine=engine,
+                    )
+                    # Drop aggregations that the database engine does not support
+                    if not aggregator.use_database(formulas) and engine == AGGREGATION_ENGINE_POSTGIS:
+                        break
+                    seconds = timeit.timeit(lambda: aggregator.aggregate(formulas), number=NUMBER)
+                    timings.append(1000 * seconds / NUMBER)
+                else:
+                    tiles = aggregator.tile_count()
+                    faster = 'PostGIS' if timings[1] < timings[0] else 'Python'
+                    (database_tiles if faster == 'PostGIS' else python_tiles).append(tiles)
+                    print('{:>6} {:>6} {:>6} {:>6} {:>10.1f} {:>10.1f} {:>8}'.format(
+                        count, zoom, tiles, '{:.0%}'.format(area) if area else 'all', timings[0], timings[1], faster
+                    ))
+
+    # Suggest the smallest tile count above which the database was always faster
+    threshold = max(python_tiles) + 1 if python_tiles else min(database_tiles, default=0)
+    if database_tiles and threshold <= max(database_tiles):
+        print('Suggested setting: RASTER_AGGREGATION_DATABASE_TILES = {0}'.format(threshold))
+    else:
+        print('The python engine was faster for all query shapes.')
+
+
+if __name__ == '__main__':
+    django.setup()
+    run([int(layer_id) for layer_id in sys.argv[1:]])
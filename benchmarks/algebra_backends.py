@@ -0,0 +1,73 @@
+"""
+Compare the numpy and numexpr formula evaluation backends.
+
+The benchmark evaluates the formulas from the formula parser tests on tile
+sized arrays, with and without nodata masks. Run it from the repository root
+with a settings module that configures the GDAL library, for instance:
+
+    DJANGO_SETTINGS_MODULE=tests.testproj.settings python -m benchmarks.algebra_backends
+"""
+import timeit
+
+import numpy
+
+import django
+from raster.algebra import fused
+from raster.algebra.const import NUMEXPR_BACKEND, NUMPY_BACKEND
+from raster.algebra.parser import FormulaParser
+from raster.tiles.const import WEB_MERCATOR_TILESIZE
+
+FORMULAS = (
+    'x + y',
+    'x * 99999 + 0.5 * y',
+    'x + y + z + a',
+    'x*(x>1) + 2*y + 3*z*(z==78)',
+    '(a*b)*((b>0) & (a > 1)) + 99*a*(b <=0)',
+    '((a * 2) + (x * 3)) * 6',
+    '(a - x) / (a + x)',
+    '((a - x) / (a + x) > 0.2) * 1 + ((a - x) / (a + x) > 0.5) * 2 + ((a - x) / (a + x) > 0.8) * 3',
+    'log(a) * sin(x) + exp(y)',
+)
+
+NUMBER = 50
+
+
+def get_data(masked):
+    rng = numpy.random.RandomState(23)
+    size = WEB_MERCATOR_TILESIZE * WEB_MERCATOR_TILESIZE
+    data = {
+        'a': rng.randint(1, 10, size).astype('float64'),
+        'b': rng.randint(0, 2, size).astype('float64'),
+        'x': rng.randn(size),
+        'y': rng.rand(size),
+        'z': rng.randint(0, 100, size).astype('float64'),
+    }
+    if masked:
+        data = {key: numpy.ma.masked_values(val, val[0]) for key, val in data.items()}
+    return data
+
+
+def run():
+    if not fused.is_available():
+        print('Numexpr is not installed, only the numpy backend is available.')
+        return
+
+    numpy.seterr(all='ignore')
+    print('{:<90} {:>8} {:>10} {:>10} {:>8}'.format('Formula', 'Masked', 'Numpy ms', 'Numexpr ms', 'Speedup'))
+    for masked in (False, True):
+        data = get_data(masked)
+        for formula in FORMULAS:
+            timings = []
+            for backend in (NUMPY_BACKEND, NUMEXPR_BACKEND):
+                parser = FormulaParser(backend=backend)
+                parser.evaluate(dict(data), formula)
+                seconds = timeit.timeit(lambda: parser.evaluate(dict(data), formula), number=NUMBER)
+                timings.append(1000 * seconds / NUMBER)
+            print('{:<90} {:>8} {:>10.3f} {:>10.3f} {:>8.1f}'.format(
+                formula, str(masked), timings[0], timings[1], timings[0] / timings[1]
+            ))
+
+
+if __name__ == '__main__':
+    django.setup()
+    run()
@@ -4,8 +4,8 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import render
 
 from .models import (
-    Legend, LegendEntry, LegendSemantics, RasterLayer, RasterLayerBandMetadata, RasterLayerMetadata,
-    RasterLayerParseStatus, RasterLayerReprojected, RasterTile
+    Legend, LegendEntry, LegendSemantics, RasterAggregation, RasterExport, RasterLayer, RasterLayerBandMetadata,
+    RasterLayerMetadata, RasterLayerParseStatus, RasterLayerReprojected, RasterTile
 )
 
 
@@ -157,6 +157,28 @@ class RasterTileModelAdmin(admin.ModelAdmin):
         return False
 
 
+class RasterExportModelAdmin(admin.ModelAdmin):
+    list_display = ('id', 'filename', 'status', 'tiles_done', 'tiles_total', 'created')
+    list_filter = ('status', )
+    readonly_fields = (
+        'key', 'parameters', 'status', 'tiles_done', 'tiles_total', 'log', 'archive', 'filename',
+    )
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class RasterAggregationModelAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'tiles_done', 'tiles_total', 'created')
+    list_filter = ('status', )
+    readonly_fields = (
+        'key', 'parameters', 'status', 'tiles_done', 'tiles_total', 'log', 'result',
+    )
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class LegendEntriesInLine(admin.TabularInline):
     model = LegendEntry
     extra = 0
@@ -171,6 +193,8 @@ class LegendAdmin(admin.ModelAdmin):
 admin.site.register(LegendSemantics)
 admin.site.register(RasterLayer, RasterLayerModelAdmin)
 admin.site.register(RasterTile, RasterTileModelAdmin)
+admin.site.register(RasterExport, RasterExportModelAdmin)
+admin.site.register(RasterAggregation, RasterAggregationModelAdmin)
 admin.site.register(RasterLayerMetadata, RasterLayerMetadataModelAdmin)
 admin.site.register(LegendEntry)
 admin.site.register(Legend, LegendAdmin)
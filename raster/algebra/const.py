@@ -6,6 +6,32 @@ import numpy
 ALGEBRA_PIXEL_TYPE_GDAL = 7
 ALGEBRA_PIXEL_TYPE_NUMPY = "float64"
 
+# Nodata value for boolean algebra results
+ALGEBRA_BOOLEAN_NODATA = 255
+
+# Number of compiled formulas kept in the formula cache
+FORMULA_CACHE_SIZE = 512
+
+# Formula evaluation backends
+NUMPY_BACKEND = "numpy"
+NUMEXPR_BACKEND = "numexpr"
+
+# Formula evaluation precision modes
+PRECISION_FLOAT64 = "float64"
+PRECISION_FLOAT32 = "float32"
+PRECISION_AUTO = "auto"
+
+# GDAL datatypes for algebra results, from narrow to wide
+ALGEBRA_DATATYPES = (
+    (1, "uint8"),
+    (2, "uint16"),
+    (3, "int16"),
+    (4, "uint32"),
+    (5, "int32"),
+    (6, "float32"),
+    (7, "float64"),
+)
+
 LPAR = "("
 RPAR = ")"
 
@@ -101,6 +127,10 @@ UNARY_REPLACE_MAP = {
     FILL: UNARY_FILL,
 }
 
+# Domains of the operations on masked data as defined in numpy.ma.core
+SAFE_DIVIDE_TOLERANCE = float(numpy.finfo(float).tiny)
+TAN_DOMAIN_EPS = 1e-35
+
 # Map function names to numpy functions
 FUNCTION_MAP = {
     "sin": numpy.sin,
@@ -119,3 +149,14 @@ FUNCTION_MAP = {
     "std": numpy.std,
     "sum": numpy.sum,
 }
+
+# Functions that reduce arrays to a single value
+REDUCTION_FUNCTIONS = ("min", "max", "mean", "median", "std", "sum")
+
+# Functions that are evaluated on the 3x3 neighborhood of every pixel
+NEIGHBORHOOD_FUNCTIONS = (
+    "focalmean", "focalsum", "focalstd", "focalmin", "focalmax", "focalmajority", "slope", "hillshade",
+)
+
+# Number of pixels around a pixel that a neighborhood function depends on
+NEIGHBORHOOD_RADIUS = 1
@@ -0,0 +1,153 @@
+"""
+Neighborhood functions for raster algebra.
+
+Neighborhood functions compute the value of every pixel from the 3x3 window
+of pixels around it, for instance the focal mean or the slope of an elevation
+model. The windows are evaluated with vectorized operations on shifted views
+of the data, which is padded by replicating its edge values.
+
+Nodata pixels are ignored by the focal statistics, the result is nodata where
+the center pixel is nodata. The slope and hillshade are nodata where any
+pixel of the window is nodata.
+"""
+import numpy
+
+from raster.algebra import const
+from raster.exceptions import RasterAlgebraException
+
+# Sun position for the hillshade in degrees
+HILLSHADE_AZIMUTH = 315
+HILLSHADE_ALTITUDE = 45
+
+
+def windows(data):
+    """
+    Return the 3x3 windows of a two dimensional array as a stack of the nine
+    shifted views of the edge padded array, in row major window order.
+    """
+    height, width = data.shape
+    radius = const.NEIGHBORHOOD_RADIUS
+    padded = numpy.pad(data, radius, mode='edge')
+    size = 2 * radius + 1
+    return numpy.stack([
+        padded[row:row + height, col:col + width] for row in range(size) for col in range(size)
+    ])
+
+
+def gradients(stack, pixel_size):
+    """
+    Compute the gradients of the surface in x and y direction with the Horn
+    method. The y direction points down the rows of the data.
+    """
+    a, b, c, d, e, f, g, h, i = stack
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * pixel_size[0])
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * pixel_size[1])
+    return dzdx, dzdy
+
+
+def focal_count(stack):
+    return numpy.sum(numpy.isfinite(stack), axis=0)
+
+
+def focalsum(stack, pixel_size):
+    return numpy.nansum(stack, axis=0)
+
+
+def focalmean(stack, pixel_size):
+    return numpy.nansum(stack, axis=0) / focal_count(stack)
+
+
+def focalstd(stack, pixel_size):
+    mean = focalmean(stack, pixel_size)
+    return numpy.sqrt(numpy.nansum((stack - mean) ** 2, axis=0) / focal_count(stack))
+
+
+def focalmin(stack, pixel_size):
+    return numpy.fmin.reduce(stack, axis=0)
+
+
+def focalmax(stack, pixel_size):
+    return numpy.fmax.reduce(stack, axis=0)
+
+
+def focalmajority(stack, pixel_size):
+    """
+    Return the most frequent value of each window. Ties are resolved to the
+    smallest value.
+    """
+    stack = numpy.sort(stack, axis=0)
+    counts = numpy.sum(stack[:, numpy.newaxis] == stack[numpy.newaxis], axis=1)
+    return numpy.choose(numpy.argmax(counts, axis=0), stack)
+
+
+def slope(stack, pixel_size):
+    """
+    Return the slope in degrees.
+    """
+    dzdx, dzdy = gradients(stack, pixel_size)
+    return numpy.degrees(numpy.arctan(numpy.hypot(dzdx, dzdy)))
+
+
+def hillshade(stack, pixel_size):
+    """
+    Return the hillshade for a sun at the default azimuth and altitude, as
+    values between 0 and 255.
+    """
+    dzdx, dzdy = gradients(stack, pixel_size)
+    zenith = numpy.radians(90 - HILLSHADE_ALTITUDE)
+    azimuth = numpy.radians(360 - HILLSHADE_AZIMUTH + 90)
+    slope_angle = numpy.arctan(numpy.hypot(dzdx, dzdy))
+    aspect = numpy.arctan2(dzdy, -dzdx)
+    shade = (
+        numpy.cos(zenith) * numpy.cos(slope_angle)
+        + numpy.sin(zenith) * numpy.sin(slope_angle) * numpy.cos(azimuth - aspect)
+    )
+    return 255 * numpy.clip(shade, 0, None)
+
+
+NEIGHBORHOOD_FUNCTION_MAP = {
+    "focalmean": focalmean,
+    "focalsum": focalsum,
+    "focalstd": focalstd,
+    "focalmin": focalmin,
+    "focalmax": focalmax,
+    "focalmajority": focalmajority,
+    "slope": slope,
+    "hillshade": hillshade,
+}
+
+
+def evaluate(name, data, valid, shape=None, pixel_size=(1, 1)):
+    """
+    Evaluate a neighborhood function on data with an optional validity array.
+
+    Flat data is interpreted as an array of the given shape, which defaults to
+    the shape of the data. Returns the result in the shape of the data and its
+    validity array, which is None if no validity was provided.
+    """
+    if shape is None:
+        shape = numpy.shape(data)
+    if len(shape) != 2:
+        raise RasterAlgebraException('Neighborhood functions require two dimensional data.')
+
+    flat = numpy.ndim(data) == 1
+
+    # Convert the data to floats in which nodata is represented by nan
+    data = numpy.broadcast_to(data, shape) if numpy.ndim(data) == 0 else numpy.reshape(data, shape)
+    dtype = data.dtype if data.dtype.kind == 'f' else numpy.dtype(const.ALGEBRA_PIXEL_TYPE_NUMPY)
+    values = data.astype(dtype)
+    if valid is not None:
+        valid = numpy.reshape(valid, shape) if numpy.ndim(valid) else numpy.broadcast_to(valid, shape)
+        values[numpy.logical_not(valid)] = numpy.nan
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = NEIGHBORHOOD_FUNCTION_MAP[name](windows(values), pixel_size)
+
+    if valid is not None:
+        valid = numpy.logical_and(valid, numpy.isfinite(result))
+
+    if flat:
+        result = result.ravel()
+        valid = None if valid is None else valid.ravel()
+
+    return result, valid
@@ -0,0 +1,236 @@
+"""
+Fused evaluation of compiled formulas using numexpr.
+
+The numpy evaluation of an expression stack calls one ufunc per operator and
+allocates a full size temporary array for every node. Numexpr compiles the
+whole expression into a single kernel that is evaluated in cache sized chunks
+on multiple threads. This module translates expression stacks into numexpr
+expressions, numexpr is an optional dependency.
+
+Masked input arrays are supported by evaluating the expression on the raw
+data and reconstructing the mask the way numpy.ma would: the mask is the
+union of the input masks and of the domain masks of divisions, logarithms and
+tangents that operate on masked data.
+"""
+from functools import lru_cache
+
+import numpy
+
+from raster.algebra import const
+from raster.algebra.tree import build_tree, variables
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Operators that translate directly into numexpr syntax
+FUSED_OPERATOR_MAP = {
+    const.ADD: '+',
+    const.SUBTRACT: '-',
+    const.MULTIPLY: '*',
+    const.DIVIDE: '/',
+    const.POWER: '**',
+    const.EQUAL: '==',
+    const.NOT_EQUAL: '!=',
+    const.GREATER: '>',
+    const.GREATER_EQUAL: '>=',
+    const.LESS: '<',
+    const.LESS_EQUAL: '<=',
+}
+
+# Logical operators are applied to truth values like numpy.logical_and does
+FUSED_LOGICAL_OPERATOR_MAP = {
+    const.LOGICAL_AND: '&',
+    const.LOGICAL_OR: '|',
+}
+
+FUSED_ARITHMETIC_OPERATORS = (const.ADD, const.SUBTRACT, const.MULTIPLY, const.DIVIDE, const.POWER)
+
+FUSED_FUNCTIONS = ('sin', 'cos', 'tan', 'log', 'exp', 'abs')
+
+
+def is_available():
+    return numexpr is not None
+
+
+@lru_cache(maxsize=const.FORMULA_CACHE_SIZE)
+def translate(tree, masked):
+    """
+    Translate a tree into a numexpr expression. The masked argument is a
+    tuple of variable names that hold masked arrays.
+
+    Returns the expression, the domain mask expression (or None), the mapping
+    of local names to variable names and the constants. Returns None if the
+    tree can not be translated.
+    """
+    names = {name: 'v{}'.format(i) for i, name in enumerate(variables(tree))}
+    constants = {}
+    domains = []
+
+    def is_masked(node):
+        return any(name in masked for name in variables(node))
+
+    def truth(node, expression):
+        # Comparisons and logical operations already result in booleans.
+        if node[0] == 'binary' and node[1] not in FUSED_ARITHMETIC_OPERATORS:
+            return expression
+        elif node[0] == 'unary' and node[1] == const.UNARY_NOT:
+            return expression
+        return '({} != 0)'.format(expression)
+
+    def visit(node):
+        if node[0] == 'variable':
+            return names[node[1]]
+
+        elif node[0] in ('number', 'keyword'):
+            # Null comparisons require masked array semantics.
+            if node[0] == 'number':
+                value = float(node[1])
+            elif node[1] == const.NULL:
+                raise ValueError
+            else:
+                value = const.KEYWORD_MAP[node[1]]
+            key = 'c{}'.format(len(constants))
+            constants[key] = value
+            return key
+
+        elif node[0] == 'unary':
+            # The fill operator requires masked array semantics.
+            if node[1] == const.UNARY_FILL:
+                raise ValueError
+            child = visit(node[2])
+            if node[1] == const.UNARY_LESS:
+                return '(-{})'.format(child)
+            elif node[1] == const.UNARY_NOT:
+                return '(~{})'.format(truth(node[2], child))
+            elif is_masked(node[2]):
+                # The unary plus operator converts masked arrays to regular
+                # arrays, dropping the mask.
+                raise ValueError
+            return child
+
+        elif node[0] == 'function':
+            if node[1] not in FUSED_FUNCTIONS:
+                raise ValueError
+            child = visit(node[2])
+            if is_masked(node[2]):
+                if node[1] == 'log':
+                    domains.append('({} <= 0)'.format(child))
+                elif node[1] == 'tan':
+                    domains.append('(abs(cos({})) < {!r})'.format(child, const.TAN_DOMAIN_EPS))
+            return '{}({})'.format(node[1], child)
+
+        left = visit(node[2])
+        right = visit(node[3])
+        if node[1] in FUSED_LOGICAL_OPERATOR_MAP:
+            return '({} {} {})'.format(
+                truth(node[2], left), FUSED_LOGICAL_OPERATOR_MAP[node[1]], truth(node[3], right),
+            )
+        if node[1] == const.DIVIDE and (is_masked(node[2]) or is_masked(node[3])):
+            domains.append('(abs({}) * {!r} >= abs({}))'.format(left, const.SAFE_DIVIDE_TOLERANCE, right))
+        return '({} {} {})'.format(left, FUSED_OPERATOR_MAP[node[1]], right)
+
+    try:
+        expression = visit(tree)
+    except ValueError:
+        return
+
+    domain = ' | '.join(domains) if domains else None
+
+    return expression, domain, tuple((local, name) for name, local in names.items()), tuple(constants.items())
+
+
+def evaluate_valid(stack, data, valid, dtype=None):
+    """
+    Evaluate a compiled expression stack on a dictionary of plain arrays with
+    numexpr. The valid dictionary holds boolean validity arrays for variables
+    that contain nodata. Numerical constants are converted to the dtype if
+    provided.
+
+    Returns the result and its validity array, which is None if the formula
+    does not use variables with nodata. Returns None if numexpr is not
+    installed, the formula contains operations that can not be fused, or
+    variables are missing from the data. The caller is expected to fall back
+    to the numpy evaluation in that case.
+    """
+    if numexpr is None:
+        return
+
+    tree = build_tree(stack)
+    if tree is None:
+        return
+
+    # Formulas without variables are not worth fusing.
+    names = variables(tree)
+    if not names or any(name not in data for name in names):
+        return
+
+    masked = tuple(name for name in names if valid.get(name) is not None)
+
+    translated = translate(tree, masked)
+    if translated is None:
+        return
+    expression, domain, local_names, constants = translated
+
+    local_dict = {}
+    for local, value in constants:
+        if dtype is not None and not isinstance(value, bool):
+            value = numpy.array(value, dtype=dtype)
+        local_dict[local] = value
+    for local, name in local_names:
+        local_dict[local] = data[name]
+
+    result = numexpr.evaluate(expression, local_dict=local_dict, truediv=True)
+
+    if not masked:
+        return result, None
+
+    # Combine the validity of the inputs with the domains of the operations.
+    if len(masked) == 1 and not domain:
+        result_valid = valid[masked[0]]
+    else:
+        validity = []
+        for index, name in enumerate(masked):
+            local_dict['m{}'.format(index)] = valid[name]
+            validity.append('m{}'.format(index))
+        if domain:
+            validity.append('~({})'.format(domain))
+        result_valid = numexpr.evaluate(' & '.join(validity), local_dict=local_dict, truediv=True)
+
+    return result, numpy.broadcast_to(result_valid, result.shape)
+
+
+def evaluate(stack, data, dtype=None):
+    """
+    Evaluate a compiled expression stack on the data dictionary with numexpr.
+    The data can contain masked arrays, the result is masked the way numpy.ma
+    would mask it. Numerical constants are converted to the dtype if provided.
+
+    Returns None if the formula can not be evaluated with numexpr, see
+    evaluate_valid.
+    """
+    tree = build_tree(stack)
+    if tree is None:
+        return
+
+    # Only the masks of variables used in the formula are required.
+    masked = [name for name in variables(tree) if isinstance(data.get(name), numpy.ma.MaskedArray)]
+
+    arrays = {name: numpy.ma.getdata(array) for name, array in data.items()}
+    valid = {name: ~numpy.ma.getmaskarray(data[name]) for name in masked}
+
+    evaluated = evaluate_valid(stack, arrays, valid, dtype)
+    if evaluated is None:
+        return
+
+    result, result_valid = evaluated
+    if result_valid is None:
+        return result
+
+    # Numpy.ma results inherit the attributes of the first masked operand,
+    # including its fill value for boolean results.
+    result = numpy.ma.masked_array(result, mask=~result_valid)
+    result._update_from(data[masked[0]])
+
+    return result
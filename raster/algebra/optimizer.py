@@ -0,0 +1,152 @@
+"""
+Optimization of compiled formulas.
+
+Formulas often contain constant arithmetic and repeat subexpressions, for
+instance when a normalized difference is used in several legend entries. The
+optimizer folds constant subexpressions into numbers and finds subexpressions
+that occur more than once, such that they are evaluated only once. Several formulas that are evaluated on the same
+data can be optimized together, such that the subexpressions they have in
+common are shared as well. The optimizer also reports the variables that a
+formula references, which allows skipping input data that is not used.
+"""
+from collections import Counter, namedtuple
+from functools import lru_cache
+
+import numpy
+
+from raster.algebra import const
+from raster.algebra.tree import build_tree, variables
+
+# Result of an optimization. The stack is the optimized expression stack, the
+# starts are the stack positions where the subexpression ending at each
+# position starts, the shared dictionary maps stack positions of repeated
+# subexpressions to their trees, which identify them across formulas, and the
+# variables are the names of the variables referenced in the formula.
+OptimizedFormula = namedtuple('OptimizedFormula', ('stack', 'starts', 'shared', 'variables'))
+
+LEAF_NODES = ('variable', 'number', 'keyword')
+
+
+def constant_value(node):
+    """
+    Return the value of a constant leaf node, or None if it is not constant.
+    """
+    if node[0] == 'number':
+        return numpy.array(node[1], dtype=const.ALGEBRA_PIXEL_TYPE_NUMPY)
+    elif node[0] == 'keyword' and node[1] != const.NULL:
+        return const.KEYWORD_MAP[node[1]]
+
+
+def constant_node(value):
+    """
+    Convert a computed constant into a leaf node. Returns None for values
+    that can not be represented in a formula.
+    """
+    value = numpy.asarray(value)
+    if value.ndim or value.dtype.kind not in 'biuf':
+        return
+    elif value.dtype.kind == 'b':
+        return ('keyword', const.TRUE if value else const.FALSE)
+    elif value == numpy.inf:
+        return ('keyword', const.INFINITE)
+    elif not numpy.isfinite(value):
+        return
+    return ('number', repr(float(value)))
+
+
+def fold_constants(tree):
+    """
+    Replace subexpressions without variables by their values.
+    """
+    if tree[0] in LEAF_NODES:
+        return tree
+
+    children = tuple(fold_constants(child) for child in tree[2:])
+    tree = tree[:2] + children
+
+    # Neighborhood functions depend on the shape of the data.
+    if tree[1] in const.NEIGHBORHOOD_FUNCTIONS:
+        return tree
+
+    values = [constant_value(child) for child in children]
+    if any(value is None for value in values):
+        return tree
+
+    # Compute the value like the formula parser would.
+    with numpy.errstate(all='ignore'):
+        if tree[0] == 'unary':
+            value = const.UNARY_OPERATOR_MAP[tree[1]](*values)
+        elif tree[0] == 'binary':
+            value = const.OPERATOR_MAP[tree[1]](*values)
+        else:
+            value = const.FUNCTION_MAP[tree[1]](*values)
+
+    return constant_node(value) or tree
+
+
+@lru_cache(maxsize=const.FORMULA_CACHE_SIZE)
+def optimize(stack):
+    """
+    Optimize a compiled expression stack. Stacks that do not form a complete
+    expression are returned unchanged, their evaluation reports the error.
+    """
+    return optimize_all((stack, ))[0]
+
+
+@lru_cache(maxsize=const.FORMULA_CACHE_SIZE)
+def optimize_all(stacks):
+    """
+    Optimize a tuple of compiled expression stacks that are evaluated on the
+    same data. Subexpressions that occur more than once in any of the stacks
+    are shared. Returns a tuple with an optimized formula for every stack.
+    """
+    trees = [build_tree(stack) for stack in stacks]
+    trees = [None if tree is None else fold_constants(tree) for tree in trees]
+
+    # Count the occurrences of subexpressions. The subexpressions within
+    # repeated subexpressions are only counted once, because the repeated
+    # subexpression is evaluated once.
+    counts = Counter()
+
+    def count(node):
+        if node[0] in LEAF_NODES:
+            return
+        counts[node] += 1
+        if counts[node] == 1:
+            for child in node[2:]:
+                count(child)
+
+    for tree in trees:
+        if tree is not None:
+            count(tree)
+
+    return tuple(
+        OptimizedFormula(stack, (), {}, ()) if tree is None else emit_stack(tree, counts)
+        for stack, tree in zip(stacks, trees)
+    )
+
+
+def emit_stack(tree, counts):
+    """
+    Convert a tree into an optimized formula, keeping track of the start of
+    every subexpression and the positions of repeated subexpressions.
+    """
+    optimized = []
+    starts = []
+    shared = {}
+
+    def emit(node):
+        start = len(optimized)
+        if node[0] in LEAF_NODES:
+            optimized.append(node[1])
+        else:
+            for child in node[2:]:
+                emit(child)
+            optimized.append(node[1])
+        starts.append(start)
+        if counts[node] > 1:
+            shared[len(optimized) - 1] = node
+
+    emit(tree)
+
+    return OptimizedFormula(tuple(optimized), tuple(starts), shared, tuple(variables(tree)))
@@ -1,47 +1,38 @@
 import keyword
 import operator
-from functools import reduce
+import threading
+from functools import lru_cache, reduce, wraps
 
 import numpy
-from pyparsing import Forward, Keyword, Literal, Optional, Regex, Word, ZeroOrMore, alphanums, delimitedList, oneOf
+from pyparsing import (
+    Forward, Keyword, Literal, Optional, ParseException, Regex, Word, ZeroOrMore, alphanums, delimitedList, oneOf
+)
 
+from django.conf import settings
 from django.contrib.gis.gdal import GDALRaster
-from raster.algebra import const
+from raster.algebra import const, focal, fused
+from raster.algebra import precision as algebra_precision
+from raster.algebra.optimizer import optimize, optimize_all
+from raster.algebra.tree import build_tree, fill_variable, halo
 from raster.exceptions import RasterAlgebraException
 
 
-class FormulaParser(object):
+class FormulaGrammar(object):
     """
-    Deconstruct mathematical algebra expressions and convert those into
-    callable funcitons.
-
-
-    Deconstruct mathematical algebra expressions and convert those into
-    callable funcitons.
-
-    This formula parser was inspired by the fourFun pyparsing example and also
-    benefited from additional substantial contributions by Paul McGuire.
-    This module uses pyparsing for this purpose and the parser is adopted from
-    the `fourFun example`__.
-
-    Example usage::
+    Backus Normal Form (BNF) grammar of the formula language.
 
-        >>> parser = FormulaParser()
-        >>> parser.set_formula('log(a * 3 + b)')
-        >>> parser.evaluate({'a': 5, 'b': 23})
-        ... 3.6375861597263857
-        >>> parser.evaluate({'a': [5, 6, 7], 'b': [23, 24, 25]})
-        ... array([ 3.63758616,  3.73766962,  3.8286414 ])
-
-    __ http://pyparsing.wikispaces.com/file/view/fourFn.py
+    The grammar converts formula strings into expression stacks that can be
+    evaluated by the FormulaParser. Constructing the grammar is expensive, so
+    a single instance is shared by all parsers. Formulas are parsed under a
+    lock because the parse actions push onto a shared expression stack.
     """
 
     def __init__(self):
         """
         Setup the Backus Normal Form (BNF) parser logic.
         """
-        # Set an empty formula attribute
-        self.formula = None
+        self.lock = threading.Lock()
+        self.expr_stack = []
 
         # Instantiate blank parser for BNF construction
         self.bnf = Forward()
@@ -105,6 +96,102 @@ class FormulaParser(object):
         if toks and toks[0] in const.UNARY_REPLACE_MAP:
             self.expr_stack.append(const.UNARY_REPLACE_MAP[toks[0]])
 
+    def parse(self, formula):
+        """
+        Parse a formula and return its expression stack as a tuple.
+        """
+        with self.lock:
+            self.expr_stack = []
+            self.bnf.parseString(formula)
+            return tuple(self.expr_stack)
+
+
+GRAMMAR = FormulaGrammar()
+
+
+@lru_cache(maxsize=const.FORMULA_CACHE_SIZE)
+def compile_formula(formula):
+    """
+    Compile a normalized formula into an expression stack. The stacks are
+    cached, such that repeated evaluations of a formula skip parsing.
+    """
+    return GRAMMAR.parse(formula)
+
+
+def reuse_shared(evaluate):
+    """
+    Decorate stack evaluation methods such that subexpressions that occur
+    more than once in an optimized stack are only evaluated once.
+    """
+    @wraps(evaluate)
+    def wrapper(self, stack):
+        position = len(stack) - 1
+        key = self.shared.get(position)
+        if key is not None and key in self.memo:
+            # Remove the subexpression from the stack and reuse its value
+            del stack[self.starts[position]:]
+            return self.memo[key]
+        value = evaluate(self, stack)
+        if key is not None:
+            self.memo[key] = value
+        return value
+    return wrapper
+
+
+class FormulaParser(object):
+    """
+    Deconstruct mathematical algebra expressions and convert those into
+    callable funcitons.
+
+
+    Deconstruct mathematical algebra expressions and convert those into
+    callable funcitons.
+
+    This formula parser was inspired by the fourFun pyparsing example and also
+    benefited from additional substantial contributions by Paul McGuire.
+    This module uses pyparsing for this purpose and the parser is adopted from
+    the `fourFun example`__.
+
+    Formulas are compiled into expression stacks by the shared grammar of this
+    module. The compiled stacks are cached, so instantiating parsers and
+    re-evaluating formulas is cheap. Before evaluation, constant
+    subexpressions are folded and repeated subexpressions are evaluated only
+    once.
+
+    Example usage::
+
+        >>> parser = FormulaParser()
+        >>> parser.set_formula('log(a * 3 + b)')
+        >>> parser.evaluate({'a': 5, 'b': 23})
+        ... 3.6375861597263857
+        >>> parser.evaluate({'a': [5, 6, 7], 'b': [23, 24, 25]})
+        ... array([ 3.63758616,  3.73766962,  3.8286414 ])
+
+    __ http://pyparsing.wikispaces.com/file/view/fourFn.py
+    """
+
+    def __init__(self, backend=None):
+        # Set an empty formula attribute
+        self.formula = None
+        # Set the evaluation backend, defaults to the backend from settings
+        self.backend = backend
+        # Positions of shared subexpressions in the stack and their values
+        self.shared = {}
+        self.starts = ()
+        self.memo = {}
+        # Shape of flat data and pixel size for neighborhood functions
+        self.shape = None
+        self.pixel_size = (1, 1)
+
+    def get_backend(self):
+        """
+        Return the evaluation backend, either numpy or numexpr.
+        """
+        if self.backend is None:
+            return getattr(settings, 'RASTER_ALGEBRA_BACKEND', const.NUMPY_BACKEND)
+        return self.backend
+
+    @reuse_shared
     def evaluate_stack(self, stack):
         """
         Evaluate a stack element.
@@ -129,6 +216,9 @@ class FormulaParser(object):
         elif op in const.FUNCTION_MAP:
             return const.FUNCTION_MAP[op](self.evaluate_stack(stack))
 
+        elif op in const.NEIGHBORHOOD_FUNCTIONS:
+            return self.evaluate_neighborhood(op, self.evaluate_stack(stack))
+
         elif op in const.KEYWORD_MAP:
             return const.KEYWORD_MAP[op]
 
@@ -136,10 +226,100 @@ class FormulaParser(object):
             return self.variable_map[op]
 
         else:
-            try:
-                return numpy.array(op, dtype=const.ALGEBRA_PIXEL_TYPE_NUMPY)
-            except ValueError:
-                raise RasterAlgebraException('Found an undeclared variable "{0}" in formula.'.format(op))
+            return self.get_number(op)
+
+    @reuse_shared
+    def evaluate_stack_valid(self, stack):
+        """
+        Evaluate a stack element on plain arrays with validity masks.
+
+        Returns the value, its validity array and the fill value of the masked
+        variables the value was derived from. The validity array is None if
+        all values are valid, the fill value is None if the value would not be
+        a masked array in numpy.ma. Masks are only combined where the numpy.ma
+        semantics require it.
+        """
+        op = stack.pop()
+
+        if op in const.UNARY_OPERATOR_MAP:
+            value, valid, fill = self.evaluate_stack_valid(stack)
+            if op == const.UNARY_FILL:
+                # Replace invalid values with the fill value, which results in
+                # a regular array.
+                if valid is not None:
+                    value = numpy.where(valid, value, numpy.array(fill).astype(value.dtype))
+                return value, None, None
+            elif op == const.UNARY_AND:
+                # Converting to a regular array drops the mask.
+                return numpy.array(value), None, None
+            return const.UNARY_OPERATOR_MAP[op](value), valid, fill
+
+        elif op in const.OPERATOR_MAP:
+            op2, valid2, fill2 = self.evaluate_stack_valid(stack)
+            op1, valid1, fill1 = self.evaluate_stack_valid(stack)
+            # Handle null case
+            if isinstance(op1, str) and op1 == const.NULL:
+                return const.OPERATOR_MAP[op](self.get_invalid(op2, valid2, op), True), None, None
+            elif isinstance(op2, str) and op2 == const.NULL:
+                return const.OPERATOR_MAP[op](self.get_invalid(op1, valid1, op), True), None, None
+            valid = self.combine_valid(valid1, valid2)
+            # Mask divisions by values close to zero on masked data
+            if op == const.DIVIDE and (fill1 is not None or fill2 is not None):
+                valid = self.combine_valid(valid, numpy.abs(op1) * const.SAFE_DIVIDE_TOLERANCE < numpy.abs(op2))
+            return const.OPERATOR_MAP[op](op1, op2), valid, fill2 if fill1 is None else fill1
+
+        elif op in const.FUNCTION_MAP:
+            value, valid, fill = self.evaluate_stack_valid(stack)
+            # Reductions are computed over the valid values only.
+            if op in const.REDUCTION_FUNCTIONS:
+                if valid is not None:
+                    value = value[valid]
+                return const.FUNCTION_MAP[op](value), None, None
+            # Mask values outside of the function domains on masked data
+            if fill is not None and op == 'log':
+                valid = self.combine_valid(valid, value > 0)
+            elif fill is not None and op == 'tan':
+                valid = self.combine_valid(valid, numpy.abs(numpy.cos(value)) >= const.TAN_DOMAIN_EPS)
+            return const.FUNCTION_MAP[op](value), valid, fill
+
+        elif op in const.NEIGHBORHOOD_FUNCTIONS:
+            value, valid, fill = self.evaluate_stack_valid(stack)
+            value, valid = focal.evaluate(op, value, valid, self.shape, self.pixel_size)
+            return value, valid, fill
+
+        elif op in const.KEYWORD_MAP:
+            return const.KEYWORD_MAP[op], None, None
+
+        elif op in self.variable_map:
+            return self.variable_map[op], self.valid_map.get(op), self.fill_map.get(op)
+
+        else:
+            return self.get_number(op), None, None
+
+    def evaluate_neighborhood(self, op, value):
+        """
+        Evaluate a neighborhood function on a regular or masked array.
+        """
+        if not isinstance(value, numpy.ma.MaskedArray):
+            return focal.evaluate(op, value, None, self.shape, self.pixel_size)[0]
+
+        result, valid = focal.evaluate(
+            op, numpy.ma.getdata(value), ~numpy.ma.getmaskarray(value), self.shape, self.pixel_size,
+        )
+        result = numpy.ma.masked_array(result, mask=numpy.logical_not(valid))
+        result._update_from(value)
+
+        return result
+
+    def get_number(self, op):
+        """
+        Convert a number string from the formula into a numpy number.
+        """
+        try:
+            number = numpy.array(op, dtype=const.ALGEBRA_PIXEL_TYPE_NUMPY)
+        except ValueError:
+            raise RasterAlgebraException('Found an undeclared variable "{0}" in formula.'.format(op))
+        return number.astype(self.number_dtype, copy=False)
 
     @staticmethod
     def get_mask(data, operator):
@@ -152,6 +332,28 @@ class FormulaParser(object):
         # If there is no mask, all values are not null
         return numpy.zeros(data.shape, dtype=numpy.bool)
 
+    @staticmethod
+    def get_invalid(data, valid, operator):
+        # Make sure the right operator is used
+        if operator not in (const.EQUAL, const.NOT_EQUAL):
+            raise RasterAlgebraException('NULL can only be used with "==" or "!=" operators.')
+        # Get mask from validity
+        if valid is not None:
+            return numpy.logical_not(valid)
+        # If there is no validity, all values are not null
+        return numpy.zeros(numpy.shape(data), dtype=bool)
+
+    @staticmethod
+    def combine_valid(valid1, valid2):
+        """
+        Combine two validity arrays, either of which can be None.
+        """
+        if valid1 is None:
+            return valid2
+        elif valid2 is None:
+            return valid1
+        return numpy.logical_and(valid1, valid2)
+
     def set_formula(self, formula):
         """
         Store the input formula as the one to evaluate on.
@@ -159,6 +361,24 @@ class FormulaParser(object):
         # Remove any white space and line breaks from formula.
         self.formula = formula.replace(' ', '').replace('\n', '').replace('\r', '')
 
+    def optimize_formula(self):
+        """
+        Return the optimized expression stack of the current formula.
+        """
+        return optimize(compile_formula(self.formula))
+
+    def referenced_variables(self, formula=None):
+        """
+        Return the names of the variables that the formula references, after
+        constant folding. Data for other variables is not used by the
+        evaluation.
+        """
+        if formula:
+            self.set_formula(formula)
+        if not self.formula:
+            raise RasterAlgebraException('Formula not specified.')
+        return self.optimize_formula().variables
+
     def prepare_data(self):
         """
         Basic checks and conversion of input data.
@@ -173,16 +393,29 @@ class FormulaParser(object):
             if not isinstance(var, numpy.ndarray):
                 self.variable_map[key] = numpy.array(var)
 
-    def evaluate(self, data={}, formula=None):
+    def set_shared(self, optimized):
+        """
+        Prepare the reuse of shared subexpressions for an evaluation of the
+        optimized stack. The values of shared subexpressions are kept in the
+        memo until it is cleared.
+        """
+        self.shared = optimized.shared
+        self.starts = optimized.starts
+
+    def evaluate(self, data={}, formula=None, dtype=None):
         """
         Evaluate the input data using the current formula expression stack.
 
         The formula is stored as attribute and can be re-evaluated with several
-        input data sets on an existing parser.
+        input data sets on an existing parser. Numbers in the formula are
+        converted to the dtype, which defaults to float64.
         """
         if formula:
             self.set_formula(formula)
 
+        # Set the data type for numbers in the formula
+        self.number_dtype = dtype or const.ALGEBRA_PIXEL_TYPE_NUMPY
+
         if not self.formula:
             raise RasterAlgebraException('Formula not specified.')
 
@@ -192,83 +425,420 @@ class FormulaParser(object):
         # Check and convert input data
         self.prepare_data()
 
-        # Reset expression stack
-        self.expr_stack = []
+        # Get the optimized expression stack
+        optimized = self.optimize_formula()
 
-        # Populate the expression stack
-        self.bnf.parseString(self.formula)
+        # Try evaluating the formula as fused expression if requested, fall
+        # back to numpy if the formula can not be fused.
+        if self.get_backend() == const.NUMEXPR_BACKEND:
+            result = fused.evaluate(optimized.stack, self.variable_map, self.number_dtype)
+            if result is not None:
+                return result
 
-        # Evaluate stack on data
-        return self.evaluate_stack(self.expr_stack)
+        # Evaluate a fresh copy of the stack on data
+        self.set_shared(optimized)
+        self.memo = {}
+        self.expr_stack = list(optimized.stack)
+        result = self.evaluate_stack(self.expr_stack)
+        self.memo = {}
+
+        return result
+
+    def evaluate_valid(self, data, valid, formula=None, dtype=None, fill_values=None):
+        """
+        Evaluate the input data on plain arrays with validity masks.
+
+        This is an alternative to evaluating masked arrays that avoids the
+        overhead of numpy.ma. The data dictionary holds plain arrays and the
+        valid dictionary holds boolean arrays that are True for valid values,
+        for the variables that have nodata. The fill values are used by the
+        fill operator and default to the numpy.ma default fill values.
+
+        Returns the result and its validity array, which is None if all
+        values are valid. The results are the same as when evaluating masked
+        arrays with the evaluate method.
+        """
+        if formula:
+            self.set_formula(formula)
+
+        if not self.formula:
+            raise RasterAlgebraException('Formula not specified.')
+
+        return self.evaluate_valid_multi(data, valid, [self.formula], dtype, fill_values)[0]
+
+    def evaluate_valid_multi(self, data, valid, formulas, dtype=None, fill_values=None):
+        """
+        Evaluate several formulas on the same plain arrays with validity masks.
+
+        The formulas are optimized together, such that the subexpressions they
+        have in common are evaluated only once. Returns a list with the result
+        and its validity array for each formula, see evaluate_valid. Results
+        can share memory with each other.
+        """
+        # Set the data type for numbers in the formula
+        self.number_dtype = dtype or const.ALGEBRA_PIXEL_TYPE_NUMPY
+
+        compiled = []
+        for formula in formulas:
+            self.set_formula(formula or '')
+            if not self.formula:
+                raise RasterAlgebraException('Formula not specified.')
+            compiled.append(compile_formula(self.formula))
+
+        # Store data and masks for variables
+        self.variable_map = data
+        self.prepare_data()
+        self.valid_map = valid
+        self.fill_map = {
+            key: numpy.ma.default_fill_value(self.variable_map[key]) for key in valid if key in self.variable_map
+        }
+        self.fill_map.update(fill_values or {})
+
+        # The values of shared subexpressions are kept for all formulas.
+        self.memo = {}
+
+        results = []
+        for optimized in optimize_all(tuple(compiled)):
+            # Try evaluating the formula as fused expression if requested.
+            if self.get_backend() == const.NUMEXPR_BACKEND:
+                result = fused.evaluate_valid(optimized.stack, self.variable_map, valid, self.number_dtype)
+                if result is not None:
+                    results.append(result)
+                    continue
+
+            # Evaluate a fresh copy of the stack on data, values outside of the
+            # operation domains are masked and do not need to raise warnings.
+            self.set_shared(optimized)
+            self.expr_stack = list(optimized.stack)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                result, result_valid, fill = self.evaluate_stack_valid(self.expr_stack)
+            results.append((result, result_valid))
+
+        self.memo = {}
+
+        return results
 
 
 class RasterAlgebraParser(FormulaParser):
     """
     Compute raster algebra expressions using the FormulaParser class.
+
+    The precision determines the data type in which formulas are evaluated.
+    In float64 mode, all data is converted to float64 and the results are
+    float64 rasters. In float32 mode, the data is evaluated in float32. In
+    auto mode, the narrowest data type that does not alter the result is
+    inferred from the formula and the input data types. In the float32 and
+    auto modes, the results are stored in the narrowest GDAL datatype that
+    holds the result values.
     """
 
-    def evaluate_raster_algebra(self, data, formula, check_aligned=False):
+    def __init__(self, backend=None, precision=None):
+        super(RasterAlgebraParser, self).__init__(backend=backend)
+        # Set the evaluation precision, defaults to the precision from settings
+        self.precision = precision
+
+    def get_precision(self):
         """
-        Evaluate a raster algebra expression on a set of rasters. All input
-        rasters need to be strictly aligned (same size, geotransform and srid).
+        Return the evaluation precision, either float64, float32 or auto.
+        """
+        if self.precision is None:
+            return getattr(settings, 'RASTER_ALGEBRA_PRECISION', const.PRECISION_FLOAT64)
+        return self.precision
 
-        The input raster list will be zipped into a dictionary using the input
-        names. The resulting dictionary will be used as input data for formula
-        evaluation. If the check_aligned flag is set, the input rasters are
-        compared to make sure they are aligned.
+    def get_dtypes(self, arrays, nodata_values):
+        """
+        Return the evaluation dtype and the result dtype for the current
+        formula on the input arrays. The result dtype is None if it is the
+        dtype of the evaluation result.
+        """
+        precision = self.get_precision()
+
+        if precision == const.PRECISION_FLOAT64 or not self.formula:
+            return algebra_precision.FLOAT64, algebra_precision.FLOAT64
+        elif precision == const.PRECISION_FLOAT32:
+            return algebra_precision.FLOAT32, None
+        elif precision != const.PRECISION_AUTO:
+            raise RasterAlgebraException('Unknown algebra precision "{}".'.format(precision))
+
+        tree = build_tree(self.optimize_formula().stack)
+        if tree is None:
+            return algebra_precision.FLOAT64, algebra_precision.FLOAT64
+
+        dtypes = {key: array.dtype for key, array in arrays.items()}
+
+        return algebra_precision.infer_dtypes(tree, dtypes, nodata_values)
+
+    def get_result_datatype(self, formula, dtypes, nodata_values):
+        """
+        Return the GDAL datatype, the numpy dtype and the nodata value of the
+        results of evaluate_raster_data for the formula, inferred from the
+        dtypes and nodata values of the input bands keyed by data key. The
+        formula is not evaluated. The nodata value is the one of results with
+        nodata pixels, results without a masked input have the nodata value
+        of the first input.
+        """
+        referenced = self.referenced_variables(formula)
+        precision = self.get_precision()
+
+        band_dtypes = {}
+        masked = {}
+        for key, dtype in dtypes.items():
+            variable, band_index = self.split_key(key)
+            if variable in referenced:
+                band_dtypes[variable] = numpy.dtype(dtype)
+                masked[variable] = nodata_values[key]
+        masked = {variable: nodata for variable, nodata in masked.items() if nodata is not None}
+
+        tree = build_tree(self.optimize_formula().stack)
+        if tree is None:
+            dtype, result_dtype = algebra_precision.FLOAT64, algebra_precision.FLOAT64
+        else:
+            dtype, result_dtype = algebra_precision.infer_dtypes(tree, band_dtypes, masked.values())
+
+        # Results are evaluated in the dtype of the precision
+        boolean = result_dtype == algebra_precision.BOOL
+        if precision == const.PRECISION_FLOAT64:
+            dtype = algebra_precision.FLOAT64
+        elif precision == const.PRECISION_FLOAT32:
+            dtype = result_dtype = algebra_precision.BOOL if boolean else algebra_precision.FLOAT32
+
+        # Use the nodata value of the masked variable that fills the result
+        variable = None if tree is None else fill_variable(tree, masked)
+        if variable is None:
+            nodata = next(iter(nodata_values.values()), None)
+        elif boolean:
+            nodata = const.ALGEBRA_BOOLEAN_NODATA
+        else:
+            nodata = float(numpy.array(masked[variable]).astype(dtype))
+
+        if precision == const.PRECISION_FLOAT64:
+            return const.ALGEBRA_PIXEL_TYPE_GDAL, const.ALGEBRA_PIXEL_TYPE_NUMPY, nodata
+        datatype, numpy_type = algebra_precision.gdal_datatype(result_dtype, nodata)
+        return datatype, numpy_type, nodata
+
+    def evaluate_raster_data(self, data, formula, check_aligned=False, halo=0):
+        """
+        Evaluate a raster algebra expression on a set of rasters and return
+        the result as an array with its validity and nodata value.
+
+        The result is a flat array in the datatype of the result raster, with
+        the nodata value filled in. The validity is a boolean array that is
+        False for the nodata pixels of the result, or None if the result has
+        no nodata value. The input data is evaluated as plain arrays with
+        validity masks, without the overhead of masked arrays.
+
+        Neighborhood functions require data around the area of interest. If
+        the input rasters have a halo of pixels around the area of interest,
+        the halo is cropped from the result, see get_halo.
+        """
+        return self.evaluate_raster_data_multi(data, [formula], check_aligned, halo)[0]
+
+    def evaluate_raster_data_multi(self, data, formulas, check_aligned=False, halo=0):
+        """
+        Evaluate several raster algebra expressions on the same set of rasters.
+
+        The bands are read and converted once for all formulas, and the
+        subexpressions that the formulas have in common are evaluated once.
+        Returns a list with the result, its validity and its nodata value for
+        each formula, see evaluate_raster_data.
         """
         # Check that all input rasters are aligned
         if check_aligned:
             self.check_aligned(list(data.values()))
 
-        # Construct list of numpy arrays holding raster pixel data, converting
-        # data to default number type. This is necessary because formula
-        # evaluation can lead to unexpected results. This could be
-        # differentiated in the future based on data types and formulas.
-        data_arrays = {}
+        # Neighborhood functions evaluate the flat data in the shape of the
+        # rasters.
+        orig = list(data.values())[0]
+        self.shape = (orig.height, orig.width)
+        self.pixel_size = (abs(orig.scale.x), abs(orig.scale.y))
+
+        # Normalize the formulas and collect the referenced variables.
+        normalized = []
+        referenced = set()
+        for formula in formulas:
+            referenced.update(self.referenced_variables(formula))
+            normalized.append(self.formula)
+
+        # Construct list of numpy arrays holding raster pixel data. Bands of
+        # variables that the formulas do not reference are not read.
+        band_arrays = {}
+        nodata_values = {}
         for key, rast in data.items():
 
-            keysplit = key.split(const.BAND_INDEX_SEPARATOR)
+            variable, band_index = self.split_key(key)
+
+            if variable not in referenced:
+                continue
+
+            band_arrays[variable] = rast.bands[band_index].data().ravel()
+            nodata_values[variable] = rast.bands[band_index].nodata_value
 
-            variable = keysplit[0]
+        # Convert data to the evaluation number type. By default this is
+        # float64, because formula evaluation in the data types of the input
+        # can lead to unexpected results such as integer overflows. Several
+        # formulas are evaluated in a common type that holds the values of
+        # all formulas, such that subexpressions can be shared.
+        result_dtypes = []
+        evaluation_dtypes = []
+        for formula in normalized:
+            self.set_formula(formula)
+            dtype, result_dtype = self.get_dtypes(band_arrays, nodata_values.values())
+            evaluation_dtypes.append(dtype)
+            result_dtypes.append(result_dtype)
+        dtype = numpy.result_type(*evaluation_dtypes)
 
-            if len(keysplit) > 1:
-                band_index = int(keysplit[1])
+        data_arrays = {}
+        valid = {}
+        fill_values = {}
+        for variable, array in band_arrays.items():
+            data_arrays[variable] = array.astype(dtype, copy=False)
+            nodata = nodata_values[variable]
+            if nodata is not None:
+                valid[variable] = self.get_valid(data_arrays[variable], nodata)
+                fill_values[variable] = nodata
+
+        # Evaluate formulas on raster data
+        evaluated = self.evaluate_valid_multi(data_arrays, valid, normalized, dtype=dtype, fill_values=fill_values)
+
+        results = []
+        for formula, (result, result_valid), result_dtype in zip(normalized, evaluated, result_dtypes):
+            # Crop the halo from the result
+            if halo:
+                result = self.crop_halo(result, self.shape, halo)
+                result_valid = None if result_valid is None else self.crop_halo(result_valid, self.shape, halo)
+
+            # Get nodata value from the masked input data or from the original
+            # band data. Masked results inherit the nodata value of a masked
+            # variable in the formula, following numpy.ma.
+            if result_valid is not None and not numpy.all(result_valid):
+                if result.dtype == bool:
+                    # Boolean results need a nodata value that is distinct
+                    # from true and false.
+                    nodata = const.ALGEBRA_BOOLEAN_NODATA
+                else:
+                    variable = fill_variable(build_tree(optimize(compile_formula(formula)).stack), valid)
+                    nodata = float(numpy.array(fill_values[variable]).astype(result.dtype))
             else:
-                band_index = 0
+                result_valid = None
+                nodata = orig.bands[0].nodata_value
 
-            if rast.bands[band_index].nodata_value is None:
-                data_arrays[variable] = rast.bands[band_index].data().ravel().astype(const.ALGEBRA_PIXEL_TYPE_NUMPY)
+            # Store the result in the narrowest GDAL datatype that holds the
+            # result values and the nodata value.
+            if self.get_precision() == const.PRECISION_FLOAT64:
+                numpy_type = const.ALGEBRA_PIXEL_TYPE_NUMPY
             else:
-                data_arrays[variable] = numpy.ma.masked_values(
-                    rast.bands[band_index].data().ravel().astype(const.ALGEBRA_PIXEL_TYPE_NUMPY),
-                    rast.bands[band_index].nodata_value,
-                )
+                numpy_type = algebra_precision.gdal_datatype(result_dtype or result.dtype, nodata)[1]
+
+            # Convert the result to the datatype and fill in the nodata value
+            result = numpy.array(result, dtype=numpy_type)
+            if result_valid is not None:
+                result[numpy.logical_not(result_valid)] = nodata
+
+            # Valid pixels that have the nodata value are nodata in the result.
+            if nodata is not None:
+                result_valid = self.get_valid(result, nodata)
+
+            results.append((result, result_valid, nodata))
+
+        return results
+
+    def get_halo(self, formula=None):
+        """
+        Return the number of pixels around the area of interest that the
+        neighborhood functions in the formula depend on. Invalid formulas
+        have no halo, their evaluation reports the errors.
+        """
+        if formula:
+            self.set_formula(formula)
+        try:
+            tree = build_tree(self.optimize_formula().stack)
+        except ParseException:
+            return 0
+        return 0 if tree is None else halo(tree)
 
-        # Evaluate formula on raster data
-        result = self.evaluate(data_arrays, formula)
+    @staticmethod
+    def crop_halo(array, shape, halo):
+        """
+        Crop a halo of pixels from a flat array of the given shape. Arrays of
+        other sizes, such as the results of reductions, are returned as is.
+        """
+        if numpy.size(array) != shape[0] * shape[1]:
+            return array
+        array = numpy.reshape(array, shape)[halo:shape[0] - halo, halo:shape[1] - halo]
+        return array.ravel()
+
+    @staticmethod
+    def split_key(key):
+        """
+        Split a data key into the variable name and the band index.
+        """
+        keysplit = key.split(const.BAND_INDEX_SEPARATOR)
+
+        variable = keysplit[0]
+
+        if len(keysplit) > 1:
+            band_index = int(keysplit[1])
+        else:
+            band_index = 0
+
+        return variable, band_index
+
+    def referenced_layers(self, layers, formula=None):
+        """
+        Return the part of a dictionary keyed by data keys, such as the layer
+        ids of an algebra request, that the formula references. The keys are
+        variable names with optional band indices, layers of other keys do
+        not need to be fetched for the evaluation.
+
+        The dictionary is returned unchanged if the formula is invalid or
+        references none of the keys, such that the evaluation reports errors.
+        """
+        try:
+            referenced = self.referenced_variables(formula)
+            result = {key: value for key, value in layers.items() if self.split_key(key)[0] in referenced}
+        except (ParseException, RasterAlgebraException, ValueError):
+            return layers
+
+        return result or layers
+
+    @staticmethod
+    def get_valid(data, nodata):
+        """
+        Return a boolean array that is True where data is not nodata.
+        """
+        if numpy.isnan(nodata):
+            return numpy.logical_not(numpy.isnan(data))
+        return data != nodata
+
+    def evaluate_raster_algebra(self, data, formula, check_aligned=False, halo=0):
+        """
+        Evaluate a raster algebra expression on a set of rasters. All input
+        rasters need to be strictly aligned (same size, geotransform and srid).
+
+        The input raster list will be zipped into a dictionary using the input
+        names. The resulting dictionary will be used as input data for formula
+        evaluation. If the check_aligned flag is set, the input rasters are
+        compared to make sure they are aligned. If the input rasters have a
+        halo of pixels for neighborhood functions, the result raster covers
+        the area within the halo.
+        """
+        result, valid, nodata = self.evaluate_raster_data(data, formula, check_aligned, halo)
 
         # Reference first original raster for constructing result
         orig = list(data.values())[0]
 
-        # Get nodata value from mask or from original band data
-        if numpy.ma.is_masked(result):
-            # Get mask fill value
-            nodata = float(result.fill_value)
-            # Overwrite result with mask values filled in
-            result = result.filled()
-        else:
-            nodata = orig.bands[0].nodata_value
+        # Get the GDAL datatype of the result
+        datatype = dict((numpy_type, datatype) for datatype, numpy_type in const.ALGEBRA_DATATYPES)[result.dtype.name]
 
         # Return GDALRaster holding results
         return GDALRaster({
-            'datatype': const.ALGEBRA_PIXEL_TYPE_GDAL,
+            'datatype': datatype,
             'driver': 'MEM',
-            'width': orig.width,
-            'height': orig.height,
+            'width': orig.width - 2 * halo,
+            'height': orig.height - 2 * halo,
             'nr_of_bands': 1,
             'srid': orig.srs.srid,
-            'origin': orig.origin,
+            'origin': (orig.origin.x + halo * orig.scale.x, orig.origin.y + halo * orig.scale.y),
             'scale': orig.scale,
             'skew': orig.skew,
             'bands': [{
@@ -0,0 +1,224 @@
+"""
+Data type inference for raster algebra.
+
+By default, raster algebra is evaluated in float64. For byte and integer
+rasters, this is several times the memory that is needed to hold the data.
+The functions in this module infer the narrowest data type in which a formula
+can be evaluated without changing its result, and select the narrowest GDAL
+datatype that holds a result.
+
+Integer arithmetic is tracked by the value range of every node in the
+expression tree, such that additions, subtractions and multiplications are
+widened just enough to never overflow. Operations that produce fractional
+values are evaluated in float64, unless their inputs are float32 data that
+is evaluated at its own precision.
+"""
+import numpy
+
+from raster.algebra import const
+
+FLOAT64 = numpy.dtype(const.ALGEBRA_PIXEL_TYPE_NUMPY)
+FLOAT32 = numpy.dtype('float32')
+BOOL = numpy.dtype('bool')
+
+# Integer dtypes, from narrow to wide
+INTEGER_DTYPES = [numpy.dtype(name) for name in ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'uint64', 'int64')]
+
+# Functions that always produce fractional values
+FRACTIONAL_FUNCTIONS = (
+    'sin', 'cos', 'tan', 'log', 'exp', 'mean', 'median', 'std', 'focalmean', 'focalstd', 'slope', 'hillshade',
+)
+
+# Functions that preserve the data type and value range of their input
+PRESERVING_FUNCTIONS = ('round', 'sign', 'int', 'min', 'max', 'focalmin', 'focalmax', 'focalmajority')
+
+# Operators that preserve integer types
+INTEGER_OPERATORS = (const.ADD, const.SUBTRACT, const.MULTIPLY)
+
+# Operators that result in booleans
+BOOLEAN_OPERATORS = (
+    const.EQUAL,
+    const.NOT_EQUAL,
+    const.GREATER,
+    const.GREATER_EQUAL,
+    const.LESS,
+    const.LESS_EQUAL,
+    const.LOGICAL_OR,
+    const.LOGICAL_AND,
+)
+
+
+def range_dtype(low, high):
+    """
+    Return the narrowest integer dtype holding the value range. Ranges beyond
+    the 64 bit integer types are evaluated in float64.
+    """
+    for dtype in INTEGER_DTYPES:
+        info = numpy.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return FLOAT64
+
+
+def constant_type(value):
+    """
+    Return the dtype and value range of a constant. Integral values are
+    integers, other values are float32 if they can be represented exactly.
+    """
+    if isinstance(value, bool):
+        return BOOL, (0, 1)
+    value = float(value)
+    if value.is_integer():
+        return range_dtype(int(value), int(value)), (int(value), int(value))
+    if numpy.isinf(value) or float(numpy.float32(value)) == value:
+        return FLOAT32, None
+    return FLOAT64, None
+
+
+def infer_dtypes(tree, dtypes, nodata_values=()):
+    """
+    Infer the dtypes for evaluating the tree on variables of the given dtypes.
+
+    Returns the evaluation dtype to which all input data and constants are
+    converted, and the dtype that holds the result values. The nodata values
+    of the input data are included in the evaluation dtype, such that the
+    masks and fill values of the input data are preserved.
+    """
+    # Collect the dtypes of all values computed in the tree.
+    found = []
+
+    def visit(node):
+        """
+        Return the dtype and the integer value range of a node. The range is
+        None for fractional values.
+        """
+        if node[0] == 'variable':
+            dtype = numpy.dtype(dtypes[node[1]])
+            if dtype.kind == 'b':
+                return BOOL, (0, 1)
+            elif dtype.kind in 'iu':
+                info = numpy.iinfo(dtype)
+                result = dtype, (int(info.min), int(info.max))
+            else:
+                result = dtype, None
+
+        elif node[0] == 'number':
+            result = constant_type(node[1])
+
+        elif node[0] == 'keyword':
+            if node[1] == const.NULL:
+                return None, None
+            result = constant_type(const.KEYWORD_MAP[node[1]])
+
+        elif node[0] == 'unary':
+            dtype, rng = visit(node[2])
+            if node[1] == const.UNARY_NOT:
+                return BOOL, (0, 1)
+            elif node[1] == const.UNARY_LESS and rng is not None and dtype != BOOL:
+                rng = (-rng[1], -rng[0])
+                dtype = range_dtype(*rng)
+            result = dtype, rng
+
+        elif node[0] == 'function':
+            dtype, rng = visit(node[2])
+            if node[1] in FRACTIONAL_FUNCTIONS:
+                result = (dtype if dtype.kind == 'f' else FLOAT64), None
+            elif node[1] == 'abs' and rng is not None:
+                low = 0 if rng[0] <= 0 <= rng[1] else min(abs(rng[0]), abs(rng[1]))
+                rng = (low, max(abs(rng[0]), abs(rng[1])))
+                result = range_dtype(*rng), rng
+            elif node[1] == 'focalsum' and rng is not None:
+                # Focal sums add up the values of a window.
+                size = (2 * const.NEIGHBORHOOD_RADIUS + 1) ** 2
+                rng = (min(0, size * rng[0]), max(0, size * rng[1]))
+                result = range_dtype(*rng), rng
+            elif node[1] in PRESERVING_FUNCTIONS or node[1] == 'abs':
+                result = dtype, rng
+            else:
+                # Sums are accumulated in 64 bit precision.
+                result = (numpy.dtype('int64') if rng is not None else dtype), None
+
+        else:
+            left, left_range = visit(node[2])
+            right, right_range = visit(node[3])
+
+            if left is None or right is None:
+                # Null comparisons only use the mask of the other operand.
+                return BOOL, (0, 1)
+
+            elif node[1] in BOOLEAN_OPERATORS:
+                # Operands are compared in their common dtype.
+                if node[1] not in (const.LOGICAL_OR, const.LOGICAL_AND):
+                    found.append(numpy.result_type(left, right))
+                return BOOL, (0, 1)
+
+            elif left == BOOL and right == BOOL:
+                # Arithmetic on booleans results in booleans in numpy.
+                return BOOL, (0, 1)
+
+            elif node[1] in INTEGER_OPERATORS and left_range is not None and right_range is not None:
+                if node[1] == const.ADD:
+                    rng = (left_range[0] + right_range[0], left_range[1] + right_range[1])
+                elif node[1] == const.SUBTRACT:
+                    rng = (left_range[0] - right_range[1], left_range[1] - right_range[0])
+                else:
+                    products = [a * b for a in left_range for b in right_range]
+                    rng = (min(products), max(products))
+                result = range_dtype(*rng), rng
+
+            elif left.kind == 'f' or right.kind == 'f':
+                # Float operands keep their precision if the integer operands
+                # can be represented exactly.
+                result = numpy.result_type(left, right), None
+
+            else:
+                result = FLOAT64, None
+
+        if result[0] != BOOL:
+            found.append(result[0])
+
+        return result
+
+    try:
+        result, rng = visit(tree)
+    except KeyError:
+        # Undeclared variables are reported by the evaluation.
+        return FLOAT64, FLOAT64
+
+    # Include the nodata values of the input data.
+    for nodata in nodata_values:
+        if nodata is not None:
+            found.append(constant_type(nodata)[0])
+
+    evaluation = numpy.result_type(*found) if found else BOOL
+
+    # Integer results are stored in the dtype of their value range.
+    if rng is not None and result != BOOL:
+        result = range_dtype(*rng)
+
+    return evaluation, result
+
+
+def fits(value, dtype):
+    """
+    Check if a value can be represented exactly in a dtype.
+    """
+    if value is None:
+        return True
+    dtype = numpy.dtype(dtype)
+    value = float(value)
+    if dtype.kind == 'f':
+        return numpy.isnan(value) or float(dtype.type(value)) == value
+    info = numpy.iinfo(dtype)
+    return value.is_integer() and info.min <= value <= info.max
+
+
+def gdal_datatype(dtype, nodata=None):
+    """
+    Return the narrowest GDAL datatype and its numpy dtype that hold values of
+    the dtype and the nodata value.
+    """
+    for datatype, numpy_type in const.ALGEBRA_DATATYPES:
+        if numpy.can_cast(dtype, numpy_type) and fits(nodata, numpy_type):
+            return datatype, numpy_type
+    return const.ALGEBRA_PIXEL_TYPE_GDAL, const.ALGEBRA_PIXEL_TYPE_NUMPY
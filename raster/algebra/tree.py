@@ -0,0 +1,132 @@
+"""
+Expression trees of compiled formulas.
+
+The formula grammar produces expression stacks in postfix order, which are
+convenient to evaluate but not to analyse. This module converts stacks into
+nested tuples that can be inspected and translated by the evaluation
+backends. The following node types are used:
+
+    ('variable', name)
+    ('number', token)
+    ('keyword', name)
+    ('unary', operator, child)
+    ('binary', operator, left, right)
+    ('function', name, child)
+"""
+import re
+from functools import lru_cache
+
+from raster.algebra import const
+
+NUMBER = re.compile(const.NUMBER)
+
+
+@lru_cache(maxsize=const.FORMULA_CACHE_SIZE)
+def build_tree(stack):
+    """
+    Convert an expression stack into a tree. The stack elements are
+    interpreted in the same order as in the FormulaParser evaluation. Returns
+    None if the stack is not a complete expression.
+    """
+    stack = list(stack)
+
+    def pop():
+        op = stack.pop()
+
+        if op in const.UNARY_OPERATOR_MAP:
+            return ('unary', op, pop())
+
+        elif op in const.OPERATOR_MAP:
+            right = pop()
+            left = pop()
+            return ('binary', op, left, right)
+
+        elif op in const.FUNCTION_MAP or op in const.NEIGHBORHOOD_FUNCTIONS:
+            return ('function', op, pop())
+
+        elif op in const.KEYWORD_MAP:
+            return ('keyword', op)
+
+        elif NUMBER.fullmatch(op):
+            return ('number', op)
+
+        return ('variable', op)
+
+    try:
+        tree = pop()
+    except IndexError:
+        return
+
+    # The stack has to be consumed entirely by the tree.
+    if stack:
+        return
+
+    return tree
+
+
+def build_stack(tree):
+    """
+    Convert a tree back into an expression stack.
+    """
+    if tree[0] in ('variable', 'number', 'keyword'):
+        return (tree[1], )
+    stack = ()
+    for child in tree[2:]:
+        stack += build_stack(child)
+    return stack + (tree[1], )
+
+
+def variables(tree):
+    """
+    List the variable names in a tree, in order of appearance in the formula.
+    """
+    if tree[0] == 'variable':
+        return [tree[1]]
+    elif tree[0] in ('number', 'keyword'):
+        return []
+    result = []
+    for child in tree[2:]:
+        result.extend(name for name in variables(child) if name not in result)
+    return result
+
+
+def halo(tree):
+    """
+    Return the number of pixels around the data that the result of the tree
+    depends on through neighborhood functions.
+    """
+    if tree[0] in ('variable', 'number', 'keyword'):
+        return 0
+    result = max(halo(child) for child in tree[2:])
+    if tree[0] == 'function' and tree[1] in const.NEIGHBORHOOD_FUNCTIONS:
+        result += const.NEIGHBORHOOD_RADIUS
+    return result
+
+
+def fill_variable(tree, masked):
+    """
+    Return the name of the masked variable from which the result of the tree
+    inherits its fill value in numpy.ma, or None if the result is not a
+    masked array. The fill operator, the unary plus, null comparisons and
+    reductions result in regular arrays.
+    """
+    if tree[0] == 'variable':
+        return tree[1] if tree[1] in masked else None
+
+    elif tree[0] in ('number', 'keyword'):
+        return
+
+    elif tree[0] == 'unary':
+        if tree[1] in (const.UNARY_FILL, const.UNARY_AND):
+            return
+        return fill_variable(tree[2], masked)
+
+    elif tree[0] == 'function':
+        if tree[1] in const.REDUCTION_FUNCTIONS:
+            return
+        return fill_variable(tree[2], masked)
+
+    if ('keyword', const.NULL) in tree[2:]:
+        return
+
+    return fill_variable(tree[2], masked) or fill_variable(tree[3], masked)
@@ -0,0 +1,85 @@
+"""
+Cloud optimized GeoTIFF output.
+
+Cloud optimized GeoTIFFs are internally tiled and compressed, and store their
+overviews ahead of the full resolution data. Clients can read any part of the
+raster at any resolution through http range requests, without downloading the
+entire file.
+"""
+from ctypes import POINTER, c_char_p, c_int, c_void_p
+
+from django.contrib.gis.gdal import Driver
+from django.contrib.gis.gdal.libgdal import std_call
+from django.contrib.gis.gdal.prototypes import raster as capi
+from django.contrib.gis.gdal.prototypes.generation import void_output, voidptr_output
+from django.contrib.gis.gdal.raster.band import GDALBand
+from raster.tiles.const import WEB_MERCATOR_TILESIZE
+
+# Reference for GDALBuildOverviews and GDALGetOverview
+# https://gdal.org/api/raster_c_api.html
+
+build_overviews = void_output(std_call('GDALBuildOverviews'),
+    [c_void_p, c_char_p, c_int, POINTER(c_int), c_int, POINTER(c_int), c_void_p, c_void_p],
+    cpl=True
+)
+get_overview = voidptr_output(std_call('GDALGetOverview'), [c_void_p, c_int])
+
+# GDAL datatypes of floating point data
+FLOAT_DATATYPES = (6, 7)
+
+
+class OverviewBand(GDALBand):
+    """
+    An overview of a raster band, which is read and written like the band.
+    """
+
+    def __init__(self, band, index):
+        self.source = band.source
+        self._ptr = get_overview(band.ptr, index)
+
+
+def overview_factors(width, height, zoom):
+    """
+    Return the decimation factors of the overviews of a raster at the zoom
+    level, halving the resolution until the raster fits into one tile. Every
+    overview corresponds to a zoom level of the tile pyramid.
+    """
+    factors = []
+    factor = 1
+    while max(width, height) > factor * WEB_MERCATOR_TILESIZE and len(factors) < zoom:
+        factor *= 2
+        factors.append(factor)
+    return factors
+
+
+def add_overviews(raster, factors):
+    """
+    Add empty overviews with the decimation factors to the raster. Returns
+    the overview bands of the first band of the raster.
+    """
+    overview_list = (c_int * len(factors))(*factors)
+    # The overviews are created without computing their pixel values
+    build_overviews(raster.ptr, b'NONE', len(factors), overview_list, 0, None, None, None)
+    return [OverviewBand(raster.bands[0], index) for index in range(len(factors))]
+
+
+def write_cog(raster, name, compress):
+    """
+    Copy a raster with its overviews into a cloud optimized GeoTIFF file,
+    with internal tiles of the web mercator tilesize.
+    """
+    predictor = 3 if raster.bands[0].datatype() in FLOAT_DATATYPES else 2
+    options = [
+        'TILED=YES',
+        'BLOCKXSIZE={}'.format(WEB_MERCATOR_TILESIZE),
+        'BLOCKYSIZE={}'.format(WEB_MERCATOR_TILESIZE),
+        'COMPRESS={}'.format(compress.upper()),
+        'PREDICTOR={}'.format(predictor),
+        'COPY_SRC_OVERVIEWS=YES',
+        'BIGTIFF=IF_SAFER',
+    ]
+    options = [option.encode() for option in options] + [None]
+    options = (c_char_p * len(options))(*options)
+    # Copy the raster and close the copy to write it to disk
+    target = capi.copy_ds(Driver('tif').ptr, name.encode(), raster.ptr, 0, options, None, None)
+    capi.close_ds(target)
@@ -0,0 +1,97 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+
+COLORMAP_REGISTRY_SIZE = 256
+
+COLORMAP_VERSION_KEY = 'raster:colormaps:version'
+
+
+class ColormapRegistry(object):
+    """
+    Cache for colormaps resolved from the database.
+
+    Tile requests resolve the same legends over and over again. The registry
+    keeps the resolved colormap dictionaries in memory, such that only the
+    first request for a given key needs to query and decode the legend. At
+    most ``RASTER_COLORMAP_REGISTRY_SIZE`` colormaps are kept, the least
+    recently used ones are dropped first. Keys that do not resolve to a
+    colormap are not registered.
+
+    The registry is local to the process, but tagged with a version that is
+    stored in the Django cache with the ``RASTER_COLORMAP_CACHE`` alias. The
+    legend, layer and band metadata signals in the models module change the
+    version whenever data that colormaps depend on is changed, which empties
+    the registries of all processes sharing that cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._colormaps = OrderedDict()
+        self._version = None
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'RASTER_COLORMAP_CACHE', DEFAULT_CACHE_ALIAS)]
+
+    @property
+    def size(self):
+        return getattr(settings, 'RASTER_COLORMAP_REGISTRY_SIZE', COLORMAP_REGISTRY_SIZE)
+
+    def _sync(self):
+        """
+        Drop the registered colormaps if the shared version has changed.
+        """
+        version = self.cache.get(COLORMAP_VERSION_KEY)
+        if version != self._version:
+            self._colormaps.clear()
+            self._version = version
+
+    def get(self, key, resolve):
+        """
+        Return the colormap for the key, calling resolve to compute it if it
+        has not been registered yet. Colormaps are returned as copies such
+        that callers can modify them without altering the registry.
+        """
+        with self._lock:
+            self._sync()
+            version = self._version
+            colormap = self._colormaps.get(key)
+            if colormap is not None:
+                self._colormaps.move_to_end(key)
+
+        if colormap is None:
+            colormap = resolve()
+            if colormap is not None:
+                with self._lock:
+                    # Skip colormaps resolved before a concurrent change
+                    if version != self._version:
+                        return colormap
+                    self._colormaps[key] = colormap
+                    while len(self._colormaps) > self.size:
+                        self._colormaps.popitem(last=False)
+
+        if isinstance(colormap, dict):
+            return dict(colormap)
+
+        return colormap
+
+    def clear(self):
+        """
+        Drop all registered colormaps in this and all other processes.
+        """
+        with self._lock:
+            self._version = uuid.uuid4().hex
+            self.cache.set(COLORMAP_VERSION_KEY, self._version, None)
+            self._colormaps.clear()
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return len(self._colormaps)
+
+
+colormap_registry = ColormapRegistry()
@@ -8,7 +8,23 @@ IMG_ENHANCEMENTS = {
 }
 IMG_FORMATS = {'png': ('PNG', 'image/png'), 'jpg': ('JPEG', 'image/jpeg'), 'tif': ('TIFF', 'image/tiff')}
 EXPORT_MAX_PIXELS = 10000 * 10000
+EXPORT_PREFETCH_ROWS = 2
+EXPORT_FORMAT_COG = 'cog'
+EXPORT_FORMATS = ('zip', EXPORT_FORMAT_COG)
+EXPORT_COMPRESSION = 'deflate'
 MAX_EXPORT_NAME_LENGTH = 100
+AGGREGATION_TASK_TILES = 1024
+AGGREGATION_SAMPLE_PIXELS = 64 * 256 * 256
+AGGREGATION_SYNC_TILES = 256
+AGGREGATION_ENGINE_PYTHON = 'python'
+AGGREGATION_ENGINE_POSTGIS = 'postgis'
+AGGREGATION_ENGINE_AUTO = 'auto'
+AGGREGATION_ENGINES = (AGGREGATION_ENGINE_PYTHON, AGGREGATION_ENGINE_POSTGIS, AGGREGATION_ENGINE_AUTO)
+AGGREGATION_DATABASE_TILES = 256
+TILE_FETCH_SIZE = 64
+BINCOUNT_MAX_RANGE = 2 ** 16
+QUANTILE_SKETCH_COMPRESSION = 200
+ZONE_DATATYPE = 5
 README_TEMPLATE = """Django Raster Algebra Export
 ============================
 {description}
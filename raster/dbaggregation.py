@@ -0,0 +1,224 @@
+"""
+Aggregations of raster tiles in PostGIS.
+
+The database engine aggregates the values of a single band of a layer without
+reading the tiles into python. Value counts, histograms and summary statistics
+are merged over all tiles in the database, the queries return one row per
+value or histogram bin. Histograms and statistics within a value range bin
+the pixel values directly, such that continuous rasters are not grouped by
+their distinct values first. Clip geometries are applied with ``ST_Clip``, which
+selects the pixels whose center is within the geometry.
+
+The tiles are selected by their index range, which uses the index of the
+tile table. With a clip geometry, the tiles on the boundary of the geometry
+are found by their index beforehand and only their positions in the range are
+sent with the query. Only these tiles are clipped, the other tiles are either
+entirely inside or outside of the geometry and are selected by their center.
+"""
+import numpy
+
+from django.db import connection
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESHIFT, WEB_MERCATOR_WORLDSIZE
+
+TILE_FILTER_SQL = """
+rasterlayer_id = %(layer)s
+AND tilez = %(zoom)s
+AND tilex BETWEEN %(xmin)s AND %(xmax)s
+AND tiley BETWEEN %(ymin)s AND %(ymax)s
+"""
+
+TILE_POSITION_SQL = '((tiley - %(ymin)s) * %(width)s + tilex - %(xmin)s)'
+
+TILE_CENTER_SQL = """ST_SetSRID(ST_MakePoint(
+        (tilex + 0.5) * %(tilesize)s - %(shift)s,
+        %(shift)s - (tiley + 0.5) * %(tilesize)s
+    ), %(srid)s)"""
+
+CLIPPED_TILE_FILTER_SQL = TILE_FILTER_SQL + """
+AND (
+    {position} = ANY(%(clip)s::integer[])
+    OR ST_Intersects({center}, ST_GeomFromEWKB(%(geom)s))
+)
+""".format(position=TILE_POSITION_SQL, center=TILE_CENTER_SQL)
+
+CLIPPED_RASTER_SQL = """CASE
+        WHEN {position} = ANY(%(clip)s::integer[]) THEN ST_Clip(rast, ST_GeomFromEWKB(%(geom)s), TRUE)
+        ELSE rast
+    END""".format(position=TILE_POSITION_SQL)
+
+VALUE_COUNT_SQL = """
+SELECT (vcresult).value AS value, SUM((vcresult).count) AS count
+FROM (
+    SELECT ST_ValueCount({raster}, %(band)s, TRUE) AS vcresult
+    FROM raster_rastertile
+    WHERE {tiles}
+) AS tiles_for_agg
+WHERE (vcresult).value IS NOT NULL
+GROUP BY (vcresult).value
+"""
+
+PIXEL_VALUES_SQL = """
+SELECT unnest(ST_DumpValues({raster}, %(band)s, TRUE)) AS value
+FROM raster_rastertile
+WHERE {tiles}
+"""
+
+HISTOGRAM_SQL = """
+SELECT width_bucket(value, %(lower_bounds)s::double precision[]) AS bin, COUNT(*)
+FROM ({pixel_values}) AS pixel_values
+WHERE value BETWEEN %(low)s AND %(high)s
+GROUP BY bin
+"""
+
+RANGE_STATS_SQL = """
+SELECT COUNT(*), SUM(value), SUM(value * value), MIN(value), MAX(value)
+FROM ({pixel_values}) AS pixel_values
+WHERE value BETWEEN %(low)s AND %(high)s
+"""
+
+SUMMARY_STATS_SQL = """
+SELECT (stats).count, (stats).sum, (stats).mean, (stats).stddev, (stats).min, (stats).max
+FROM (
+    SELECT ST_SummaryStatsAgg({raster}, %(band)s, TRUE) AS stats
+    FROM raster_rastertile
+    WHERE {tiles}
+) AS tiles_for_agg
+"""
+
+BAND_TYPE_SQL = """
+SELECT ST_BandPixelType(rast, %(band)s), ST_BandNoDataValue(rast, %(band)s)
+FROM raster_rastertile
+WHERE rasterlayer_id = %(layer)s
+AND rast IS NOT NULL
+LIMIT 1
+"""
+
+# Numpy dtypes of the band data of PostGIS pixel types as read by Django, which
+# reads the sub byte and signed byte pixel types as unsigned bytes.
+PIXEL_TYPE_DTYPES = {
+    '1BB': 'uint8',
+    '2BUI': 'uint8',
+    '4BUI': 'uint8',
+    '8BSI': 'uint8',
+    '8BUI': 'uint8',
+    '16BSI': 'int16',
+    '16BUI': 'uint16',
+    '32BSI': 'int32',
+    '32BUI': 'uint32',
+    '32BF': 'float32',
+    '64BF': 'float64',
+}
+
+
+def band_type(layer_id, band):
+    """
+    Return the numpy dtype and the nodata value of a band of the tiles of a
+    layer from the header of one of its tiles. The dtype is None if the layer
+    has no tiles.
+    """
+    with connection.cursor() as cursor:
+        # Bands are numbered from one in PostGIS
+        cursor.execute(BAND_TYPE_SQL, {'layer': layer_id, 'band': band + 1})
+        row = cursor.fetchone()
+    if row is None:
+        return None, None
+    return PIXEL_TYPE_DTYPES.get(row[0], 'float64'), row[1]
+
+
+class TileQuery(object):
+    """
+    The tiles of a layer band within a tile range at a zoom level, optionally
+    clipped by a geometry in the projection of the tiles. The indices of the
+    tiles on the boundary of the geometry are found beforehand.
+    """
+
+    def __init__(self, layer_id, band, zoom, tilerange, geom=None, clip=()):
+        xmin, ymin, xmax, ymax = tilerange
+        self.geom = geom
+        self.params = {
+            'layer': layer_id,
+            # Bands are numbered from one in PostGIS
+            'band': band + 1,
+            'zoom': zoom,
+            'xmin': xmin,
+            'ymin': ymin,
+            'xmax': xmax,
+            'ymax': ymax,
+            'width': xmax - xmin + 1,
+        }
+        if geom is not None:
+            self.params['geom'] = bytes(geom.ewkb)
+            self.params['clip'] = self.positions(clip)
+            self.params['tilesize'] = WEB_MERCATOR_WORLDSIZE / 2 ** zoom
+            self.params['shift'] = WEB_MERCATOR_TILESHIFT
+            self.params['srid'] = WEB_MERCATOR_SRID
+
+    def positions(self, tiles):
+        """
+        Convert tile indices into positions within the tile range.
+        """
+        xmin, ymin, width = self.params['xmin'], self.params['ymin'], self.params['width']
+        return [(tiley - ymin) * width + tilex - xmin for tilex, tiley in tiles]
+
+    def format(self, sql):
+        """
+        Insert the raster expression and the tile filter into a query.
+        """
+        return sql.format(
+            raster=CLIPPED_RASTER_SQL if self.geom is not None else 'rast',
+            tiles=CLIPPED_TILE_FILTER_SQL if self.geom is not None else TILE_FILTER_SQL,
+        )
+
+    def execute(self, sql, **params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, dict(self.params, **params))
+            return cursor.fetchall()
+
+    def value_counts(self):
+        """
+        Return the unique values of the tiles and their counts as arrays.
+        """
+        rows = self.execute(self.format(VALUE_COUNT_SQL))
+        values = numpy.array([row[0] for row in rows], dtype='float64')
+        counts = numpy.array([row[1] for row in rows], dtype='int64')
+        return values, counts
+
+    def histogram(self, edges):
+        """
+        Return the counts of the pixel values in the bins between the edges,
+        with the same bins as ``numpy.histogram``. Every bin contains its
+        lower edge, the last bin also contains the upper edge.
+        """
+        edges = [float(edge) for edge in edges]
+        # Only the lower edges are passed to width_bucket, values on the upper
+        # edge are in the bucket of the last lower edge instead of past it.
+        rows = self.execute(
+            HISTOGRAM_SQL.format(pixel_values=self.format(PIXEL_VALUES_SQL)),
+            lower_bounds=edges[:-1],
+            low=edges[0],
+            high=edges[-1],
+        )
+        counts = numpy.zeros(len(edges) - 1, dtype='int64')
+        for index, count in rows:
+            counts[index - 1] = count
+        return counts
+
+    def statistics(self, value_range=None):
+        """
+        Return the number, the sum and the sum of squares of the values, and
+        their minimum and maximum. Only the values within the value range are
+        included if it is provided.
+        """
+        if value_range:
+            count, total, squares, minimum, maximum = self.execute(
+                RANGE_STATS_SQL.format(pixel_values=self.format(PIXEL_VALUES_SQL)),
+                low=float(value_range[0]),
+                high=float(value_range[1]),
+            )[0]
+        else:
+            count, total, mean, std, minimum, maximum = self.execute(self.format(SUMMARY_STATS_SQL))[0]
+            # Recover the sum of squares from the population standard deviation
+            squares = count * (std ** 2 + mean ** 2) if count else 0
+        if not count:
+            return 0, 0, 0, None, None
+        return int(count), total, squares, minimum, maximum
@@ -11,3 +11,11 @@ class RasterAlgebraException(SuspiciousOperation):
 
 class RasterAggregationException(Exception):
     pass
+
+
+class RasterExportCancelled(Exception):
+    """Raster export was cancelled."""
+
+
+class RasterAggregationCancelled(Exception):
+    """Raster aggregation was cancelled."""
@@ -0,0 +1,354 @@
+"""
+Raster algebra exports.
+
+Exports evaluate a formula on a range of tiles and write the results into a
+single raster. The tiles are processed in a pipeline: the rows of tiles are
+read from the database one row at a time, the algebra is evaluated by a pool
+of threads and a single writer writes the finished rows of tiles as blocks
+into the target band. Reading the next row overlaps with the evaluation of
+the previous ones, and numpy releases the GIL during evaluation such that the
+evaluation scales with the number of cores.
+
+Exports run asynchronously as RasterExport jobs. The job parameters are
+collected from the export request, the archive with the raster, a readme and
+a colormap is created by a task and stored on the job.
+"""
+import json
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+
+import numpy
+
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from django.core.files import File
+from raster.algebra.const import ALGEBRA_PIXEL_TYPE_GDAL, ALGEBRA_PIXEL_TYPE_NUMPY
+from raster.algebra.parser import RasterAlgebraParser
+from raster.cog import add_overviews, overview_factors, write_cog
+from raster.const import EXPORT_COMPRESSION, EXPORT_FORMAT_COG, EXPORT_PREFETCH_ROWS, README_TEMPLATE
+from raster.dbaggregation import band_type
+from raster.exceptions import RasterAlgebraException, RasterExportCancelled
+from raster.models import RasterExport
+from raster.streaming import StreamBuffer, StreamingGeoTIFF
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+from raster.tiles.lookup import get_raster_tile_row
+from raster.tiles.utils import tile_bounds, tile_scale
+
+
+def evaluate_tile(data, formula, halo=0, dtype=ALGEBRA_PIXEL_TYPE_NUMPY, nodata_value=None):
+    """
+    Evaluate the formula on the rasters of a tile. Returns the result data in
+    the dtype of the export, with the nodata value of the export filled in
+    where the result has no data. Every evaluation uses its own parser,
+    parsers are not thread safe.
+    """
+    result, valid, tile_nodata_value = RasterAlgebraParser().evaluate_raster_data(data, formula, halo=halo)
+    result = result.astype(dtype)
+    if valid is not None and nodata_value is not None:
+        result[numpy.logical_not(valid)] = nodata_value
+    return result
+
+
+def export_datatype(ids, formula):
+    """
+    Return the GDAL datatype, the numpy dtype and the nodata value of the
+    export raster. They are inferred from the formula and the pixel types and
+    nodata values of the layer bands, such that all tiles are written with the
+    same datatype and nodata value.
+    """
+    dtypes = {}
+    nodata_values = {}
+    for key, layerid in ids.items():
+        variable, band_index = RasterAlgebraParser.split_key(key)
+        dtypes[key], nodata_values[key] = band_type(layerid, band_index)
+        if dtypes[key] is None:
+            # Layers without tiles are not written
+            return ALGEBRA_PIXEL_TYPE_GDAL, ALGEBRA_PIXEL_TYPE_NUMPY, None
+
+    return RasterAlgebraParser().get_result_datatype(formula, dtypes, nodata_values)
+
+
+def fetch_row(ids, zoom, y, xmin, xmax, halo=0):
+    """
+    Read the rasters of a row of tiles for all layers. Returns a list of the
+    x indices and the data dictionaries of the tiles for which data was found
+    for all layers.
+    """
+    rows = {name: get_raster_tile_row(layerid, zoom, y, xmin, xmax, halo) for name, layerid in ids.items()}
+    tiles = []
+    for x in range(xmin, xmax + 1):
+        data = {name: row[x] for name, row in rows.items() if x in row}
+        # Ignore this tile if data is not found for all layers
+        if len(data) == len(ids):
+            tiles.append((x, data))
+    return tiles
+
+
+def write_row(target, yindex, xmin, evaluations, offset=(0, 0), dtype=ALGEBRA_PIXEL_TYPE_NUMPY, nodata_value=None):
+    """
+    Write the evaluated tiles of a row into the target band as one block.
+    The offset is the pixel position of the target in the mosaic of tiles,
+    the parts of the tiles outside of the target are skipped. The block is
+    written in the dtype of the target.
+    """
+    # Compute the rows of the tiles that are within the target
+    top = yindex * WEB_MERCATOR_TILESIZE - offset[1]
+    rows = slice(max(0, -top), min(WEB_MERCATOR_TILESIZE, target.height - top))
+
+    if not evaluations or rows.start >= rows.stop:
+        return
+
+    # Tiles without data are nodata, as in the empty target raster
+    width = -(-(offset[0] + target.width) // WEB_MERCATOR_TILESIZE) * WEB_MERCATOR_TILESIZE
+    block = numpy.full((WEB_MERCATOR_TILESIZE, width), nodata_value or 0, dtype=dtype)
+    for x, evaluation in evaluations:
+        try:
+            data = evaluation.result()
+        except:
+            raise RasterAlgebraException('Failed to evaluate raster algebra.')
+        xoffset = (x - xmin) * WEB_MERCATOR_TILESIZE
+        block[:, xoffset:xoffset + WEB_MERCATOR_TILESIZE] = data.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)
+
+    target.data(
+        data=numpy.ascontiguousarray(block[rows, offset[0]:offset[0] + target.width]),
+        size=(target.width, rows.stop - rows.start),
+        offset=(0, top + rows.start),
+    )
+
+
+def evaluate_rows(ids, formula, zoom, xmin, xmax, ymin, ymax, halo=0, dtype=ALGEBRA_PIXEL_TYPE_NUMPY,
+                  nodata_value=None):
+    """
+    Generate the evaluations of the rows of tiles in the tile range, as the y
+    index of the row and a list of the x indices and evaluation futures of
+    its tiles. The next rows are read and submitted to the evaluation pool
+    before a row is returned.
+    """
+    workers = getattr(settings, 'RASTER_EXPORT_WORKERS', None) or os.cpu_count() or 1
+
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for yindex, y in enumerate(range(ymin, ymax + 1)):
+                # Submit the evaluation of the tiles in the row
+                evaluations = [
+                    (x, pool.submit(evaluate_tile, data, formula, halo, dtype, nodata_value))
+                    for x, data in fetch_row(ids, zoom, y, xmin, xmax, halo)
+                ]
+                pending.append((yindex, evaluations))
+                # Return the oldest row while the next rows are read and evaluated
+                if len(pending) > EXPORT_PREFETCH_ROWS:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        except:
+            # Drop the evaluations that have not started yet
+            for yindex, evaluations in pending:
+                for x, evaluation in evaluations:
+                    evaluation.cancel()
+            raise
+
+
+def write_algebra(target, ids, formula, zoom, xmin, xmax, ymin, ymax, halo=0, offset=(0, 0),
+                  dtype=ALGEBRA_PIXEL_TYPE_NUMPY, nodata_value=None):
+    """
+    Evaluate the formula on the tile range and write the results into the
+    target band, which covers the tile range starting at the pixel offset.
+    Generates the number of processed tiles after every row of tiles. The
+    results are written in the dtype and with the nodata value of the target.
+    """
+    rows = evaluate_rows(ids, formula, zoom, xmin, xmax, ymin, ymax, halo, dtype, nodata_value)
+    for yindex, evaluations in rows:
+        write_row(target, yindex, xmin, evaluations, offset, dtype, nodata_value)
+        yield (yindex + 1) * (xmax - xmin + 1)
+
+
+def export_algebra(target, ids, formula, zoom, xmin, xmax, ymin, ymax, halo=0, progress=None, offset=(0, 0),
+                   dtype=ALGEBRA_PIXEL_TYPE_NUMPY, nodata_value=None):
+    """
+    Write the algebra results of the tile range into the target band. The
+    optional progress callback is called with the number of processed tiles
+    after every row of tiles, exceptions raised by it abort the export.
+    """
+    tiles = write_algebra(target, ids, formula, zoom, xmin, xmax, ymin, ymax, halo, offset, dtype, nodata_value)
+    for tiles_done in tiles:
+        if progress:
+            progress(tiles_done)
+
+
+def write_overviews(raster, ids, formula, zoom, xmin, xmax, ymin, ymax, halo=0, progress=None,
+                    dtype=ALGEBRA_PIXEL_TYPE_NUMPY, nodata_value=None):
+    """
+    Add overviews to an export raster and fill them with the algebra results
+    of the tiles of the lower zoom levels, such that the overviews use the
+    tile pyramid instead of resampling the raster.
+    """
+    factors = overview_factors(raster.width, raster.height, zoom)
+    for level, band in enumerate(add_overviews(raster, factors), start=1):
+        # The tiles of the lower zoom level cover the raster with an offset
+        # where the tile range does not start at a tile of that level.
+        factor = 2 ** level
+        offset = (
+            xmin % factor * WEB_MERCATOR_TILESIZE // factor,
+            ymin % factor * WEB_MERCATOR_TILESIZE // factor,
+        )
+        export_algebra(
+            band, ids, formula, zoom - level, xmin // factor, xmax // factor, ymin // factor, ymax // factor,
+            halo, progress, offset, dtype, nodata_value,
+        )
+
+
+def construct_raster(name, z, xmin, xmax, ymin, ymax, datatype=ALGEBRA_PIXEL_TYPE_GDAL, nodata_value=None):
+    """
+    Create an empty tif raster file on disk using the input tile range. The
+    new raster aligns with the xyz tile scheme and can be filled
+    sequentially with raster algebra results of the GDAL datatype. The band
+    is filled with the nodata value.
+    """
+    # Compute bounds and scale to construct raster.
+    bounds = []
+    for x in range(xmin, xmax + 1):
+        for y in range(ymin, ymax + 1):
+            bounds.append(tile_bounds(x, y, z))
+    bounds = [
+        min([bnd[0] for bnd in bounds]),
+        min([bnd[1] for bnd in bounds]),
+        max([bnd[2] for bnd in bounds]),
+        max([bnd[3] for bnd in bounds]),
+    ]
+    scale = tile_scale(z)
+    # Instantiate raster using the file path.
+    return GDALRaster({
+        'srid': WEB_MERCATOR_SRID,
+        'width': (xmax - xmin + 1) * WEB_MERCATOR_TILESIZE,
+        'height': (ymax - ymin + 1) * WEB_MERCATOR_TILESIZE,
+        'scale': (scale, -scale),
+        'origin': (bounds[0], bounds[3]),
+        'driver': 'tif',
+        'bands': [{'nodata_value': nodata_value} if nodata_value is not None else {'data': [0]}],
+        'name': name,
+        'datatype': datatype,
+    })
+
+
+def archive_names(parameters):
+    """
+    Returns the filename base with a datetime stamp and the readme text of
+    an export.
+    """
+    now = datetime.now()
+    filename_base = '{0}_{1}'.format(parameters['filename'], now.strftime('%Y_%m_%d_%H_%M'))
+    readme = README_TEMPLATE.format(datetime=now.strftime('%Y-%m-%d at %H:%M'), **parameters['readme'])
+    return filename_base, readme
+
+
+def stream_archive(parameters, filename_base, readme, progress=None):
+    """
+    Generate the zip archive of an export in chunks of bytes. The readme and
+    the colormap are written first, the raster is written into the archive
+    while its rows of tiles are evaluated. The archive is never held in
+    memory or on disk as a whole.
+    """
+    formula = parameters['formula']
+    zoom, xmin, ymin, xmax, ymax = parameters['tile_range']
+    halo = RasterAlgebraParser().get_halo(formula)
+    datatype, dtype, nodata_value = export_datatype(parameters['ids'], formula)
+    bounds = tile_bounds(xmin, ymin, zoom)
+    scale = tile_scale(zoom)
+
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        # Write README.txt and COLORMAP.txt files to zip file
+        archive.writestr('README.txt', readme)
+        archive.writestr('COLORMAP.txt', parameters['colormap'])
+        yield buffer.take()
+        # Write the raster into the archive row by row
+        info = zipfile.ZipInfo(filename_base + '.tif', date_time=datetime.now().timetuple()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(info, 'w', force_zip64=True) as entry:
+            tiff = StreamingGeoTIFF(
+                entry,
+                width=(xmax - xmin + 1) * WEB_MERCATOR_TILESIZE,
+                height=(ymax - ymin + 1) * WEB_MERCATOR_TILESIZE,
+                origin=(bounds[0], bounds[3]),
+                scale=(scale, -scale),
+                dtype=dtype,
+                nodata_value=nodata_value,
+            )
+            tiles = write_algebra(
+                tiff, parameters['ids'], formula, zoom, xmin, xmax, ymin, ymax, halo,
+                dtype=dtype, nodata_value=nodata_value,
+            )
+            for tiles_done in tiles:
+                if progress:
+                    progress(tiles_done)
+                yield buffer.take()
+            tiff.close()
+    yield buffer.take()
+
+
+def create_archive(export):
+    """
+    Evaluate the raster algebra of an export job and store the zip archive
+    with the resulting raster, the readme and the colormap on the job. In the
+    cloud optimized GeoTIFF format, the raster is stored without archive. The
+    number of processed tiles is updated after every row of tiles, the
+    export is aborted if the job is no longer running.
+    """
+    parameters = json.loads(export.parameters)
+    formula = parameters['formula']
+    zoom, xmin, ymin, xmax, ymax = parameters['tile_range']
+    halo = RasterAlgebraParser().get_halo(formula)
+    filename_base, readme = archive_names(parameters)
+
+    def progress(tiles_done):
+        # Updating the running job fails if it was cancelled
+        if not RasterExport.objects.filter(id=export.id, status=RasterExport.RUNNING).update(tiles_done=tiles_done):
+            raise RasterExportCancelled('Raster export was cancelled.')
+
+    def store(path, filename):
+        # Store the export file on the export
+        export.filename = filename
+        with open(path, 'rb') as archive:
+            export.archive.save(filename, File(archive), save=False)
+
+    raster_workdir = getattr(settings, 'RASTER_WORKDIR', None)
+    if parameters.get('format') == EXPORT_FORMAT_COG:
+        with NamedTemporaryFile(dir=raster_workdir, suffix='.tif') as exportfile:
+            # Construct an empty raster with the output dimensions and write
+            # the algebra results into it.
+            datatype, dtype, nodata_value = export_datatype(parameters['ids'], formula)
+            result_raster = construct_raster(exportfile.name, zoom, xmin, xmax, ymin, ymax, datatype, nodata_value)
+            export_algebra(
+                result_raster.bands[0], parameters['ids'], formula, zoom, xmin, xmax, ymin, ymax, halo, progress,
+                dtype=dtype, nodata_value=nodata_value,
+            )
+            # Fill the overviews from the tile pyramid, checking for
+            # cancellation after every row of tiles.
+            write_overviews(
+                result_raster, parameters['ids'], formula, zoom, xmin, xmax, ymin, ymax, halo,
+                lambda tiles_done: progress(export.tiles_total), dtype, nodata_value,
+            )
+            # Store the readme in the image description of the raster
+            result_raster.metadata = {'DEFAULT': {'TIFFTAG_IMAGEDESCRIPTION': readme}}
+            # Copy the raster into a cloud optimized GeoTIFF
+            compression = getattr(settings, 'RASTER_EXPORT_COMPRESSION', EXPORT_COMPRESSION)
+            with NamedTemporaryFile(dir=raster_workdir, suffix='.tif') as dest:
+                write_cog(result_raster, dest.name, compression)
+                store(dest.name, filename_base + '.tif')
+    else:
+        # Write the zip archive while the raster is evaluated
+        with NamedTemporaryFile(dir=raster_workdir, suffix='.zip') as dest:
+            for chunk in stream_archive(parameters, filename_base, readme, progress):
+                dest.write(chunk)
+            dest.flush()
+            store(dest.name, filename_base + '.zip')
+
+    export.status = RasterExport.FINISHED
+    export.tiles_done = export.tiles_total
+    export.save()
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from raster.models import RasterLayer, RasterTile
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute the summary statistics of the tiles of raster layers that '
+        'were parsed before tiles were summarized.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('layers', nargs='*', type=int, help='Raster layer ids, defaults to all layers.')
+        parser.add_argument('--all', action='store_true', help='Recompute the summaries of all tiles.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of tiles updated per query.')
+
+    def handle(self, *args, **options):
+        layers = RasterLayer.objects.all().order_by('id')
+        if options['layers']:
+            layers = layers.filter(id__in=options['layers'])
+
+        for layer in layers:
+            discrete = layer.datatype in (RasterLayer.CATEGORICAL, RasterLayer.MASK)
+            tiles = RasterTile.objects.filter(rasterlayer=layer).exclude(rast=None)
+            if not options['all']:
+                tiles = tiles.filter(summary_count__isnull=True)
+
+            # Summarize the tiles in batches, without holding the layer in memory
+            count = 0
+            batch = []
+            for tile in tiles.iterator(chunk_size=options['batch_size']):
+                tile.summarize(discrete)
+                batch.append(tile)
+                if len(batch) == options['batch_size']:
+                    RasterTile.objects.bulk_update(batch, RasterTile.SUMMARY_FIELDS)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                RasterTile.objects.bulk_update(batch, RasterTile.SUMMARY_FIELDS)
+                count += len(batch)
+
+            self.stdout.write('Summarized {0} tiles of raster layer {1}.'.format(count, layer.id))
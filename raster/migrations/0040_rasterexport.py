@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0039_auto_20190313_0728'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RasterExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=64)),
+                ('parameters', models.TextField()),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Running'), (2, 'Finished'), (3, 'Failed'), (4, 'Cancelled')], default=0)),
+                ('tiles_done', models.PositiveIntegerField(default=0)),
+                ('tiles_total', models.PositiveIntegerField(default=0)),
+                ('log', models.TextField(default='', editable=False)),
+                ('archive', models.FileField(blank=True, null=True, upload_to='rasters/exports')),
+                ('filename', models.CharField(blank=True, default='', max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
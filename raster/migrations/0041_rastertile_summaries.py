@@ -0,0 +1,42 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0040_rasterexport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rastertile',
+            name='summary_count',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), editable=False, null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='rastertile',
+            name='summary_max',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(null=True), editable=False, null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='rastertile',
+            name='summary_min',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(null=True), editable=False, null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='rastertile',
+            name='summary_sum',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), editable=False, null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='rastertile',
+            name='summary_sum_squares',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), editable=False, null=True, size=None),
+        ),
+        migrations.AddField(
+            model_name='rastertile',
+            name='summary_value_counts',
+            field=django.contrib.postgres.fields.ArrayField(base_field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=3), editable=False, null=True, size=None),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0042_rasteraggregation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rastertile',
+            index=models.Index(fields=['rasterlayer', 'tilez', 'tilex', 'tiley'], name='rastertile_layer_zxy_idx'),
+        ),
+    ]
@@ -1,26 +1,15 @@
 from django.contrib.gis.geos import GEOSGeometry
 from django.db import connection
+from raster.dbaggregation import TileQuery
 from raster.tiles.const import WEB_MERCATOR_SRID
-
-CLIPPED_VALUE_COUNT_SQL = """
-WITH tiles_for_agg AS (
-    SELECT ST_ValueCount(ST_Clip(ST_Transform(rast, {geom_srid}), ST_GeomFromEWKT('{geom_ewkt}'))) AS vcresult
-    FROM raster_rastertile
-    WHERE ST_Intersects(rast, ST_Transform(ST_GeomFromEWKT('{geom_ewkt}'), {rast_srid}))
-    AND rasterlayer_id = {rasterlayer_id}
-    AND tilez = {zoom}
-)
-SELECT (vcresult).value, SUM((vcresult).count) AS count
-FROM tiles_for_agg
-GROUP BY (vcresult).value
-"""
+from raster.tiles.utils import boundary_tiles, tile_index_range, tile_scale
 
 GLOBAL_VALUE_COUNT_SQL = """
 WITH tiles_for_agg AS (
     SELECT ST_ValueCount(rast) AS vcresult
     FROM raster_rastertile
-    WHERE rasterlayer_id = {rasterlayer_id}
-    AND tilez = {zoom}
+    WHERE rasterlayer_id = %(rasterlayer_id)s
+    AND tilez = %(zoom)s
 )
 SELECT (vcresult).value, SUM((vcresult).count) AS count
 FROM tiles_for_agg
@@ -29,18 +18,18 @@ GROUP BY (vcresult).value
 
 MINSIZE_SQL = """
 SELECT
-    ST_ScaleX(ST_Transform(rast, {srid})) AS scalex,
-    ST_ScaleY(ST_Transform(rast, {srid})) AS scaley
+    ST_ScaleX(ST_Transform(rast, %(srid)s)) AS scalex,
+    ST_ScaleY(ST_Transform(rast, %(srid)s)) AS scaley
 FROM raster_rastertile
-WHERE rasterlayer_id = {rasterlayer_id}
-AND tilez = {zoom}
+WHERE rasterlayer_id = %(rasterlayer_id)s
+AND tilez = %(zoom)s
 LIMIT 1
 """
 
 MAX_ZOOM_SQL = """
 SELECT MAX(tilez)
 FROM raster_rastertile
-WHERE rasterlayer_id={rasterlayer_id}
+WHERE rasterlayer_id = %(rasterlayer_id)s
 """
 
 
@@ -50,7 +39,9 @@ class ValueCountMixin(object):
     """
     def db_value_count(self, geom=None, area=False, zoom=None):
         """
-        Compute value count in database.
+        Compute value count in database. The pixels are counted in the Web
+        Mercator projection of the tiles, areas are given in square meters of
+        that projection, regardless of the projection of the geometry.
         """
         if not zoom:
             zoom = self._max_zoom
@@ -66,28 +57,32 @@ class ValueCountMixin(object):
             # Make sure geometry is GEOS Geom
             geom = GEOSGeometry(geom)
 
-            sql = CLIPPED_VALUE_COUNT_SQL.format(
-                geom_ewkt=geom.ewkt,
-                geom_srid=geom.srid,
-                rast_srid=WEB_MERCATOR_SRID,
-                rasterlayer_id=self.id,
-                zoom=zoom
-            )
+            # Transform the geometry into the projection of the tiles, such
+            # that the tiles do not have to be transformed.
+            geom = geom.transform(WEB_MERCATOR_SRID, clone=True)
+
+            # Limit the tile range to the overlap of the geometry with the layer
+            gxmin, gymin, gxmax, gymax = geom.extent
+            lxmin, lymin, lxmax, lymax = self.extent()
+            bbox = (max(gxmin, lxmin), max(gymin, lymin), min(gxmax, lxmax), min(gymax, lymax))
+            if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                return {}
+            tilerange = tile_index_range(bbox, zoom)
+
+            # Only clip the tiles on the boundary of the geometry
+            clip = boundary_tiles(geom, tilerange, zoom)
+            values, counts = TileQuery(self.id, 0, zoom, tilerange, geom, clip).value_counts()
+            rows = list(zip(values, counts))
         else:
-            sql = GLOBAL_VALUE_COUNT_SQL.format(
-                rasterlayer_id=self.id,
-                zoom=zoom
-            )
-
-        cursor = connection.cursor()
-        cursor.execute(sql)
+            cursor = connection.cursor()
+            cursor.execute(GLOBAL_VALUE_COUNT_SQL, {'rasterlayer_id': self.id, 'zoom': zoom})
+            rows = cursor.fetchall()
 
-        # Convert value count to areas if requested
+        # Convert value count to areas of the tile pixels if requested
         if area:
-            scalex, scaley = self._min_pixelsize(geom.srid)
-            return {int(row[0]): int(row[1]) * scalex * scaley for row in cursor.fetchall()}
+            return {int(row[0]): int(row[1]) * tile_scale(zoom) ** 2 for row in rows}
         else:
-            return {int(row[0]): int(row[1]) for row in cursor.fetchall()}
+            return {int(row[0]): int(row[1]) for row in rows}
 
     _maxz = None
 
@@ -98,7 +93,7 @@ class ValueCountMixin(object):
         """
         if not self._maxz:
             cursor = connection.cursor()
-            cursor.execute(MAX_ZOOM_SQL.format(rasterlayer_id=self.id))
+            cursor.execute(MAX_ZOOM_SQL, {'rasterlayer_id': self.id})
             self._maxz = cursor.fetchone()[0]
         return self._maxz
 
@@ -109,14 +104,8 @@ class ValueCountMixin(object):
         if not zoom:
             zoom = self._max_zoom
 
-        sql = MINSIZE_SQL.format(
-            srid=srid,
-            rasterlayer_id=self.id,
-            zoom=zoom
-        )
-
         cursor = connection.cursor()
-        cursor.execute(sql)
+        cursor.execute(MINSIZE_SQL, {'srid': srid, 'rasterlayer_id': self.id, 'zoom': zoom})
         res = cursor.fetchone()
         self._minsize = (abs(res[0]), abs(res[1]))
         self._minsize_srid = srid
@@ -11,6 +11,7 @@ from django.contrib.postgres.fields import ArrayField
 from django.db.models import Max, Min
 from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
+from raster.colormaps import colormap_registry
 from raster.mixins import ValueCountMixin
 from raster.tiles.const import WEB_MERCATOR_SRID
 from raster.utils import hex_to_rgba
@@ -89,6 +90,7 @@ def legend_entries_changed(sender, instance, **kwargs):
     """
     Updates style json upon adding or removing legend entries.
     """
+    colormap_registry.clear()
     try:
         instance.legend.update_json()
         instance.legend.save()
@@ -101,12 +103,22 @@ def update_dependent_legends_on_semantics_change(sender, instance, **kwargs):
     """
     Updates dependent Legends on a change in Semantics.
     """
+    colormap_registry.clear()
     legend_ids = LegendEntry.objects.filter(semantics_id=instance.id).values_list('legend_id', flat=True)
     for legend in Legend.objects.filter(id__in=legend_ids):
         legend.update_json()
         legend.save()
 
 
+@receiver(post_save, sender=Legend)
+@receiver(post_delete, sender=Legend)
+def clear_colormap_registry_on_legend_change(sender, instance, **kwargs):
+    """
+    Drops cached colormaps when a legend is changed or deleted.
+    """
+    colormap_registry.clear()
+
+
 class RasterLayer(models.Model, ValueCountMixin):
     """
     Source data model for raster layers
@@ -241,6 +253,15 @@ def parse_raster_layer_if_status_is_unparsed(sender, instance, created, **kwargs
         parse(instance.id)
 
 
+@receiver(post_save, sender=RasterLayer)
+@receiver(post_delete, sender=RasterLayer)
+def clear_colormap_registry_on_layer_change(sender, instance, **kwargs):
+    """
+    Drops cached colormaps, the legend of the layer might have changed.
+    """
+    colormap_registry.clear()
+
+
 class RasterLayerReprojected(models.Model):
     """
     Stores reprojected version of raster.
@@ -348,6 +369,14 @@ class RasterLayerBandMetadata(models.Model):
         return (self.min, self.max, self.mean, self.std)
 
 
+@receiver(post_save, sender=RasterLayerBandMetadata)
+def clear_colormap_registry_on_band_metadata_change(sender, instance, **kwargs):
+    """
+    Drops cached colormaps, continuous colormap ranges depend on band metadata.
+    """
+    colormap_registry.clear()
+
+
 class RasterTile(models.Model):
     """
     Store individual tiles of a raster data source layer.
@@ -357,6 +386,10 @@ class RasterTile(models.Model):
         (8, 8), (9, 9), (10, 10), (11, 11), (12, 12), (13, 13),
         (14, 14), (15, 15), (16, 16), (17, 17), (18, 18)
     )
+    SUMMARY_FIELDS = (
+        'summary_count', 'summary_sum', 'summary_sum_squares', 'summary_min', 'summary_max', 'summary_value_counts',
+    )
+
     rid = models.AutoField(primary_key=True)
     rast = models.RasterField(null=True, blank=True, srid=WEB_MERCATOR_SRID)
     rasterlayer = models.ForeignKey(RasterLayer, null=True, blank=True, db_index=True, on_delete=models.CASCADE)
@@ -364,5 +397,132 @@ class RasterTile(models.Model):
     tiley = models.IntegerField(db_index=True, null=True)
     tilez = models.IntegerField(db_index=True, null=True, choices=ZOOMLEVELS)
 
+    # Summary statistics of the valid pixels of each band of the tile
+    summary_count = ArrayField(models.BigIntegerField(), null=True, editable=False)
+    summary_sum = ArrayField(models.FloatField(), null=True, editable=False)
+    summary_sum_squares = ArrayField(models.FloatField(), null=True, editable=False)
+    summary_min = ArrayField(models.FloatField(null=True), null=True, editable=False)
+    summary_max = ArrayField(models.FloatField(null=True), null=True, editable=False)
+    # Value counts of tiles of discrete layers as band, value and count rows
+    summary_value_counts = ArrayField(ArrayField(models.FloatField(), size=3), null=True, editable=False)
+
+    class Meta:
+        # Tile index ranges of a layer at a zoom level are selected together
+        indexes = [
+            models.Index(fields=['rasterlayer', 'tilez', 'tilex', 'tiley'], name='rastertile_layer_zxy_idx'),
+        ]
+
     def __str__(self):
         return '{} {}'.format(self.rid, self.rasterlayer.name)
+
+    def save(self, *args, discrete=None, **kwargs):
+        """
+        Save the tile and update the summaries of the tile data. The discrete
+        flag of the layer is passed by the caller. Tiles that already have
+        summaries keep their kind of summary by default, tiles without
+        summaries are not summarized unless the flag is passed.
+        """
+        if discrete is None and self.summary_count is not None:
+            discrete = self.summary_value_counts is not None
+        update_fields = kwargs.get('update_fields')
+        if self.rast is not None and discrete is not None and (update_fields is None or 'rast' in update_fields):
+            self.summarize(discrete)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields).union(self.SUMMARY_FIELDS)
+        super(RasterTile, self).save(*args, **kwargs)
+
+    def summarize(self, discrete=False):
+        """
+        Compute the summary statistics of the bands of the tile raster, which
+        answer aggregations over entire tiles without reading the raster. The
+        valid pixels are the pixels that differ from the nodata value.
+        """
+        self.summary_count = []
+        self.summary_sum = []
+        self.summary_sum_squares = []
+        self.summary_min = []
+        self.summary_max = []
+        self.summary_value_counts = [] if discrete else None
+
+        for index, band in enumerate(self.rast.bands):
+            data = band.data().ravel().astype('float64')
+            nodata = band.nodata_value
+            if nodata is not None:
+                data = data[numpy.logical_not(numpy.isnan(data)) if numpy.isnan(nodata) else data != nodata]
+
+            self.summary_count.append(data.size)
+            self.summary_sum.append(float(numpy.sum(data)))
+            self.summary_sum_squares.append(float(numpy.sum(numpy.square(data))))
+            self.summary_min.append(float(numpy.min(data)) if data.size else None)
+            self.summary_max.append(float(numpy.max(data)) if data.size else None)
+
+            if discrete:
+                values, counts = numpy.unique(data, return_counts=True)
+                self.summary_value_counts.extend([index, value, count] for value, count in zip(values.tolist(), counts.tolist()))
+
+
+class RasterExport(models.Model):
+    """
+    Tracks an asynchronous raster algebra export and stores the resulting
+    archive. Exports with identical parameters have the same key, such that
+    finished archives can be reused.
+    """
+    PENDING = 0
+    RUNNING = 1
+    FINISHED = 2
+    FAILED = 3
+    CANCELLED = 4
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FINISHED, 'Finished'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+    key = models.CharField(max_length=64, db_index=True)
+    parameters = models.TextField()
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    tiles_done = models.PositiveIntegerField(default=0)
+    tiles_total = models.PositiveIntegerField(default=0)
+    log = models.TextField(default='', editable=False)
+    archive = models.FileField(upload_to='rasters/exports', null=True, blank=True)
+    filename = models.CharField(max_length=200, blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.id, self.get_status_display())
+
+
+class RasterAggregation(models.Model):
+    """
+    Tracks an asynchronous raster algebra aggregation and stores its result.
+    Aggregations with identical parameters have the same key, such that
+    finished results can be reused.
+    """
+    PENDING = 0
+    RUNNING = 1
+    FINISHED = 2
+    FAILED = 3
+    CANCELLED = 4
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FINISHED, 'Finished'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+    key = models.CharField(max_length=64, db_index=True)
+    parameters = models.TextField()
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    tiles_done = models.PositiveIntegerField(default=0)
+    tiles_total = models.PositiveIntegerField(default=0)
+    log = models.TextField(default='', editable=False)
+    result = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.id, self.get_status_display())
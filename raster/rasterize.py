@@ -15,12 +15,19 @@ rasterize_geometries = voidptr_output(std_call('GDALRasterizeGeometries'),
 )
 
 
-def rasterize(geom, rast, burn_value=1, all_touched=False, add=False):
+def rasterize(geom, rast, burn_value=1, all_touched=False, add=False, datatype=None):
     """
     Rasterize a geometry. The result is aligned with the input raster.
+
+    A list of geometries is rasterized in a single pass, with a list of burn
+    values for the geometries or the same burn value for all of them. The
+    datatype of the result defaults to the datatype of the input raster.
     """
     # Create in memory target raster
-    rasterized = rast.warp({'name': 'rasterized.MEM', 'driver': 'MEM'})
+    target = {'name': 'rasterized.MEM', 'driver': 'MEM'}
+    if datatype is not None:
+        target['datatype'] = datatype
+    rasterized = rast.warp(target)
 
     # Set all values to zero if add option is off.
     if not add:
@@ -29,18 +36,21 @@ def rasterize(geom, rast, burn_value=1, all_touched=False, add=False):
     # Set zero as nodata
     rasterized.bands[0].nodata_value = 0
 
-    # Make sure geom is an OGR geometry
-    if not isinstance(geom, OGRGeometry):
-        geom = OGRGeometry(geom.ewkt)
-    geom.transform(rast.srs)
+    geoms = geom if isinstance(geom, (list, tuple)) else [geom]
+    burn_values = burn_value if isinstance(burn_value, (list, tuple)) else [burn_value] * len(geoms)
+
+    # Make sure the geoms are OGR geometries
+    geoms = [geom if isinstance(geom, OGRGeometry) else OGRGeometry(geom.ewkt) for geom in geoms]
+    for geom in geoms:
+        geom.transform(rast.srs)
 
     # Set rasterization parameters
     nr_of_bands_to_rasterize = 1
     band_indices_to_rasterize = (c_int * 1)(1)
 
-    nr_of_geometries = 1
-    burn_value = (c_double * 1)(burn_value)
-    geometry_list = (c_void_p * 1)(geom.ptr)
+    nr_of_geometries = len(geoms)
+    burn_value = (c_double * nr_of_geometries)(*burn_values)
+    geometry_list = (c_void_p * nr_of_geometries)(*(geom.ptr for geom in geoms))
 
     # Setup papsz options
     papsz_options = []
@@ -51,7 +61,7 @@ def rasterize(geom, rast, burn_value=1, all_touched=False, add=False):
 
     papsz_options = (c_char_p * len(papsz_options))(*papsz_options)
 
-    # Rasterize this geometry
+    # Rasterize the geometries
     rasterize_geometries(
         rasterized.ptr,
         nr_of_bands_to_rasterize,
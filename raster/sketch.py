@@ -0,0 +1,107 @@
+"""
+Mergeable quantile sketches.
+
+A quantile sketch summarizes a distribution of values by a bounded number of
+weighted centroids, following the merging t-digest. The centroids are small
+near the tails of the distribution and large in its center, such that the
+extreme quantiles are estimated precisely. Sketches of parts of the values
+can be merged in any grouping, the memory required does not depend on the
+number of values.
+"""
+import numpy
+
+from raster.const import QUANTILE_SKETCH_COMPRESSION
+
+
+class QuantileSketch(object):
+    """
+    Approximate the quantiles of a distribution of values.
+    """
+
+    def __init__(self, compression=QUANTILE_SKETCH_COMPRESSION):
+        self.compression = compression
+        self.means = numpy.array([], dtype='float64')
+        self.weights = numpy.array([], dtype='float64')
+        self.min_value = None
+        self.max_value = None
+
+    @property
+    def count(self):
+        return int(numpy.sum(self.weights))
+
+    def push(self, data):
+        """
+        Add the values of an array to the sketch.
+        """
+        data = numpy.asarray(data, dtype='float64').ravel()
+        if not data.size:
+            return
+        self._add(data, numpy.ones(data.size), data.min(), data.max())
+
+    def merge(self, other):
+        """
+        Merge the values of another sketch into this sketch.
+        """
+        if other.weights.size:
+            self._add(other.means, other.weights, other.min_value, other.max_value)
+        return self
+
+    def _add(self, means, weights, min_value, max_value):
+        self.min_value = min_value if self.min_value is None else min(self.min_value, min_value)
+        self.max_value = max_value if self.max_value is None else max(self.max_value, max_value)
+        self._compress(numpy.concatenate([self.means, means]), numpy.concatenate([self.weights, weights]))
+
+    def _compress(self, means, weights):
+        """
+        Combine the centroids into clusters whose size is limited by the scale
+        function of the t-digest on their quantile.
+        """
+        order = numpy.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+
+        # Assign the centroids to clusters by the scaled quantile of their centers
+        cumulative = numpy.cumsum(weights)
+        centers = (cumulative - weights / 2) / cumulative[-1]
+        scaled = self.compression / (2 * numpy.pi) * numpy.arcsin(2 * centers - 1)
+        clusters = numpy.floor(scaled - scaled[0]).astype('int64')
+
+        # Compute the weighted means of the clusters
+        weights_sum = numpy.bincount(clusters, weights=weights)
+        means_sum = numpy.bincount(clusters, weights=means * weights)
+        nonempty = weights_sum > 0
+        self.weights = weights_sum[nonempty]
+        self.means = means_sum[nonempty] / self.weights
+
+    def quantiles(self, fractions):
+        """
+        Return the estimated values at the quantile fractions, between 0 and
+        1. Returns None for every fraction if the sketch is empty.
+        """
+        if not self.weights.size:
+            return [None for fraction in fractions]
+
+        # Interpolate between the centers of the centroids and the extremes
+        cumulative = numpy.cumsum(self.weights)
+        total = cumulative[-1]
+        positions = numpy.concatenate([[0], cumulative - self.weights / 2, [total]])
+        values = numpy.concatenate([[self.min_value], self.means, [self.max_value]])
+        return numpy.interp(numpy.asarray(fractions) * total, positions, values).tolist()
+
+    def serialize(self):
+        return {
+            'compression': self.compression,
+            'means': self.means.tolist(),
+            'weights': self.weights.tolist(),
+            'min': None if self.min_value is None else float(self.min_value),
+            'max': None if self.max_value is None else float(self.max_value),
+        }
+
+    @classmethod
+    def deserialize(cls, data):
+        sketch = cls(data['compression'])
+        sketch.means = numpy.array(data['means'], dtype='float64')
+        sketch.weights = numpy.array(data['weights'], dtype='float64')
+        sketch.min_value = data['min']
+        sketch.max_value = data['max']
+        return sketch
@@ -0,0 +1,186 @@
+"""
+Sequential writers for streamed exports.
+
+Streamed exports are written into file objects that can not seek, such as
+zip archive entries in http responses. The GeoTIFF writer therefore writes
+the raster data uncompressed in the order of the rows, and places the image
+file directory after the data, where the final nodata value and the skipped
+strips are known.
+"""
+import struct
+
+import numpy
+
+from raster.algebra.const import ALGEBRA_PIXEL_TYPE_NUMPY
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+
+# TIFF field types
+ASCII = 2
+SHORT = 3
+LONG = 4
+DOUBLE = 12
+LONG8 = 16
+
+FIELD_FORMATS = {ASCII: 's', SHORT: 'H', LONG: 'I', DOUBLE: 'd', LONG8: 'Q'}
+
+# TIFF sample formats by numpy dtype kind
+SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+
+# Files with more data than this are written as BigTIFF
+TIFF_MAX_DATA_SIZE = 2 ** 32 - 2 ** 20
+
+
+class StreamBuffer(object):
+    """
+    A write only file object that collects the written bytes until they are
+    taken out.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class StreamingGeoTIFF(object):
+    """
+    Write a single band GeoTIFF into a file object sequentially.
+
+    The writer is used like a GDALBand, but the data has to be written in
+    complete rows from top to bottom. Strips of rows that are skipped are
+    stored as sparse strips, which are read as nodata. The nodata value can be
+    set until the writer is closed.
+    """
+
+    def __init__(self, fileobj, width, height, origin, scale, srid=WEB_MERCATOR_SRID,
+                 dtype=ALGEBRA_PIXEL_TYPE_NUMPY, rows_per_strip=WEB_MERCATOR_TILESIZE, nodata_value=None):
+        self.fileobj = fileobj
+        self.width = width
+        self.height = height
+        self.origin = origin
+        self.scale = scale
+        self.srid = srid
+        self.dtype = numpy.dtype(dtype).newbyteorder('<')
+        self.rows_per_strip = rows_per_strip
+        self.nodata_value = nodata_value
+        self.row = 0
+        self.sparse = set()
+
+        self.row_size = self.width * self.dtype.itemsize
+        self.bigtiff = self.row_size * self.height > TIFF_MAX_DATA_SIZE
+
+        # Write the header, the image file directory follows the data
+        if self.bigtiff:
+            self.data_offset = 16
+            header = struct.pack('<2sHHHQ', b'II', 43, 8, 0, self.data_offset + self.row_size * self.height)
+        else:
+            self.data_offset = 8
+            header = struct.pack('<2sHI', b'II', 42, self.data_offset + self.row_size * self.height)
+        self.fileobj.write(header)
+
+    def data(self, data, size, offset=(0, 0)):
+        """
+        Write complete rows of data, starting at the row of the offset.
+        """
+        if offset[0] != 0 or size[0] != self.width or offset[1] < self.row or offset[1] + size[1] > self.height:
+            raise ValueError('Rows have to be written completely and sequentially.')
+        self.fill(offset[1])
+        self.fileobj.write(numpy.asarray(data, dtype=self.dtype).tobytes())
+        self.row = offset[1] + size[1]
+
+    def fill(self, row):
+        """
+        Fill the rows up to the given row with zeros. Strips that are filled
+        completely are marked as sparse, such that they are read as nodata.
+        """
+        while self.row < row:
+            rows = min(row - self.row, self.rows_per_strip - self.row % self.rows_per_strip)
+            if rows == min(self.rows_per_strip, self.height - self.row):
+                self.sparse.add(self.row // self.rows_per_strip)
+            self.fileobj.write(bytes(rows * self.row_size))
+            self.row += rows
+
+    def fields(self):
+        """
+        Returns the TIFF fields of the raster as tag, type and values tuples
+        in ascending tag order.
+        """
+        strips = range(0, self.height, self.rows_per_strip)
+        offsets = [self.data_offset + row * self.row_size for row in strips]
+        counts = [min(self.rows_per_strip, self.height - row) * self.row_size for row in strips]
+        # Sparse strips have no offset and size
+        for strip in self.sparse:
+            offsets[strip] = counts[strip] = 0
+        offset_type = LONG8 if self.bigtiff else LONG
+        geokeys = [
+            1, 1, 0, 4,
+            1024, 0, 1, 1,  # Projected model type
+            1025, 0, 1, 1,  # Pixel is area
+            3072, 0, 1, self.srid,  # Projected coordinate system
+            3076, 0, 1, 9001,  # Linear unit meter
+        ]
+        fields = [
+            (256, LONG, [self.width]),
+            (257, LONG, [self.height]),
+            (258, SHORT, [self.dtype.itemsize * 8]),
+            (259, SHORT, [1]),
+            (262, SHORT, [1]),
+            (273, offset_type, offsets),
+            (277, SHORT, [1]),
+            (278, LONG, [self.rows_per_strip]),
+            (279, offset_type, counts),
+            (284, SHORT, [1]),
+            (339, SHORT, [SAMPLE_FORMATS[self.dtype.kind]]),
+            (33550, DOUBLE, [abs(self.scale[0]), abs(self.scale[1]), 0]),
+            (33922, DOUBLE, [0, 0, 0, self.origin[0], self.origin[1], 0]),
+            (34735, SHORT, geokeys),
+        ]
+        if self.nodata_value is not None:
+            fields.append((42113, ASCII, repr(float(self.nodata_value)).encode() + b'\0'))
+        return fields
+
+    def close(self):
+        """
+        Fill the remaining rows and write the image file directory.
+        """
+        self.fill(self.height)
+
+        if self.bigtiff:
+            count_format, entry_format, value_size = '<Q', '<HHQ', 8
+        else:
+            count_format, entry_format, value_size = '<H', '<HHI', 4
+
+        fields = self.fields()
+        ifd_offset = self.data_offset + self.row_size * self.height
+        entry_size = struct.calcsize(entry_format) + value_size
+        extra_offset = ifd_offset + struct.calcsize(count_format) + len(fields) * entry_size + value_size
+
+        entries = struct.pack(count_format, len(fields))
+        extra = b''
+        for tag, field_type, values in fields:
+            if field_type == ASCII:
+                value = values
+            else:
+                value = struct.pack('<{0}{1}'.format(len(values), FIELD_FORMATS[field_type]), *values)
+            entries += struct.pack(entry_format, tag, field_type, len(values))
+            if len(value) <= value_size:
+                # Small values are stored in the entry
+                entries += value.ljust(value_size, b'\0')
+            else:
+                entries += struct.pack('<' + FIELD_FORMATS[LONG8 if self.bigtiff else LONG], extra_offset + len(extra))
+                # Values are aligned to words
+                extra += value + b'\0' * (len(value) % 2)
+        # Terminate the list of image file directories
+        entries += bytes(value_size)
+
+        self.fileobj.write(entries + extra)
@@ -1,9 +1,13 @@
 import shutil
 import traceback
 
-from celery import group, shared_task
+from celery import chord, group, shared_task
 
 from django.conf import settings
+from django.db.models import F
+from raster.exceptions import RasterAggregationCancelled, RasterExportCancelled
+from raster.export import create_archive
+from raster.models import RasterAggregation, RasterExport
 from raster.tiles.const import GLOBAL_MAX_ZOOM_LEVEL, MIN_ZOOMLEVEL_TASK_PARALLEL
 from raster.tiles.parser import RasterLayerParser
 
@@ -130,3 +134,121 @@ def parse(rasterlayer_id):
         all_in_one.delay(rasterlayer_id, zoom_range)
     else:
         all_in_one(rasterlayer_id, zoom_range)
+
+
+@shared_task
+def export_raster(export_id):
+    """
+    Create the archive of a raster algebra export.
+    """
+    # Start the export unless it was cancelled while waiting in the queue
+    if not RasterExport.objects.filter(id=export_id, status=RasterExport.PENDING).update(status=RasterExport.RUNNING):
+        return
+    export = RasterExport.objects.get(id=export_id)
+    try:
+        create_archive(export)
+    except RasterExportCancelled:
+        pass
+    except:
+        RasterExport.objects.filter(id=export_id).update(status=RasterExport.FAILED, log=traceback.format_exc())
+        raise
+
+
+def export(export_id):
+    """
+    Run a raster algebra export, asynchronously if celery is used.
+    """
+    if getattr(settings, 'RASTER_USE_CELERY', False):
+        export_raster.delay(export_id)
+    else:
+        export_raster(export_id)
+
+
+@shared_task
+def aggregate_tiles(parameters, formulas, tilerange, count=True, hist_ranges=None, sketch=False, aggregation_id=None):
+    """
+    Aggregate the formulas over a part of the tile range of an aggregator.
+    Returns the serialized partial results of the formulas. Parts of an
+    aggregation job are skipped if the job is no longer running, and add the
+    counted tiles to the progress of the job.
+    """
+    from raster.valuecount import Aggregator
+    running = RasterAggregation.objects.filter(id=aggregation_id, status=RasterAggregation.RUNNING)
+    if aggregation_id is not None and not running.exists():
+        return
+    aggregator = Aggregator.from_task_parameters(parameters)
+    aggregator.tilerange = tilerange
+    partials = aggregator.aggregate(formulas, count=count, hist_ranges=hist_ranges, sketch=sketch)
+    if aggregation_id is not None and count:
+        running.update(tiles_done=F('tiles_done') + aggregator.tile_count())
+    return [partial.serialize() for partial in partials]
+
+
+@shared_task
+def merge_aggregation_parts(parts, aggregation_id, count=True):
+    """
+    Merge the partial results of the parts of a raster aggregation job.
+    """
+    from raster.valuecount import merge_aggregation
+    merge_aggregation(aggregation_id, parts, count)
+
+
+@shared_task
+def aggregation_part_failed(request, exc, tb, aggregation_id):
+    """
+    Mark a raster aggregation job as failed if one of its parts failed.
+    """
+    RasterAggregation.objects.filter(id=aggregation_id, status=RasterAggregation.RUNNING).update(
+        status=RasterAggregation.FAILED,
+        log=tb or repr(exc),
+    )
+
+
+def aggregate_parts(aggregation_id, aggregator, count=True, hist_ranges=None):
+    """
+    Aggregate the parts of the tile range of a raster aggregation job in
+    parallel subtasks. The partial results of the parts are merged by a chord
+    callback that continues the job, no task waits for the subtasks.
+    """
+    parameters = aggregator.task_parameters()
+    callback = merge_aggregation_parts.s(aggregation_id, count)
+    callback.link_error(aggregation_part_failed.s(aggregation_id))
+    parts = chord(
+        aggregate_tiles.s(parameters, [aggregator.formula], tilerange, count, hist_ranges, False, aggregation_id)
+        for tilerange in aggregator.task_tileranges()
+    )
+    parts(callback)
+
+
+@shared_task
+def aggregate_raster(aggregation_id):
+    """
+    Compute the result of a raster aggregation job.
+    """
+    from raster.valuecount import run_aggregation
+
+    # Start the aggregation unless it was cancelled while waiting in the queue
+    if not RasterAggregation.objects.filter(
+            id=aggregation_id, status=RasterAggregation.PENDING).update(status=RasterAggregation.RUNNING):
+        return
+    aggregation = RasterAggregation.objects.get(id=aggregation_id)
+    try:
+        run_aggregation(aggregation)
+    except RasterAggregationCancelled:
+        pass
+    except:
+        RasterAggregation.objects.filter(id=aggregation_id).update(
+            status=RasterAggregation.FAILED,
+            log=traceback.format_exc(),
+        )
+        raise
+
+
+def aggregation(aggregation_id):
+    """
+    Run a raster aggregation job, asynchronously if celery is used.
+    """
+    if getattr(settings, 'RASTER_USE_CELERY', False):
+        aggregate_raster.delay(aggregation_id)
+    else:
+        aggregate_raster(aggregation_id)
@@ -1,4 +1,11 @@
+from itertools import groupby
+
+import numpy
+
 from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from django.db.models import F
+from raster.const import TILE_FETCH_SIZE
 from raster.models import RasterTile
 from raster.tiles.const import WEB_MERCATOR_TILESIZE
 from raster.tiles.utils import tile_bounds, tile_scale
@@ -11,21 +18,43 @@ def get_raster_tile(layer_id, tilez, tilex, tiley):
     higher level tile is found, it is warped to the requested zoom level. This
     ensures that a tile can be requested at any zoom level.
     """
+    return get_ancestor_raster_tile(layer_id, tilez, tilex, tiley, tilez)
+
+
+def get_ancestor_raster_tile(layer_id, tilez, tilex, tiley, maxzoom=None, halo=0):
+    """
+    Get the raster of a tile from the closest ancestor tile at or below the
+    maximum zoom level, warped to the requested tile. By default, the search
+    starts at the parent of the tile, for tiles that are known to be missing
+    at their zoom level.
+
+    With a halo, the tile is padded with the pixels of its neighbors. Tiles
+    that are warped from an ancestor are padded with the warped neighborhood
+    of the ancestor, such that the halo continues across ancestor borders.
+    """
+    if maxzoom is None:
+        maxzoom = tilez - 1
     # Loop through zoom levels to search for a tile
-    for zoom in range(tilez, -1, -1):
+    for zoom in range(maxzoom, -1, -1):
         # Compute multiplier to find parent raster
         multiplier = 2 ** (tilez - zoom)
+        parentx, parenty = tilex // multiplier, tiley // multiplier
         # Fetch tile
         tile = RasterTile.objects.filter(
-            tilex=tilex / multiplier,
-            tiley=tiley / multiplier,
+            tilex=parentx,
+            tiley=parenty,
             tilez=zoom,
             rasterlayer_id=layer_id,
-        )
+        ).first()
 
-        if tile.exists():
+        if tile is not None:
             # Extract raster from tile model
-            result = tile[0].rast
+            result = tile.rast
+            if halo:
+                # Pad the tile with enough pixels of its neighbors to cover
+                # the halo of the requested tile.
+                tile_halo = min(-(-halo // multiplier), result.width, result.height)
+                result = pad_tile(result, get_neighbor_tiles(layer_id, zoom, parentx, parenty), tile_halo)
             # If the tile is a parent of the original, warp it to the
             # original request tile.
             if zoom < tilez:
@@ -37,10 +66,210 @@ def get_raster_tile(layer_id, tilez, tilex, tiley):
                 # Warp parent tile to child tile in memory.
                 result = result.warp({
                     'driver': 'MEM',
-                    'width': tilesize,
-                    'height': tilesize,
+                    'width': tilesize + 2 * halo,
+                    'height': tilesize + 2 * halo,
                     'scale': [tilescale, -tilescale],
-                    'origin': [bounds[0], bounds[3]],
+                    'origin': [bounds[0] - halo * tilescale, bounds[3] + halo * tilescale],
                 })
 
             return result
+
+
+def get_neighbor_tiles(layer_id, tilez, tilex, tiley):
+    """
+    Get the rasters of the eight neighbors of a tile, as a dictionary keyed by
+    their tile index offset from the tile. The neighbors are read in a single
+    query, neighbors that do not exist are omitted.
+    """
+    neighbors = RasterTile.objects.filter(
+        rasterlayer_id=layer_id,
+        tilez=tilez,
+        tilex__gte=tilex - 1,
+        tilex__lte=tilex + 1,
+        tiley__gte=tiley - 1,
+        tiley__lte=tiley + 1,
+    ).exclude(tilex=tilex, tiley=tiley)
+
+    return {(neighbor.tilex - tilex, neighbor.tiley - tiley): neighbor.rast for neighbor in neighbors}
+
+
+def halo_slices(offset, size, halo):
+    """
+    Return the slice of a padded array that a neighboring tile at the index
+    offset covers, and the slice of the neighboring tile that it is filled
+    with, along one axis.
+    """
+    if offset < 0:
+        return slice(0, halo), slice(size - halo, size)
+    elif offset > 0:
+        return slice(halo + size, 2 * halo + size), slice(0, halo)
+    return slice(halo, halo + size), slice(0, size)
+
+
+def pad_tile(tile, neighbors, halo):
+    """
+    Add a halo of pixels to a tile raster. The neighbors are a dictionary of
+    rasters keyed by their tile index offset from the tile. Where a neighbor
+    does not exist, the halo replicates the edge values of the tile.
+    """
+    # Pad the data of every band with the edge values of the tile and copy
+    # the data of the neighbors into the halo.
+    bands = []
+    for index, band in enumerate(tile.bands):
+        data = numpy.pad(band.data(), halo, mode='edge')
+        for (offsetx, offsety), rast in neighbors.items():
+            rows, source_rows = halo_slices(offsety, tile.height, halo)
+            cols, source_cols = halo_slices(offsetx, tile.width, halo)
+            data[rows, cols] = rast.bands[index].data()[source_rows, source_cols]
+        band_input = {'data': data}
+        if band.nodata_value is not None:
+            band_input['nodata_value'] = band.nodata_value
+        bands.append(band_input)
+
+    return GDALRaster({
+        'driver': 'MEM',
+        'width': tile.width + 2 * halo,
+        'height': tile.height + 2 * halo,
+        'srid': tile.srs.srid,
+        'origin': (tile.origin.x - halo * tile.scale.x, tile.origin.y - halo * tile.scale.y),
+        'scale': (tile.scale.x, tile.scale.y),
+        'skew': (tile.skew.x, tile.skew.y),
+        'datatype': tile.bands[0].datatype(),
+        'bands': bands,
+    })
+
+
+def get_raster_tile_with_halo(layer_id, tilez, tilex, tiley, halo):
+    """
+    Get the raster from a tile with a halo of pixels from the neighboring
+    tiles, as required by neighborhood functions in raster algebra. The eight
+    neighboring tiles are read in a single query. Tiles that are missing at
+    the requested zoom level are warped from the neighborhood of an ancestor.
+    """
+    return get_ancestor_raster_tile(layer_id, tilez, tilex, tiley, tilez, halo)
+
+
+def get_raster_tile_row(layer_id, tilez, tiley, xmin, xmax, halo=0):
+    """
+    Get the rasters from a row of tiles as a dictionary keyed by the x index
+    of the tiles. The tiles of the row are read in a single query, together
+    with the rows above and below if a halo is requested. Tiles that do not
+    exist at the requested zoom level are looked up individually in the
+    higher levels with the neighborhood of the ancestor for the halo, tiles
+    that are not found are omitted.
+    """
+    margin = 1 if halo else 0
+
+    # Fetch the tiles of the row and their neighbors at the requested zoom level
+    tiles = RasterTile.objects.filter(
+        rasterlayer_id=layer_id,
+        tilez=tilez,
+        tilex__gte=xmin - margin,
+        tilex__lte=xmax + margin,
+        tiley__gte=tiley - margin,
+        tiley__lte=tiley + margin,
+    )
+    tiles = {(tile.tilex, tile.tiley): tile.rast for tile in tiles}
+
+    result = {}
+    for tilex in range(xmin, xmax + 1):
+        tile = tiles.get((tilex, tiley))
+        if tile is None:
+            # Missing tiles are warped from ancestors, including their halo
+            tile = get_ancestor_raster_tile(layer_id, tilez, tilex, tiley, halo=halo)
+            if tile is not None:
+                result[tilex] = tile
+            continue
+        if halo:
+            neighbors = {
+                (offsetx, offsety): tiles[(tilex + offsetx, tiley + offsety)]
+                for offsetx in (-1, 0, 1) for offsety in (-1, 0, 1)
+                if (offsetx or offsety) and (tilex + offsetx, tiley + offsety) in tiles
+            }
+            tile = pad_tile(tile, neighbors, halo)
+        result[tilex] = tile
+
+    return result
+
+
+def stream_raster_tiles(layer_id, tilez, tiles, halo=0, fetch_size=None):
+    """
+    Generator that yields the index and the raster of the tiles of a layer
+    for a list of tile indices, row by row. The tiles are read in a single
+    query that is ordered by rows and fetched in chunks from a server-side
+    cursor, only a window of three rows of tiles is held in memory for halos.
+    Tiles that do not exist at the requested zoom level are looked up
+    individually in the higher levels with the neighborhood of the ancestor
+    for the halo, tiles that are not found are omitted.
+    """
+    tiles = sorted(set(tiles), key=lambda index: (index[1], index[0]))
+    if not tiles:
+        return
+
+    margin = 1 if halo else 0
+    fetch_size = fetch_size or getattr(settings, 'RASTER_TILE_FETCH_SIZE', TILE_FETCH_SIZE)
+
+    # Collect the tiles to read, including the neighbors for the halo
+    needed = {
+        (tilex + offsetx, tiley + offsety)
+        for tilex, tiley in tiles
+        for offsetx in range(-margin, margin + 1) for offsety in range(-margin, margin + 1)
+    }
+    xmin = min(tilex for tilex, tiley in needed)
+    xmax = max(tilex for tilex, tiley in needed)
+    ymin = min(tiley for tilex, tiley in needed)
+    ymax = max(tiley for tilex, tiley in needed)
+
+    query = RasterTile.objects.filter(
+        rasterlayer_id=layer_id,
+        tilez=tilez,
+        tilex__gte=xmin,
+        tilex__lte=xmax,
+        tiley__gte=ymin,
+        tiley__lte=ymax,
+    )
+
+    # Restrict the query to the needed tiles if they do not fill their range,
+    # by the shorter list of the needed or the skipped tile positions.
+    width = xmax - xmin + 1
+    skipped = width * (ymax - ymin + 1) - len(needed)
+    if skipped:
+        query = query.annotate(position=(F('tiley') - ymin) * width + F('tilex') - xmin)
+        if skipped < len(needed):
+            query = query.exclude(position__in=[
+                (tiley - ymin) * width + tilex - xmin
+                for tiley in range(ymin, ymax + 1) for tilex in range(xmin, xmax + 1)
+                if (tilex, tiley) not in needed
+            ])
+        else:
+            query = query.filter(position__in=[(tiley - ymin) * width + tilex - xmin for tilex, tiley in needed])
+
+    rows = query.order_by('tiley', 'tilex').values_list('tilex', 'tiley', 'rast').iterator(chunk_size=fetch_size)
+
+    fetched = {}
+    pending = next(rows, None)
+    for tiley, row in groupby(tiles, lambda index: index[1]):
+        # Read the tiles up to the row below the current row
+        while pending is not None and pending[1] <= tiley + margin:
+            fetched[(pending[0], pending[1])] = pending[2]
+            pending = next(rows, None)
+
+        for tilex, tiley in row:
+            tile = fetched.get((tilex, tiley))
+            if tile is None:
+                # Missing tiles are warped from ancestors, including their halo
+                tile = get_ancestor_raster_tile(layer_id, tilez, tilex, tiley, halo=halo)
+                if tile is not None:
+                    yield (tilex, tiley), tile
+                continue
+            if halo:
+                neighbors = {
+                    (offsetx, offsety): fetched[(tilex + offsetx, tiley + offsety)]
+                    for offsetx in (-1, 0, 1) for offsety in (-1, 0, 1)
+                    if (offsetx or offsety) and (tilex + offsetx, tiley + offsety) in fetched
+                }
+                tile = pad_tile(tile, neighbors, halo)
+            yield (tilex, tiley), tile
+
+        # Drop the tiles that the following rows do not use
+        fetched = {index: rast for index, rast in fetched.items() if index[1] > tiley - margin}
@@ -352,6 +352,9 @@ class RasterLayerParser(object):
             'height': (indexrange[3] - indexrange[1] + 1) * self.tilesize,
         })
 
+        # Value counts are summarized for tiles of discrete layers
+        discrete = self.rasterlayer.datatype in (RasterLayer.CATEGORICAL, RasterLayer.MASK)
+
         # Create all tiles in this quadrant in batches
         batch = []
         for tilex in range(indexrange[0], indexrange[2] + 1):
@@ -391,16 +394,16 @@ class RasterLayerParser(object):
                     'bands': band_data,
                 })
 
-                # Store tile in batch array
-                batch.append(
-                    RasterTile(
-                        rast=dest,
-                        rasterlayer_id=self.rasterlayer.id,
-                        tilex=tilex,
-                        tiley=tiley,
-                        tilez=zoom
-                    )
+                # Store tile with its summary statistics in batch array
+                tile = RasterTile(
+                    rast=dest,
+                    rasterlayer_id=self.rasterlayer.id,
+                    tilex=tilex,
+                    tiley=tiley,
+                    tilez=zoom
                 )
+                tile.summarize(discrete)
+                batch.append(tile)
 
                 # Commit batch to database and reset it
                 if len(batch) == self.batch_step_size:
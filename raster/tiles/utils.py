@@ -2,8 +2,10 @@
 Everything required to create TMS tiles.
 """
 from django.conf import settings
+from django.contrib.gis.geos import Polygon
 from raster.tiles.const import (
-    GLOBAL_MAX_ZOOM_LEVEL, QUADRANT_SIZE, WEB_MERCATOR_TILESHIFT, WEB_MERCATOR_TILESIZE, WEB_MERCATOR_WORLDSIZE
+    GLOBAL_MAX_ZOOM_LEVEL, QUADRANT_SIZE, WEB_MERCATOR_SRID, WEB_MERCATOR_TILESHIFT, WEB_MERCATOR_TILESIZE,
+    WEB_MERCATOR_WORLDSIZE
 )
 
 
@@ -58,6 +60,56 @@ def tile_bounds(x, y, z):
     return [xmin, ymin, xmax, ymax]
 
 
+def classify_tiles(geom, tiles, z):
+    """
+    Classify tiles against a geometry in Web Mercator by the bounds of the
+    tiles. Returns the sets of the indices of the tiles that are entirely
+    outside and entirely inside of the geometry, the other tiles intersect the
+    boundary of the geometry.
+    """
+    outside = set()
+    inside = set()
+    prepared = geom.prepared
+    for tilex, tiley in tiles:
+        bbox = Polygon.from_bbox(tile_bounds(tilex, tiley, z))
+        bbox.srid = WEB_MERCATOR_SRID
+        if prepared.contains(bbox):
+            inside.add((tilex, tiley))
+        elif not prepared.intersects(bbox):
+            outside.add((tilex, tiley))
+    return outside, inside
+
+
+def boundary_tiles(geom, tilerange, z):
+    """
+    Return the set of the indices of the tiles in the tile range that
+    intersect the boundary of a geometry in Web Mercator. The range is split
+    into blocks of tiles, blocks that are entirely inside or outside of the
+    geometry are not split any further, such that only the tiles along the
+    boundary are tested one by one.
+    """
+    boundary = set()
+    if tilerange[0] > tilerange[2] or tilerange[1] > tilerange[3]:
+        return boundary
+    prepared = geom.prepared
+    blocks = [tuple(tilerange)]
+    while blocks:
+        xmin, ymin, xmax, ymax = blocks.pop()
+        bbox = Polygon.from_bbox(tile_bounds(xmin, ymax, z)[:2] + tile_bounds(xmax, ymin, z)[2:])
+        bbox.srid = WEB_MERCATOR_SRID
+        if prepared.contains(bbox) or not prepared.intersects(bbox):
+            continue
+        if xmin == xmax and ymin == ymax:
+            boundary.add((xmin, ymin))
+        elif xmax - xmin >= ymax - ymin:
+            xmid = (xmin + xmax) // 2
+            blocks.extend([(xmin, ymin, xmid, ymax), (xmid + 1, ymin, xmax, ymax)])
+        else:
+            ymid = (ymin + ymax) // 2
+            blocks.extend([(xmin, ymin, xmax, ymid), (xmin, ymid + 1, xmax, ymax)])
+    return boundary
+
+
 def tile_scale(z):
     """
     Calculate tile pixel size scale for given zoom level.
@@ -1,5 +1,8 @@
 from django.conf.urls import url
-from raster.views import AlgebraView, ExportView, LegendView
+from raster.views import (
+    AggregationCancelView, AggregationResultView, AggregationStatusView, AggregationView, AlgebraView,
+    ExportCancelView, ExportDownloadView, ExportStatusView, ExportView, LegendView
+)
 
 urlpatterns = [
 
@@ -42,4 +45,41 @@ urlpatterns = [
         ExportView.as_view(),
         name='export',
     ),
+    url(
+        r'^export/(?P<export_id>[0-9]+)$',
+        ExportStatusView.as_view(),
+        name='export-status',
+    ),
+    url(
+        r'^export/(?P<export_id>[0-9]+)/download$',
+        ExportDownloadView.as_view(),
+        name='export-download',
+    ),
+    url(
+        r'^export/(?P<export_id>[0-9]+)/cancel$',
+        ExportCancelView.as_view(),
+        name='export-cancel',
+    ),
+
+    # Aggregation endpoint
+    url(
+        r'^aggregation$',
+        AggregationView.as_view(),
+        name='aggregation',
+    ),
+    url(
+        r'^aggregation/(?P<aggregation_id>[0-9]+)$',
+        AggregationStatusView.as_view(),
+        name='aggregation-status',
+    ),
+    url(
+        r'^aggregation/(?P<aggregation_id>[0-9]+)/result$',
+        AggregationResultView.as_view(),
+        name='aggregation-result',
+    ),
+    url(
+        r'^aggregation/(?P<aggregation_id>[0-9]+)/cancel$',
+        AggregationCancelView.as_view(),
+        name='aggregation-cancel',
+    ),
 ]
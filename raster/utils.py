@@ -1,3 +1,5 @@
+import re
+
 import numpy
 from PIL import Image
 
@@ -49,17 +51,34 @@ def rescale_to_channel_range(data, dfrom, dto, dover=None):
         return data
 
 
-def band_data_to_image(band_data, colormap):
+def band_data_to_image(band_data, colormap, valid=None, nodata=None):
     """
     Creates an python image from pixel values of a GDALRaster.
     The input is a dictionary that maps pixel values to RGBA UInt8 colors.
     If an interpolation interval is given, the values are
+
+    The band data can be a masked array, or a plain array with a boolean
+    validity array that is False for nodata pixels and the nodata value.
     """
     # Get data as 1D array
     dat = band_data.ravel()
     stats = {}
 
+    # Convert masked arrays to plain arrays with validity
+    if isinstance(dat, numpy.ma.MaskedArray):
+        if numpy.ma.is_masked(dat):
+            valid = numpy.logical_not(dat.mask)
+            nodata = dat.fill_value
+        dat = dat.data
+    elif valid is not None:
+        valid = valid.ravel()
+
     if 'continuous' in colormap:
+        # The continuous color scaling relies on the masked array arithmetic
+        # for the colors of nodata pixels, a masked view does not copy data.
+        if valid is not None:
+            dat = numpy.ma.masked_array(dat, mask=numpy.logical_not(valid), fill_value=nodata)
+
         dmin, dmax = colormap.get('range', (dat.min(), dat.max()))
 
         if dmax == dmin:
@@ -93,19 +112,21 @@ def band_data_to_image(band_data, colormap):
                 # Try to use the key as number directly
                 key = float(key)
                 selector = dat == key
+                selector_valid = valid
             except ValueError:
                 # Otherwise use it as numpy expression directly
                 parser = FormulaParser()
-                selector = parser.evaluate({'x': dat}, key)
+                if valid is None:
+                    selector, selector_valid = parser.evaluate_valid({'x': dat}, {}, key)
+                else:
+                    fill_values = {} if nodata is None else {'x': nodata}
+                    selector, selector_valid = parser.evaluate_valid({'x': dat}, {'x': valid}, key, fill_values=fill_values)
 
-            # If masked, use mask to filter values additional to formula values
-            if numpy.ma.is_masked(selector):
-                selector.fill_value = False
-                rgba[selector.filled() == 1] = color
-                # Compress for getting statistics
-                selector = selector.compressed()
-            else:
-                rgba[selector] = color
+            # Use validity to filter values additional to formula values
+            if selector_valid is not None:
+                selector = numpy.logical_and(selector, selector_valid)
+
+            rgba[selector] = color
 
             # Track pixel statistics for this tile
             stats[orig_key] = int(numpy.sum(selector))
@@ -169,3 +190,45 @@ def pixel_value_from_point(raster, point, band=0):
         offset_index[1] -= 1
 
     return raster.bands[band].data(offset=offset_index, size=(1, 1))[0, 0]
+
+
+def parse_byte_range(header, size):
+    """
+    Parse a single byte range from a http range header for a file of the
+    given size. Returns the first and last byte of the range, None if the
+    header is missing or not a single byte range, and raises a ValueError if
+    the range is not satisfiable.
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or match.groups() == ('', ''):
+        return
+
+    start, end = match.groups()
+    if not start:
+        # Suffix ranges select the last bytes of the file
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start > end:
+        raise ValueError('Byte range is not satisfiable.')
+
+    return start, end
+
+
+def read_file_range(fileobj, start, end, chunk_size=64 * 1024):
+    """
+    Yield the bytes from start to end of a file in chunks, closing the file
+    at the end.
+    """
+    try:
+        fileobj.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = fileobj.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
@@ -1,16 +1,247 @@
-from collections import Counter
+import copy
+import functools
+import hashlib
+import json
+import os
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from statistics import NormalDist
 
 import numpy
 
-from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F
+from raster.algebra.const import PRECISION_FLOAT32
 from raster.algebra.parser import FormulaParser, RasterAlgebraParser
-from raster.exceptions import RasterAggregationException
-from raster.models import Legend, RasterLayer
+from raster.const import (
+    AGGREGATION_DATABASE_TILES, AGGREGATION_ENGINE_AUTO, AGGREGATION_ENGINE_PYTHON, AGGREGATION_ENGINES,
+    AGGREGATION_SAMPLE_PIXELS, AGGREGATION_TASK_TILES, BINCOUNT_MAX_RANGE, ZONE_DATATYPE
+)
+from raster.dbaggregation import TileQuery
+from raster.exceptions import RasterAggregationCancelled, RasterAggregationException
+from raster.models import Legend, RasterAggregation, RasterLayer, RasterTile
 from raster.rasterize import rasterize
-from raster.tiles.const import WEB_MERCATOR_SRID
-from raster.tiles.lookup import get_raster_tile
-from raster.tiles.utils import tile_index_range
+from raster.sketch import QuantileSketch
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+from raster.tiles.lookup import stream_raster_tiles
+from raster.tiles.utils import boundary_tiles, classify_tiles, tile_bounds, tile_index_range, tile_scale
+
+
+def encode_value(value):
+    """
+    Convert numpy scalars and tuples of them into json serializable values
+    that keep the numpy datatype.
+    """
+    if isinstance(value, tuple):
+        return [encode_value(val) for val in value]
+    if isinstance(value, numpy.generic):
+        return {'value': value.item(), 'dtype': value.dtype.str}
+    return value
+
+
+def decode_value(value):
+    """
+    Restore a value converted by encode_value.
+    """
+    if isinstance(value, list):
+        return tuple(decode_value(val) for val in value)
+    if isinstance(value, dict):
+        return numpy.dtype(value['dtype']).type(value['value'])
+    return value
+
+
+def integer_offsets(data):
+    """
+    Return the offsets of the values of an array from its minimum as integers
+    and the minimum, if the values are integers within a range that can be
+    counted with bincount. Returns None otherwise.
+    """
+    if not data.size:
+        return
+    low = data.min()
+    high = data.max()
+    # Not a number values and large ranges are not counted with bincount
+    if not numpy.isfinite(low) or not numpy.isfinite(high) or high - low >= BINCOUNT_MAX_RANGE:
+        return
+    indices = data.astype('int64')
+    if data.dtype.kind == 'f' and not numpy.array_equal(indices, data):
+        return
+    indices -= int(low)
+    return indices, low
+
+
+def count_unique(data):
+    """
+    Count the unique values of an array, as numpy.unique with counts. Arrays
+    of integer values within a bounded range are counted in linear time by
+    bincount instead of sorting the values.
+    """
+    offsets = integer_offsets(data)
+    if offsets is None:
+        return numpy.unique(data, return_counts=True)
+
+    indices, low = offsets
+    counts = numpy.bincount(indices)
+    values = numpy.flatnonzero(counts)
+    return (values + low).astype(data.dtype), counts[values]
+
+
+def count_pairs(first, second):
+    """
+    Count the unique pairs of values of two arrays of equal size. Returns the
+    arrays of the first and second values of the pairs and their counts.
+    Pairs of integer values are counted through a combined index of both
+    values, other pairs are sorted by numpy.unique.
+    """
+    first_offsets = integer_offsets(first)
+    second_offsets = integer_offsets(second)
+    if first_offsets is None or second_offsets is None:
+        pairs, counts = numpy.unique(numpy.stack([first, second], axis=1), axis=0, return_counts=True)
+        return pairs[:, 0], pairs[:, 1], counts
+
+    # Count the combined index of the offsets of the value pairs
+    size = int(second_offsets[0].max()) + 1
+    indices, counts = count_unique(first_offsets[0] * size + second_offsets[0])
+    return (
+        (indices // size + first_offsets[1]).astype(first.dtype),
+        (indices % size + second_offsets[1]).astype(second.dtype),
+        counts,
+    )
+
+
+def estimate_total(values, sample_size, population_size, confidence=0.95):
+    """
+    Estimate the total of a value over a population of tiles from the values
+    of a simple random sample of tiles. Tiles of the sample that are missing
+    in the values count as zero. Returns the estimated total and the half
+    width of its confidence interval at the confidence level.
+    """
+    values = numpy.asarray(values, dtype='float64')
+    total = values.sum() * population_size / sample_size
+    if sample_size == population_size:
+        return total, 0.0
+    if sample_size < 2:
+        return total, numpy.inf
+
+    mean = values.sum() / sample_size
+    variance = max(0, numpy.sum(numpy.square(values)) - sample_size * mean ** 2) / (sample_size - 1)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    return total, z * population_size * numpy.sqrt((1 - sample_size / population_size) * variance / sample_size)
+
+
+def estimate_mean_error(counts, sums, sample_size, population_size, confidence=0.95):
+    """
+    Return the half width of the confidence interval of the mean value of a
+    population of tiles, estimated as the ratio of the sums and the counts of
+    the values of a simple random sample of tiles. Returns None if the sample
+    has no values.
+    """
+    counts = numpy.asarray(counts, dtype='float64')
+    sums = numpy.asarray(sums, dtype='float64')
+    if not counts.sum():
+        return None
+    if sample_size == population_size:
+        return 0.0
+    if sample_size < 2:
+        return numpy.inf
+
+    # Linearize the ratio estimator by the residuals of the tiles
+    residuals = sums - sums.sum() / counts.sum() * counts
+    variance = numpy.sum(numpy.square(residuals)) / (sample_size - 1)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    return z * numpy.sqrt((1 - sample_size / population_size) * variance / sample_size) / (counts.sum() / sample_size)
+
+
+class AggregationPartial(object):
+    """
+    Aggregation result of a part of the tiles of an aggregation.
+
+    Partials hold the value counts, the incremental statistics and optionally
+    a quantile sketch of a set of tiles, and the partials of disjoint sets of
+    tiles can be merged.
+    """
+
+    def __init__(self, sketch=False):
+        self.counts = Counter({})
+        self.sketch = QuantileSketch() if sketch else None
+        self.t0 = 0
+        self.t1 = 0
+        self.t2 = 0
+        self.min_value = None
+        self.max_value = None
+
+    def push_stats(self, data, hist_range=None):
+        """
+        Add the values of an array of valid result values to the statistics.
+        """
+        # Stop if entire data was masked
+        if data.size == 0:
+            return
+
+        # Filter data by histogram range.
+        if hist_range:
+            data = data[data >= hist_range[0]]
+            data = data[data <= hist_range[1]]
+            if data.size == 0:
+                return
+
+        # Compute incremental statistics in float64, integer results of the
+        # auto precision would overflow in their own dtype.
+        self.merge_stats(
+            data.size,
+            numpy.sum(data, dtype='float64'),
+            numpy.sum(numpy.square(data, dtype='float64')),
+            numpy.max(data),
+            numpy.min(data),
+        )
+
+    def merge_stats(self, t0, t1, t2, max_value, min_value):
+        self.t0 += t0
+        self.t1 += t1
+        self.t2 += t2
+
+        if max_value is None:
+            return
+        if self.max_value is None:
+            self.max_value = max_value
+            self.min_value = min_value
+        else:
+            self.max_value = max(max_value, self.max_value)
+            self.min_value = min(min_value, self.min_value)
+
+    def merge(self, other):
+        """
+        Merge the results of another partial into this partial.
+        """
+        self.counts.update(other.counts)
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+        self.merge_stats(other.t0, other.t1, other.t2, other.max_value, other.min_value)
+        return self
+
+    def serialize(self):
+        """
+        Return the partial as json serializable dictionary, for partials that
+        are computed in celery subtasks.
+        """
+        return {
+            'counts': [[encode_value(key), int(count)] for key, count in self.counts.items()],
+            'stats': [encode_value(value) for value in (self.t0, self.t1, self.t2, self.max_value, self.min_value)],
+            'sketch': None if self.sketch is None else self.sketch.serialize(),
+        }
+
+    @classmethod
+    def deserialize(cls, data):
+        partial = cls()
+        partial.counts.update({decode_value(key): count for key, count in data['counts']})
+        partial.merge_stats(*(decode_value(value) for value in data['stats']))
+        if data['sketch'] is not None:
+            partial.sketch = QuantileSketch.deserialize(data['sketch'])
+        return partial
 
 
 class Aggregator(object):
@@ -23,7 +254,8 @@ class Aggregator(object):
     """
 
     def __init__(self, layer_dict, formula, zoom=None, geom=None, acres=True,
-                 grouping='auto', all_touched=True, memory_efficient=False, hist_range=None):
+                 grouping='auto', all_touched=True, memory_efficient=False, hist_range=None, max_tiles=None,
+                 engine=None):
         # Set defining parameter for this aggregator
         self.layer_dict = layer_dict
         self.formula = formula
@@ -33,16 +265,41 @@ class Aggregator(object):
         self.all_touched = all_touched
         self.memory_efficient = memory_efficient
         self.hist_range = hist_range
+        self.max_tiles = max_tiles or getattr(settings, 'RASTER_AGGREGATION_MAX_TILES', None)
+        self.engine = engine or getattr(settings, 'RASTER_AGGREGATION_ENGINE', AGGREGATION_ENGINE_PYTHON)
+        if self.engine not in AGGREGATION_ENGINES:
+            raise RasterAggregationException('Invalid aggregation engine {0}.'.format(self.engine))
+        # Function that is called with the number of aggregated tiles
+        self.progress = None
 
         # Get layers from input dict
         self.layers = RasterLayer.objects.filter(id__in=layer_dict.values())
 
-        # Compute zoom if not provided
+        # Auto determine grouping based on input data
+        if grouping == 'auto':
+            all_discrete = all((lyr.datatype in (RasterLayer.CATEGORICAL, RasterLayer.MASK) for lyr in self.layers))
+            grouping = 'discrete' if all_discrete else 'continuous'
+        elif grouping in ('discrete', 'continuous'):
+            pass
+        else:
+            try:
+                legend_id = int(grouping)
+                grouping = Legend.objects.get(id=legend_id)
+            except ValueError:
+                pass
+            except ObjectDoesNotExist:
+                raise RasterAggregationException(
+                    'Invalid legend ID found in grouping value for valuecount.'
+                )
+        self.grouping = grouping
+
+        # Compute the highest zoom level within the tile budget if not provided
+        explicit_zoom = zoom is not None
         if zoom is None:
             zoom = min(self.layers.values_list('metadata__max_zoom', flat=True))
         self.zoom = zoom
 
-        # Compute tilerange for this area and the given zoom level
+        # Compute the extents of the aggregation area
         if geom:
             # Transform geom to web mercator
             if geom.srid != WEB_MERCATOR_SRID:
@@ -58,116 +315,678 @@ class Aggregator(object):
                 self.tilerange = None
                 return
             else:
-                # Compute tile index range for geometry and given zoom level
-                self.tilerange = tile_index_range(max_extent.extent, zoom)
+                extents = [max_extent.extent]
         else:
-            # Get index range set for the input layers
-            index_ranges = [tile_index_range(lyr.extent(), zoom) for lyr in self.layers]
-
-            # Compute intersection of index ranges
-            self.tilerange = [
-                max([dat[0] for dat in index_ranges]),
-                max([dat[1] for dat in index_ranges]),
-                min([dat[2] for dat in index_ranges]),
-                min([dat[3] for dat in index_ranges])
-            ]
+            extents = [lyr.extent() for lyr in self.layers]
 
-        # Auto determine grouping based on input data
-        if grouping == 'auto':
-            all_discrete = all((lyr.datatype in (RasterLayer.CATEGORICAL, RasterLayer.MASK) for lyr in self.layers))
-            grouping = 'discrete' if all_discrete else 'continuous'
-        elif grouping in ('discrete', 'continuous'):
-            pass
-        else:
-            try:
-                legend_id = int(grouping)
-                grouping = Legend.objects.get(id=legend_id)
-            except ValueError:
-                pass
-            except ObjectDoesNotExist:
+        # Compute tilerange for this area and the zoom level
+        self.tilerange = self._index_range(extents, self.zoom)
+        if self.max_tiles:
+            # Reduce the zoom level until the tile range is within the tile budget
+            while not explicit_zoom and self.zoom > 0 and self.tile_count() > self.max_tiles:
+                self.zoom -= 1
+                self.tilerange = self._index_range(extents, self.zoom)
+            if self.tile_count() > self.max_tiles:
                 raise RasterAggregationException(
-                    'Invalid legend ID found in grouping value for valuecount.'
+                    'The aggregation area covers {0} tiles at zoom level {1}, more than the '
+                    'maximum of {2} tiles.'.format(self.tile_count(), self.zoom, self.max_tiles)
                 )
-        self.grouping = grouping
 
-    def get_raster_tile(self, layerid, zoom, tilex, tiley):
-        return get_raster_tile(layerid, zoom, tilex, tiley)
+    @staticmethod
+    def _index_range(extents, zoom):
+        """
+        Compute the intersection of the tile index ranges of the extents at
+        the zoom level.
+        """
+        index_ranges = [tile_index_range(extent, zoom) for extent in extents]
+        return [
+            max([dat[0] for dat in index_ranges]),
+            max([dat[1] for dat in index_ranges]),
+            min([dat[2] for dat in index_ranges]),
+            min([dat[3] for dat in index_ranges])
+        ]
+
+    def tile_count(self):
+        """
+        Return the number of tiles in the tile range.
+        """
+        if not self.tilerange:
+            return 0
+        xmin, ymin, xmax, ymax = self.tilerange
+        return max(0, xmax - xmin + 1) * max(0, ymax - ymin + 1)
+
+    def stream_raster_tiles(self, layerid, zoom, tiles, halo=0):
+        return stream_raster_tiles(layerid, zoom, tiles, halo)
+
+    def task_parameters(self):
+        """
+        Return the parameters to reconstruct this aggregator in a subtask.
+        """
+        grouping = self.grouping
+        if isinstance(grouping, Legend):
+            grouping = grouping.id if grouping.id else grouping.json
+        return {
+            'layer_dict': self.layer_dict,
+            'formula': self.formula,
+            'zoom': self.zoom,
+            'geom': self.geom.ewkt if self.geom else None,
+            'acres': self.acres,
+            'grouping': grouping,
+            'all_touched': self.all_touched,
+            'hist_range': list(self.hist_range) if self.hist_range else None,
+            'max_tiles': self.max_tiles,
+            'engine': self.engine,
+        }
+
+    @classmethod
+    def from_task_parameters(cls, parameters):
+        parameters = dict(parameters)
+        if parameters['geom']:
+            parameters['geom'] = GEOSGeometry(parameters['geom'])
+        return cls(**parameters)
 
     def tiles(self):
         """
         Generator that yields an algebra-ready data dictionary for each tile in
         the aggregator's tile range.
         """
+        for results in self.tiles_multi([self.formula]):
+            yield results[0]
+
+    def tiles_multi(self, formulas):
+        """
+        Generator that yields a list with the valid result values of each
+        formula for every tile in the aggregator's tile range. The tiles are
+        read once and the formulas are evaluated together.
+        """
+        return self.map_tiles(formulas)
+
+    def map_tiles(self, formulas, func=None, exclude=(), joint=False, zones=None, tiles=None):
+        """
+        Generator that yields the result of a function of the valid result
+        values of the formulas for every tile in the aggregator's tile range,
+        in the order of the tiles.
+
+        The tiles are read row by row, while the formulas are evaluated and the
+        function is applied on a pool of threads. The function is called with
+        the list of the results of the formulas on a tile. Tiles with an index
+        in exclude are skipped. Joint results only contain the pixels where
+        all formulas are valid.
+
+        With a clip geometry, the tiles outside of the geometry are not read,
+        and only the tiles that intersect the boundary of the geometry are
+        masked by the rasterized geometry.
+
+        With a list of zone geometries, the tiles that no zone intersects are
+        not read. The zones are rasterized on every tile, and the results are
+        joint results that are preceded by the zone numbers of the pixels,
+        counting the zones from one. Pixels outside of all zones are invalid.
+        Overlapping zones are rasterized in separate passes, the pixels are
+        repeated for every pass, such that pixels covered by several zones
+        are included with each of these zones.
+
+        With a list of tile indices, only these tiles of the tile range are
+        read instead of all tiles.
+        """
         # Check if any tiles have been matched
         if not self.tilerange:
             return
 
         algebra_parser = RasterAlgebraParser()
 
-        for tilex in range(self.tilerange[0], self.tilerange[2] + 1):
-            for tiley in range(self.tilerange[1], self.tilerange[3] + 1):
-
-                # Prepare a data dictionary with named tiles for algebra evaluation
-                data = {}
-                for name, layerid in self.layer_dict.items():
-                    tile = self.get_raster_tile(layerid, self.zoom, tilex, tiley)
-                    if tile:
-                        data[name] = tile
-                    else:
-                        break
-
-                # Ignore this tile if it is missing in any of the input layers
-                if len(data) < len(self.layer_dict):
-                    continue
-
-                # Compute raster algebra
-                result = algebra_parser.evaluate_raster_algebra(data, self.formula)
-
-                # Convert band data to masked array
-                result_data = numpy.ma.masked_values(
-                    result.bands[0].data(),
-                    result.bands[0].nodata_value,
+        # Only fetch tiles of layers that the formulas reference
+        layer_dict = {}
+        for formula in formulas:
+            layer_dict.update(algebra_parser.referenced_layers(self.layer_dict, formula))
+
+        # Neighborhood functions require tiles with a halo of neighbor pixels
+        halo = max(algebra_parser.get_halo(formula) for formula in formulas)
+
+        # Skip the tiles outside of the clip geometry
+        outside, inside = self.classify_tiles(tiles)
+        exclude = outside.union(exclude)
+
+        # Skip the tiles that no zone intersects
+        if zones is not None:
+            zone_tiles = self.zone_passes(self.zone_tiles(zones))
+            xmin, ymin, xmax, ymax = self.tilerange
+            exclude = exclude.union(
+                (tilex, tiley) for tiley in range(ymin, ymax + 1) for tilex in range(xmin, xmax + 1)
+                if (tilex, tiley) not in zone_tiles
+            )
+
+        workers = getattr(settings, 'RASTER_AGGREGATION_WORKERS', None) or os.cpu_count() or 1
+
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for index, data in self._tile_data(layer_dict, halo, exclude, tiles):
+                    clip = self.geom is not None and index not in inside
+                    tile_zones = None if zones is None else zone_tiles[index]
+                    pending.append(pool.submit(self._evaluate_tile, data, formulas, halo, func, clip, joint, tile_zones))
+                    # Return the oldest tile while a few tiles per worker are in progress
+                    if len(pending) > 2 * workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            except:
+                # Drop the evaluations that have not started yet
+                for evaluation in pending:
+                    evaluation.cancel()
+                raise
+
+    def _tile_data(self, layer_dict, halo, exclude=(), tiles=None):
+        """
+        Generator that yields the index and an algebra-ready data dictionary
+        for each tile in the aggregator's tile range, or for each tile of a
+        list of tile indices, row by row. Tiles that are excluded are not
+        read. The tiles of each layer are streamed from a single query, and
+        the streams of the layers are merged by the tile indices.
+        """
+        if tiles is None:
+            xmin, ymin, xmax, ymax = self.tilerange
+            tiles = ((tilex, tiley) for tiley in range(ymin, ymax + 1) for tilex in range(xmin, xmax + 1))
+        tiles = sorted(
+            (index for index in tiles if index not in exclude),
+            key=lambda index: (index[1], index[0]),
+        )
+
+        streams = {
+            name: self.stream_raster_tiles(layerid, self.zoom, tiles, halo)
+            for name, layerid in layer_dict.items()
+        }
+        heads = {name: next(stream, None) for name, stream in streams.items()}
+
+        for index in tiles:
+            # Prepare a data dictionary with named tiles for algebra evaluation,
+            # the streams omit the tiles that are missing in a layer.
+            data = {}
+            for name, stream in streams.items():
+                if heads[name] is not None and heads[name][0] == index:
+                    data[name] = heads[name][1]
+                    heads[name] = next(stream, None)
+
+            # Ignore this tile if it is missing in any of the input layers
+            if len(data) < len(layer_dict):
+                continue
+
+            yield index, data
+
+    def _evaluate_tile(self, data, formulas, halo, func=None, clip=False, joint=False, zones=None):
+        """
+        Evaluate the formulas on the data of a tile and return the valid result
+        values, or the function of the results. The results are clipped by the
+        rasterized geometry if requested. Joint results are restricted to the
+        pixels where all formulas are valid, such that the result values are
+        aligned. Zones are a list of passes of zone numbers and geometries.
+        The zones of every pass are burned into the tile in a single
+        rasterization, and the zone numbers of the passes precede the joint
+        results, which are repeated for every pass. Every tile uses its own
+        parser, parsers are not thread safe.
+        """
+        algebra_parser = RasterAlgebraParser()
+
+        # Compute raster algebra as plain arrays with validity masks
+        evaluated = algebra_parser.evaluate_raster_data_multi(data, formulas, halo=halo)
+
+        # Number the pixels by the zones that cover them, in every pass
+        passes = 1
+        if zones is not None:
+            zone_numbers = []
+            for zone_pass in zones:
+                numbers, geoms = zip(*zone_pass)
+                zone_raster = rasterize(
+                    list(geoms), list(data.values())[0], burn_value=list(numbers),
+                    all_touched=self.all_touched, datatype=ZONE_DATATYPE,
+                )
+                zone_numbers.append(
+                    algebra_parser.crop_halo(zone_raster.bands[0].data().ravel(), algebra_parser.shape, halo)
                 )
+            passes = len(zone_numbers)
+            if passes > 1:
+                # Repeat the results for every pass of overlapping zones
+                zone_numbers = numpy.concatenate(zone_numbers)
+                evaluated = [
+                    (numpy.tile(result, passes), None if valid is None else numpy.tile(valid, passes), nodata)
+                    for result, valid, nodata in evaluated
+                ]
+            else:
+                zone_numbers = zone_numbers[0]
+            evaluated = [(zone_numbers, zone_numbers > 0, 0)] + evaluated
+            joint = True
 
-                # Apply rasterized geometry as mask if clip geometry was provided
-                if self.geom:
-                    result_data = self.mask_by_geom(result, result_data)
+        # Apply rasterized geometry as mask on tiles on the geometry boundary
+        if clip:
+            geom_valid = self.mask_by_geom(list(data.values())[0])
+            geom_valid = algebra_parser.crop_halo(geom_valid, algebra_parser.shape, halo)
+            if passes > 1:
+                geom_valid = numpy.tile(geom_valid, passes)
 
-                yield result_data.compressed()
+        # Combine the validity of the formulas
+        if joint:
+            valids = [valid for result, valid, nodata in evaluated if valid is not None]
+            joint_valid = functools.reduce(numpy.logical_and, valids) if valids else None
+            evaluated = [(result, joint_valid, nodata) for result, valid, nodata in evaluated]
 
-    def _clear_stats(self):
-        self._stats_t0 = 0
-        self._stats_t1 = 0
-        self._stats_t2 = 0
-        self._stats_max_value = None
-        self._stats_min_value = None
+        results = []
+        for result, valid, nodata in evaluated:
+            if clip:
+                valid = geom_valid if valid is None else valid & geom_valid
+            results.append(result if valid is None else result[valid])
 
-    def _push_stats(self, data):
-        # Stop if entire data was masked
-        if data.size == 0:
-            return
+        return results if func is None else func(results)
 
-        # Filter data by histogram range.
-        if self.hist_range:
-            stats_data = data[data >= self.hist_range[0]]
-            stats_data = stats_data[stats_data <= self.hist_range[1]]
+    def _tile_partials(self, results, count=True, hist_ranges=None, sketch=False):
+        """
+        Compute the partial aggregation results of the formulas on a tile.
+        """
+        partials = []
+        for index, data in enumerate(results):
+            partial = AggregationPartial(sketch)
+            partial.push_stats(data, self.hist_range)
+            if count:
+                hist_range = hist_ranges[index] if hist_ranges else None
+                partial.counts.update(Counter(self._count_values(data, hist_range)))
+            if sketch:
+                partial.sketch.push(data)
+            partials.append(partial)
+        return partials
+
+    def aggregate(self, formulas, count=True, hist_ranges=None, sketch=False):
+        """
+        Compute the merged partial aggregation results of the formulas over
+        the aggregator's tile range. The partials are merged in the order of
+        the tiles, the results do not depend on the distribution of the work.
+        Aggregation jobs split large tile ranges into parts that are
+        aggregated in celery subtasks, see run_aggregation.
+
+        Continuous value counts are computed in the histogram ranges of the
+        formulas, which are determined if not provided. Quantile sketches of
+        the values are computed if requested. The results are stored in the
+        aggregation cache if it is configured.
+
+        The progress function of the aggregator is called with the number of
+        tiles that have been aggregated since the last call.
+
+        Aggregations that the database engine supports are computed in
+        PostGIS if the engine is selected, see use_database.
+        """
+        # Resolve legend groupings before the tiles are counted in parallel
+        if count and self.grouping not in ('discrete', 'continuous'):
+            self._get_colormap()
+
+        # Continuous value counts require the same histogram bins on all tiles
+        if count and self.grouping == 'continuous' and hist_ranges is None:
+            hist_ranges = self._hist_ranges(formulas)
+
+        # Reuse the results of identical aggregations
+        cache_alias = getattr(settings, 'RASTER_AGGREGATION_CACHE', None)
+        if cache_alias:
+            cache = caches[cache_alias]
+            key = self.cache_key(formulas, count, hist_ranges, sketch)
+            cached = cache.get(key)
+            if cached is not None:
+                return [AggregationPartial.deserialize(data) for data in cached]
+
+        results = [AggregationPartial(sketch) for formula in formulas]
+
+        if self.use_database(formulas, sketch, count):
+            # Merge the values of the tiles in the database
+            for index, formula in enumerate(formulas):
+                hist_range = hist_ranges[index] if hist_ranges else None
+                results[index] = self._database_partial(formula, count, hist_range)
+            if self.progress:
+                self.progress(self.tile_count())
         else:
-            stats_data = data
+            # Aggregate tiles from their summaries where possible
+            summaries = {} if sketch else self.tile_summaries(formulas, count)
+            for partials in summaries.values():
+                for result, tile_partial in zip(results, partials):
+                    result.merge(tile_partial)
+            if self.progress and summaries:
+                self.progress(len(summaries))
+
+            func = functools.partial(self._tile_partials, count=count, hist_ranges=hist_ranges, sketch=sketch)
+            for partials in self.map_tiles(formulas, func, exclude=summaries):
+                for result, tile_partial in zip(results, partials):
+                    result.merge(tile_partial)
+                if self.progress:
+                    self.progress(1)
+
+        if cache_alias:
+            timeout = getattr(settings, 'RASTER_AGGREGATION_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+            cache.set(key, [partial.serialize() for partial in results], timeout)
+
+        return results
+
+    def cache_key(self, formulas, count=True, hist_ranges=None, sketch=False):
+        """
+        Return the cache key of the aggregation of the formulas. The key
+        depends on the parameters that determine the partial results, on the
+        versions of the layers, given by their modification and parsing
+        states, and on the colormap of legend groupings. Clip geometries are
+        normalized, such that equivalent geometries have the same key.
+        """
+        grouping = None
+        if count:
+            grouping = self.grouping
+            if grouping not in ('discrete', 'continuous'):
+                grouping = self._get_colormap()
+
+        geom = None
+        if self.geom:
+            geom = self.geom.clone()
+            geom.normalize()
+            geom = hashlib.sha256(bytes(geom.wkb)).hexdigest()
+
+        versions = self.layers.values_list('id', 'modified', 'parsestatus__status', 'parsestatus__tile_levels')
+
+        key = {
+            'formulas': formulas,
+            'count': count,
+            'hist_ranges': hist_ranges,
+            'sketch': sketch,
+            'layers': self.layer_dict,
+            'versions': {str(layerid): rest for layerid, *rest in versions},
+            'zoom': self.zoom,
+            'tilerange': self.tilerange,
+            'grouping': grouping,
+            'hist_range': list(self.hist_range) if self.hist_range else None,
+            'all_touched': self.all_touched,
+            'engine': self.engine,
+            'geom': geom,
+            'precision': RasterAlgebraParser().get_precision(),
+        }
+        key = json.dumps(key, sort_keys=True, default=str)
+        return 'raster-aggregation-' + hashlib.sha256(key.encode()).hexdigest()
+
+    def _hist_ranges(self, formulas):
+        """
+        Return the histogram ranges for continuous value counts of the
+        formulas. Without histogram range on the aggregator, the bins span
+        the range of the values of each formula in the aggregation area. The
+        ranges are computed in a first pass over the tiles, which is answered
+        by the tile summaries where possible.
+        """
+        if self.hist_range:
+            return [list(self.hist_range) for formula in formulas]
+
+        return [
+            None if partial.t0 == 0 else [float(partial.min_value), float(partial.max_value)]
+            for partial in self.aggregate(formulas, count=False)
+        ]
+
+    def tile_summaries(self, formulas, count=True):
+        """
+        Return the partial aggregation results of the formulas on the tiles
+        that can be aggregated from the summary statistics stored with the
+        tiles, keyed by tile index in the order of the tiles.
+
+        Summaries answer statistics without histogram range and discrete value
+        counts of formulas that consist of a single layer band, on the tiles
+        that are entirely within the aggregation area.
+        """
+        if not self.tilerange or self.hist_range or (count and self.grouping != 'discrete'):
+            return {}
+
+        bands = [self._formula_band(formula) for formula in formulas]
+        if None in bands or not self._precision_exact(formulas):
+            return {}
+
+        # Read the summaries of the tiles of every layer in one query
+        xmin, ymin, xmax, ymax = self.tilerange
+        summaries = {}
+        for layerid in set(layerid for layerid, band in bands):
+            tiles = RasterTile.objects.filter(
+                rasterlayer_id=layerid,
+                tilez=self.zoom,
+                tilex__gte=xmin,
+                tilex__lte=xmax,
+                tiley__gte=ymin,
+                tiley__lte=ymax,
+                summary_count__isnull=False,
+            )
+            if count:
+                tiles = tiles.filter(summary_value_counts__isnull=False)
+            tiles = tiles.values_list(
+                'tilex', 'tiley', 'summary_count', 'summary_sum', 'summary_sum_squares',
+                'summary_min', 'summary_max', 'summary_value_counts',
+            )
+            summaries[layerid] = {(tile[0], tile[1]): tile[2:] for tile in tiles}
+
+        # Use the tiles that have summaries for all layers and bands
+        indices = set.intersection(*(set(tiles) for tiles in summaries.values()))
+        indices = [
+            index for index in indices
+            if all(band < len(summaries[layerid][index][0]) for layerid, band in bands)
+        ]
+
+        # Clipped aggregations use the summaries of tiles within the geometry
+        if self.geom:
+            inside = self.classify_tiles()[1]
+            indices = [index for index in indices if index in inside]
+
+        return {
+            index: [self._summary_partial(summaries[layerid][index], band, count) for layerid, band in bands]
+            for index in sorted(indices, key=lambda index: (index[1], index[0]))
+        }
+
+    def use_database(self, formulas, sketch=False, count=True):
+        """
+        Return True if the formulas are aggregated by the database engine.
+
+        The database engine aggregates formulas that consist of a single layer
+        band whose values do not depend on the algebra precision, without
+        quantile sketches. Clip
+        geometries select the pixels by their center in the database, such
+        that clipped aggregations require all_touched to be False. With the
+        auto engine, the database is used for tile ranges of at least the
+        ``RASTER_AGGREGATION_DATABASE_TILES`` setting. Continuous value counts
+        are only computed in the database with the postgis engine.
+        """
+        if self.engine == AGGREGATION_ENGINE_PYTHON or sketch or not self.tilerange:
+            return False
+
+        if self.geom and self.all_touched:
+            return False
+
+        if not all(self._formula_band(formula) for formula in formulas) or not self._precision_exact(formulas):
+            return False
+
+        if self.engine == AGGREGATION_ENGINE_AUTO:
+            if count and self.grouping == 'continuous':
+                return False
+            return self.tile_count() >= getattr(settings, 'RASTER_AGGREGATION_DATABASE_TILES', AGGREGATION_DATABASE_TILES)
 
-        # Compute incremental statistics
-        self._stats_t0 += stats_data.size
-        self._stats_t1 += numpy.sum(stats_data)
-        self._stats_t2 += numpy.sum(numpy.square(stats_data))
+        return True
 
-        tile_max = numpy.max(stats_data)
-        tile_min = numpy.min(stats_data)
+    def _database_partial(self, formula, count=True, hist_range=None):
+        """
+        Compute the partial aggregation result of a single layer band formula
+        in the database.
+        """
+        layerid, band = self._formula_band(formula)
+        clip = boundary_tiles(self.geom, self.tilerange, self.zoom) if self.geom else ()
+        query = TileQuery(layerid, band, self.zoom, self.tilerange, self.geom, clip)
+
+        partial = AggregationPartial()
+        t0, t1, t2, min_value, max_value = query.statistics(self.hist_range)
+        partial.merge_stats(t0, t1, t2, max_value, min_value)
+        if not count:
+            return partial
 
-        if self._stats_max_value is None:
-            self._stats_max_value = tile_max
-            self._stats_min_value = tile_min
+        if self.grouping == 'continuous':
+            if not t0:
+                return partial
+            # Use the bins of numpy histograms in the histogram range
+            edges = numpy.histogram_bin_edges([], range=hist_range or self.hist_range)
+            counts = query.histogram(edges)
+            partial.counts.update({(edges[i], edges[i + 1]): counts[i] for i in range(len(edges) - 1)})
         else:
-            self._stats_max_value = max(tile_max, self._stats_max_value)
-            self._stats_min_value = min(tile_min, self._stats_min_value)
+            values, counts = query.value_counts()
+            if self.grouping == 'discrete':
+                partial.counts.update(dict(zip(values, counts)))
+            else:
+                # Count the values that match the legend expressions
+                formula_parser = FormulaParser()
+                for key, color in self._get_colormap().items():
+                    try:
+                        selector = values == float(key)
+                    except ValueError:
+                        selector = formula_parser.evaluate({'x': values}, key)
+                    partial.counts[key] = numpy.sum(counts[selector])
+
+        return partial
+
+    def _formula_band(self, formula):
+        """
+        Return the layer id and band index of a formula that consists of a
+        single variable, or None for other formulas.
+        """
+        for key, layerid in self.layer_dict.items():
+            variable, band = RasterAlgebraParser.split_key(key)
+            if variable == formula.strip():
+                return layerid, band
+
+    def _precision_exact(self, formulas):
+        """
+        Return True if the single layer band formulas evaluate to the values
+        of the bands at the algebra precision, such that they can be
+        aggregated from the tile summaries and in the database. The float64
+        and auto precisions keep the band values, the float32 precision only
+        keeps the integer values of discrete layers.
+        """
+        if RasterAlgebraParser().get_precision() != PRECISION_FLOAT32:
+            return True
+        layerids = set(self._formula_band(formula)[0] for formula in formulas)
+        discrete = (RasterLayer.CATEGORICAL, RasterLayer.MASK)
+        return all(layer.datatype in discrete for layer in self.layers if layer.id in layerids)
+
+    def _summary_partial(self, summary, band, count=True):
+        """
+        Construct the partial aggregation result of a tile band summary.
+        """
+        counts, sums, sum_squares, mins, maxs, value_counts = summary
+        partial = AggregationPartial()
+        partial.merge_stats(counts[band], sums[band], sum_squares[band], maxs[band], mins[band])
+        if count:
+            partial.counts.update({
+                numpy.float64(value): int(value_count)
+                for value_band, value, value_count in value_counts if value_band == band
+            })
+        return partial
+
+    def classify_tiles(self, tiles=None):
+        """
+        Classify the tiles of the tile range against the clip geometry.
+        Returns the sets of the indices of the tiles that are entirely outside
+        and entirely inside of the geometry, the other tiles intersect the
+        boundary of the geometry. The classification is computed once for the
+        zoom level and tile range of the aggregator. A list of tile indices is
+        classified without the other tiles of the tile range.
+        """
+        key = None
+        if tiles is None:
+            key = (self.zoom, tuple(self.tilerange or ()))
+            if getattr(self, '_tile_classes', (None, None))[0] == key:
+                return self._tile_classes[1]
+            if self.tilerange:
+                xmin, ymin, xmax, ymax = self.tilerange
+                tiles = ((tilex, tiley) for tiley in range(ymin, ymax + 1) for tilex in range(xmin, xmax + 1))
+
+        outside = set()
+        inside = set()
+        if self.geom and tiles:
+            outside, inside = classify_tiles(self.geom, tiles, self.zoom)
+
+        if key is not None:
+            self._tile_classes = (key, (outside, inside))
+        return outside, inside
+
+    def tile_polygon(self, tilex, tiley):
+        """
+        Return the bounding box of a tile at the aggregation zoom level.
+        """
+        bbox = Polygon.from_bbox(tile_bounds(tilex, tiley, self.zoom))
+        bbox.srid = WEB_MERCATOR_SRID
+        return bbox
+
+    def zone_tiles(self, zones):
+        """
+        Return a dictionary with the zone numbers and geometries of the zones
+        that intersect each tile of the tile range, keyed by the tile index.
+        Zones are numbered from one in the order of the list of geometries.
+        """
+        xmin, ymin, xmax, ymax = self.tilerange
+        tiles = {}
+        for number, geom in enumerate(zones, start=1):
+            zone_xmin, zone_ymin, zone_xmax, zone_ymax = tile_index_range(geom.extent, self.zoom)
+            for tiley in range(max(ymin, zone_ymin), min(ymax, zone_ymax) + 1):
+                for tilex in range(max(xmin, zone_xmin), min(xmax, zone_xmax) + 1):
+                    tiles.setdefault((tilex, tiley), []).append((number, geom))
+        return tiles
+
+    def zone_passes(self, zone_tiles):
+        """
+        Split the zones of every tile of a zone_tiles dictionary into passes
+        of zones that do not overlap, such that every pass is burned into the
+        tile in a single rasterization. Zones are assigned to the first pass
+        without overlapping zones. Zones overlap if their interiors intersect,
+        or if they touch when all touched pixels are burned. Returns a
+        dictionary with the list of passes of the tiles.
+        """
+        # Collect the overlapping zones, only zones on the same tile can overlap
+        overlaps = {}
+        checked = set()
+        prepared = {}
+        for tile_zones in zone_tiles.values():
+            for index, (number, geom) in enumerate(tile_zones):
+                if number not in prepared:
+                    prepared[number] = geom.prepared
+                for other_number, other in tile_zones[index + 1:]:
+                    if (number, other_number) in checked:
+                        continue
+                    checked.add((number, other_number))
+                    if prepared[number].intersects(other) and (self.all_touched or not prepared[number].touches(other)):
+                        overlaps.setdefault(number, set()).add(other_number)
+                        overlaps.setdefault(other_number, set()).add(number)
+
+        # Assign the zones to passes in the order of their numbers
+        zone_pass = {}
+        for number in sorted(set(number for tile_zones in zone_tiles.values() for number, geom in tile_zones)):
+            taken = set(zone_pass[other] for other in overlaps.get(number, ()) if other in zone_pass)
+            zone_pass[number] = next(index for index in range(len(taken) + 1) if index not in taken)
+
+        result = {}
+        for tile, tile_zones in zone_tiles.items():
+            passes = {}
+            for number, geom in tile_zones:
+                passes.setdefault(zone_pass[number], []).append((number, geom))
+            result[tile] = [passes[index] for index in sorted(passes)]
+        return result
+
+    def task_tileranges(self):
+        """
+        Split the tile range into ranges of rows of tiles with at most the
+        number of tiles per aggregation subtask.
+        """
+        if not self.tilerange:
+            return []
+        xmin, ymin, xmax, ymax = self.tilerange
+        task_tiles = getattr(settings, 'RASTER_AGGREGATION_TASK_TILES', AGGREGATION_TASK_TILES)
+        rows = max(1, task_tiles // (xmax - xmin + 1))
+        return [[xmin, tiley, xmax, min(tiley + rows - 1, ymax)] for tiley in range(ymin, ymax + 1, rows)]
+
+    def _clear_stats(self):
+        self._set_stats(AggregationPartial())
+
+    def _set_stats(self, partial):
+        self._stats_t0 = partial.t0
+        self._stats_t1 = partial.t1
+        self._stats_t2 = partial.t2
+        self._stats_max_value = partial.max_value
+        self._stats_min_value = partial.min_value
 
     def statistics(self, reset=False):
         """
@@ -177,11 +996,15 @@ class Aggregator(object):
         sum of squares t2 = sum(x^2).
         """
         if reset or not hasattr(self, '_stats_max_value') or self._stats_max_value is None:
-            self._clear_stats()
             # Only compute statistics if they have not been previously computed.
-            for data in self.tiles():
-                self._push_stats(data)
+            self._set_stats(self.aggregate([self.formula], count=False)[0])
+
+        return self._get_stats()
 
+    def _get_stats(self):
+        """
+        Compute the statistics from the incremental sums.
+        """
         if self._stats_t0 == 0:
             # If totals sum is zero, no data was available to comput statistics
             mean = None
@@ -193,17 +1016,18 @@ class Aggregator(object):
 
         return (self._stats_min_value, self._stats_max_value, mean, std)
 
-    def mask_by_geom(self, tile, data):
-        # Rasterize the aggregation area to the result raster
+    def mask_by_geom(self, tile, valid=None):
+        # Rasterize the aggregation area to the tile
         self.rastgeom = rasterize(self.geom, tile, all_touched=self.all_touched)
 
-        # Get boolean mask based on rasterized geom
-        rastgeom_mask = self.rastgeom.bands[0].data() != 1
+        # Get boolean validity based on rasterized geom
+        rastgeom_valid = self.rastgeom.bands[0].data().ravel() == 1
 
-        # Apply geometry mask to result data
-        data.mask = data.mask | rastgeom_mask
+        # Combine geometry with the validity of the result data
+        if valid is None:
+            return rastgeom_valid
 
-        return data
+        return valid & rastgeom_valid
 
     def value_count(self):
         """
@@ -223,81 +1047,485 @@ class Aggregator(object):
           legend_id. The data will be grouped using the legend expressions. For
           For instance, use grouping=23 for grouping the output with legend 23.
         """
-        # Instantiate counter dict for value counts.
-        results = Counter({})
-        self._clear_stats()
-
-        if self.memory_efficient:
-            # Loop through tiles individually.
-            all_result_data = self.tiles()
-        else:
-            # Combine all tiles into one big array.
-            all_result_data = [tile for tile in self.tiles()]
-            if len(all_result_data):
-                all_result_data = (
-                    numpy.concatenate(all_result_data),
-                )
+        return self._get_counts(self.aggregate([self.formula])[0])
 
-        for result_data in all_result_data:
+    def _count_values(self, result_data, hist_range=None):
+        """
+        Count the values of an array of valid result values by the grouping of
+        this aggregator. Continuous values are counted in the histogram range,
+        which defaults to the histogram range of the aggregator.
+        """
+        if self.grouping == 'discrete':
+            # Compute unique counts for discrete input data
+            unique_counts = count_unique(result_data)
+            # Add counts to results
+            values = dict(zip(unique_counts[0], unique_counts[1]))
 
-            if self.grouping == 'discrete':
-                # Compute unique counts for discrete input data
-                unique_counts = numpy.unique(result_data, return_counts=True)
-                # Add counts to results
-                values = dict(zip(unique_counts[0], unique_counts[1]))
+        elif self.grouping == 'continuous':
+            # Handle continuous case - compute histogram on masked data
+            counts, bins = numpy.histogram(result_data, range=hist_range or self.hist_range)
 
-            elif self.grouping == 'continuous':
-                if self.memory_efficient and not self.hist_range:
-                    raise RasterAggregationException(
-                        'Secify a histogram range for memory efficient continuous aggregation.'
-                    )
+            # Create dictionary with bins as keys and histogram counts as values
+            values = {}
+            for i in range(len(bins) - 1):
+                values[(bins[i], bins[i + 1])] = counts[i]
 
-                # Handle continuous case - compute histogram on masked data
-                counts, bins = numpy.histogram(result_data, range=self.hist_range)
+        else:
+            # Use colormap to compute value counts
+            formula_parser = FormulaParser()
+            values = {}
+            for key, color in self._get_colormap().items():
+                try:
+                    # Try to use the key as number directly
+                    selector = result_data == float(key)
+                except ValueError:
+                    # Otherwise use it as numpy expression directly
+                    selector = formula_parser.evaluate({'x': result_data}, key)
+                values[key] = numpy.sum(selector)
 
-                # Create dictionary with bins as keys and histogram counts as values
-                values = {}
-                for i in range(len(bins) - 1):
-                    values[(bins[i], bins[i + 1])] = counts[i]
+        return values
 
-            else:
-                # If input is not a legend, interpret input as legend json data
-                if not isinstance(self.grouping, Legend):
-                    self.grouping = Legend(json=self.grouping)
+    def _get_colormap(self):
+        """
+        Return the colormap of a legend grouping.
+        """
+        # If input is not a legend, interpret input as legend json data
+        if not isinstance(self.grouping, Legend):
+            self.grouping = Legend(json=self.grouping)
 
-                # Try getting a colormap from the input
-                try:
-                    colormap = self.grouping.colormap
-                except:
-                    raise RasterAggregationException(
-                        'Invalid grouping value found for valuecount.'
-                    )
+        # Try getting a colormap from the input
+        try:
+            return self.grouping.colormap
+        except:
+            raise RasterAggregationException(
+                'Invalid grouping value found for valuecount.'
+            )
 
-                # Use colormap to compute value counts
-                formula_parser = FormulaParser()
-                values = {}
-                for key, color in colormap.items():
-                    try:
-                        # Try to use the key as number directly
-                        selector = result_data == float(key)
-                    except ValueError:
-                        # Otherwise use it as numpy expression directly
-                        selector = formula_parser.evaluate({'x': result_data}, key)
-                    values[key] = numpy.sum(selector)
+    def _get_counts(self, partial):
+        """
+        Set the statistics from a merged partial and return its value counts.
+        """
+        self._set_stats(partial)
+        return self._scale_counts(partial.counts)
 
-            # Add counts to results.
-            results.update(Counter(values))
-            # Push statistics.
-            self._push_stats(result_data)
+    def quantiles(self, fractions):
+        """
+        Estimate the quantiles of the values of the formula at the fractions,
+        which are numbers between 0 and 1. The quantiles are computed from
+        mergeable quantile sketches of the tiles in bounded memory. Returns a
+        list with the value of each fraction, or None if there are no values.
+        The statistics of the aggregator are updated in the same pass.
+        """
+        partial = self.aggregate([self.formula], count=False, sketch=True)[0]
+        self._set_stats(partial)
+        return partial.sketch.quantiles(fractions)
 
-        # Transform pixel count to acres if requested
-        scaling_factor = 1
-        if self.acres and self.rastgeom and len(results):
-            scaling_factor = abs(self.rastgeom.scale.x * self.rastgeom.scale.y) * 0.000247105381
+    def _scale_counts(self, results):
+        """
+        Convert pixel counts into acres if requested and format the keys.
+        """
+        scaling_factor = self._scaling_factor()
 
         results = {
-            str(int(k) if type(k) == numpy.float64 and int(k) == k else k):
-            v * scaling_factor for k, v in results.items()
+            self._format_key(k): v * scaling_factor for k, v in results.items()
         }
 
         return results
+
+    def _scaling_factor(self, zonal=False):
+        """
+        Return the factor that converts pixel counts into acres if requested.
+        Counts are converted for clip geometries and for zones.
+        """
+        if self.acres and (self.geom or zonal):
+            return tile_scale(self.zoom) ** 2 * 0.000247105381
+        return 1
+
+    @staticmethod
+    def _format_key(key):
+        # Integral values are formatted as integers at every precision
+        if isinstance(key, (float, numpy.floating, numpy.integer)) and float(key).is_integer():
+            return str(int(key))
+        return str(key)
+
+    def crosstab(self, first, second):
+        """
+        Compute the cross tabulation of the values of two formulas, such as
+        the change matrix of two categorical land cover layers. Returns a
+        nested dictionary with the pixel counts of the value pairs, keyed by
+        the values of the first and of the second formula. Only pixels where
+        both formulas are valid are counted. The counts are converted into
+        acres as in the value counts.
+        """
+        counts = Counter({})
+
+        # Count the value pairs of every tile on the pixels where both formulas are valid
+        tiles = self.map_tiles([first, second], lambda results: count_pairs(*results), joint=True)
+        for first_values, second_values, pair_counts in tiles:
+            counts.update(dict(zip(zip(first_values, second_values), pair_counts)))
+
+        scaling_factor = self._scaling_factor()
+
+        results = {}
+        for (first_value, second_value), count in counts.items():
+            results.setdefault(self._format_key(first_value), {})[self._format_key(second_value)] = count * scaling_factor
+
+        return results
+
+    def zonal_aggregate(self, zones, count=True, hist_ranges=None):
+        """
+        Compute the merged partial aggregation results of the formula in each
+        of a list of zone geometries, in a single pass over the tiles. Every
+        tile is read once, and the zones that intersect it are rasterized into
+        zone numbers in a rasterization per pass of zones that do not overlap.
+        Returns a list with the partial of each zone. Pixels that are covered
+        by several zones are included in each of these zones.
+        """
+        zones = [geom if geom.srid == WEB_MERCATOR_SRID else geom.transform(WEB_MERCATOR_SRID, clone=True) for geom in zones]
+
+        # Resolve legend groupings before the tiles are counted in parallel
+        if count and self.grouping not in ('discrete', 'continuous'):
+            self._get_colormap()
+
+        # Continuous value counts of every zone are binned over the range of its values
+        if count and self.grouping == 'continuous' and not self.hist_range and hist_ranges is None:
+            hist_ranges = [
+                None if partial.t0 == 0 else [float(partial.min_value), float(partial.max_value)]
+                for partial in self.zonal_aggregate(zones, count=False)
+            ]
+
+        results = [AggregationPartial() for geom in zones]
+
+        func = functools.partial(self._zone_partials, count=count, hist_ranges=hist_ranges)
+        for partials in self.map_tiles([self.formula], func, zones=zones):
+            for number, partial in partials.items():
+                results[number - 1].merge(partial)
+
+        return results
+
+    def _zone_partials(self, results, count=True, hist_ranges=None):
+        """
+        Compute the partial aggregation results of the zones on a tile from
+        the zone numbers and the values of its pixels. The values are sorted by
+        zone once, the statistics are grouped by zone with bincount and
+        reductions over the runs of the zones, and discrete values are counted
+        as pairs of zone numbers and values. Returns a dictionary with the
+        partials of the zones on the tile, keyed by zone number.
+        """
+        numbers, data = results
+
+        # Sort the values by zone, such that the values of every zone are contiguous
+        order = numpy.argsort(numbers, kind='stable')
+        numbers = numbers[order]
+        data = data[order]
+
+        partials = {}
+
+        # Filter the statistics by histogram range
+        stats_numbers, stats_data = numbers, data
+        if self.hist_range:
+            selected = (data >= self.hist_range[0]) & (data <= self.hist_range[1])
+            stats_numbers, stats_data = numbers[selected], data[selected]
+
+        # Compute the incremental statistics of every zone
+        zone_numbers, starts = self._zone_runs(stats_numbers)
+        if zone_numbers.size:
+            t0 = numpy.diff(numpy.append(starts, stats_data.size))
+            t1 = numpy.bincount(stats_numbers, weights=stats_data)[zone_numbers]
+            t2 = numpy.bincount(stats_numbers, weights=numpy.square(stats_data, dtype='float64'))[zone_numbers]
+            max_values = numpy.maximum.reduceat(stats_data, starts)
+            min_values = numpy.minimum.reduceat(stats_data, starts)
+            for index, number in enumerate(zone_numbers.tolist()):
+                partials[number] = AggregationPartial()
+                partials[number].merge_stats(t0[index], t1[index], t2[index], max_values[index], min_values[index])
+
+        if not count:
+            return partials
+
+        if self.grouping == 'discrete':
+            # Count the pairs of zone numbers and values
+            for number, value, value_count in zip(*count_pairs(numbers, data)):
+                partials.setdefault(int(number), AggregationPartial()).counts[value] += value_count
+        else:
+            # Count the values of every zone separately
+            zone_numbers, starts = self._zone_runs(numbers)
+            ends = numpy.append(starts[1:], data.size)
+            for number, start, end in zip(zone_numbers.tolist(), starts, ends):
+                hist_range = hist_ranges[number - 1] if hist_ranges else None
+                counts = self._count_values(data[start:end], hist_range)
+                partials.setdefault(number, AggregationPartial()).counts.update(Counter(counts))
+
+        return partials
+
+    @staticmethod
+    def _zone_runs(numbers):
+        """
+        Return the zone numbers and the start indices of the runs of a sorted
+        array of zone numbers.
+        """
+        starts = numpy.flatnonzero(numpy.diff(numbers, prepend=0))
+        return numbers[starts], starts
+
+    def zonal_value_count(self, zones):
+        """
+        Compute the value counts of the formula in every zone of a dictionary
+        of zone geometries, keyed by zone id. Returns a dictionary with the
+        value counts of each zone, see value_count. The counts are converted
+        into acres if requested.
+        """
+        partials = self.zonal_aggregate(list(zones.values()))
+        scaling_factor = self._scaling_factor(zonal=True)
+        return {
+            zone: {self._format_key(k): v * scaling_factor for k, v in partial.counts.items()}
+            for zone, partial in zip(zones, partials)
+        }
+
+    def zonal_statistics(self, zones):
+        """
+        Compute the statistics of the formula in every zone of a dictionary of
+        zone geometries, keyed by zone id. Returns a dictionary with the
+        statistics (min, max, mean, std) of each zone, see statistics.
+        """
+        partials = self.zonal_aggregate(list(zones.values()), count=False)
+        aggregators = self._formula_aggregators([self.formula] * len(partials))
+
+        for aggregator, partial in zip(aggregators, partials):
+            aggregator._set_stats(partial)
+
+        return {zone: aggregator._get_stats() for zone, aggregator in zip(zones, aggregators)}
+
+    def sample_tiles(self, max_pixels=None, seed=0):
+        """
+        Draw a simple random sample of tiles from the tile range, with at most
+        the number of pixels of the budget. The budget defaults to the
+        RASTER_AGGREGATION_SAMPLE_PIXELS setting. Returns the list of the
+        indices of the sampled tiles and the number of tiles in the range.
+        """
+        population_size = self.tile_count()
+        if not population_size:
+            return [], 0
+
+        xmin, ymin, xmax, ymax = self.tilerange
+        width = xmax - xmin + 1
+
+        max_pixels = max_pixels or getattr(settings, 'RASTER_AGGREGATION_SAMPLE_PIXELS', AGGREGATION_SAMPLE_PIXELS)
+        sample_size = min(population_size, max(1, max_pixels // WEB_MERCATOR_TILESIZE ** 2))
+
+        indices = numpy.random.default_rng(seed).choice(population_size, sample_size, replace=False)
+        tiles = sorted((xmin + int(index) % width, ymin + int(index) // width) for index in indices)
+        return tiles, population_size
+
+    def _sample_partials(self, tiles, count=True, hist_ranges=None):
+        """
+        Return the partial aggregation results of the formula on the tiles of
+        a sample that have data.
+        """
+        func = functools.partial(self._tile_partials, count=count, hist_ranges=hist_ranges)
+        return [partials[0] for partials in self.map_tiles([self.formula], func, tiles=tiles)]
+
+    def approximate_value_count(self, max_pixels=None, confidence=0.95, seed=0):
+        """
+        Estimate the value counts from a random sample of the tiles, within a
+        budget of pixels to read. Returns the estimated value counts and the
+        half widths of their confidence intervals at the confidence level, as
+        dictionaries keyed like the value counts. The estimates are exact if
+        the budget covers the tile range. Continuous value counts without
+        histogram range are binned over the range of the sampled values.
+        """
+        tiles, population_size = self.sample_tiles(max_pixels, seed)
+
+        # Resolve legend groupings before the tiles are counted in parallel
+        if self.grouping not in ('discrete', 'continuous'):
+            self._get_colormap()
+
+        hist_ranges = None
+        if self.grouping == 'continuous' and not self.hist_range:
+            partial = functools.reduce(AggregationPartial.merge, self._sample_partials(tiles, count=False), AggregationPartial())
+            hist_ranges = [None if partial.t0 == 0 else [float(partial.min_value), float(partial.max_value)]]
+
+        partials = self._sample_partials(tiles, hist_ranges=hist_ranges)
+
+        scaling_factor = self._scaling_factor()
+
+        counts = {}
+        errors = {}
+        for key in set().union(*(partial.counts for partial in partials)):
+            values = [partial.counts[key] for partial in partials]
+            total, error = estimate_total(values, len(tiles), population_size, confidence)
+            counts[self._format_key(key)] = total * scaling_factor
+            errors[self._format_key(key)] = error * scaling_factor
+
+        return counts, errors
+
+    def approximate_statistics(self, max_pixels=None, confidence=0.95, seed=0):
+        """
+        Estimate the statistics from a random sample of the tiles, within a
+        budget of pixels to read. Returns the statistics (min, max, mean, std)
+        of the sampled values and the half width of the confidence interval of
+        the mean at the confidence level. The minimum and maximum of the sample
+        are within the range of all values.
+        """
+        tiles, population_size = self.sample_tiles(max_pixels, seed)
+        partials = self._sample_partials(tiles, count=False)
+
+        aggregator = self._formula_aggregators([self.formula])[0]
+        aggregator._set_stats(functools.reduce(AggregationPartial.merge, partials, AggregationPartial()))
+
+        error = estimate_mean_error(
+            [partial.t0 for partial in partials], [partial.t1 for partial in partials],
+            len(tiles), population_size, confidence,
+        )
+        return aggregator._get_stats(), error
+
+    def _formula_aggregators(self, formulas):
+        """
+        Return a copy of this aggregator for each formula, which hold the
+        statistics of the formula in multi formula aggregations.
+        """
+        aggregators = []
+        for formula in formulas:
+            aggregator = copy.copy(self)
+            aggregator.formula = formula
+            aggregator._clear_stats()
+            aggregators.append(aggregator)
+        return aggregators
+
+    def value_count_multi(self, formulas):
+        """
+        Compute value counts for several formulas in a single pass over the
+        tiles. Every tile is read once and all formulas are evaluated on it,
+        sharing their common subexpressions. Returns a list with the value
+        counts of each formula, see value_count.
+        """
+        aggregators = self._formula_aggregators(formulas)
+        partials = self.aggregate(formulas)
+        return [aggregator._get_counts(partial) for aggregator, partial in zip(aggregators, partials)]
+
+    def statistics_multi(self, formulas):
+        """
+        Compute statistics for several formulas in a single pass over the
+        tiles. Returns a list with the statistics (min, max, mean, std) of
+        each formula, see statistics.
+        """
+        aggregators = self._formula_aggregators(formulas)
+        partials = self.aggregate(formulas, count=False)
+
+        for aggregator, partial in zip(aggregators, partials):
+            aggregator._set_stats(partial)
+
+        return [aggregator._get_stats() for aggregator in aggregators]
+
+
+def json_value(value):
+    """
+    Convert numpy scalars into plain json serializable values.
+    """
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
+def aggregation_result(aggregator, partial=None):
+    """
+    Compute the value counts and statistics of an aggregator. The statistics
+    are collected while the values are counted, continuous groupings without
+    histogram range read the tiles twice, first for the value range of the
+    histogram bins. The value counts are taken from the merged partial result
+    of the formula if it is given. Returns a json serializable dictionary with
+    the zoom level of the aggregation, the value counts and the statistics.
+    """
+    value_count = aggregator.value_count() if partial is None else aggregator._get_counts(partial)
+    minimum, maximum, mean, std = aggregator.statistics()
+    return {
+        'zoom': aggregator.zoom,
+        'value_count': {key: json_value(value) for key, value in value_count.items()},
+        'statistics': {
+            'min': json_value(minimum),
+            'max': json_value(maximum),
+            'mean': json_value(mean),
+            'std': json_value(std),
+        },
+    }
+
+
+def job_aggregator(aggregation):
+    """
+    Return the aggregator of a raster aggregation job.
+    """
+    parameters = json.loads(aggregation.parameters)
+    return Aggregator.from_task_parameters(parameters['aggregator'])
+
+
+def finish_aggregation(aggregation_id, result):
+    """
+    Store the result of a raster aggregation job, unless the job was cancelled
+    in the meantime.
+    """
+    RasterAggregation.objects.filter(id=aggregation_id, status=RasterAggregation.RUNNING).update(
+        result=json.dumps(result),
+        status=RasterAggregation.FINISHED,
+        tiles_done=F('tiles_total'),
+    )
+
+
+def run_aggregation(aggregation):
+    """
+    Compute the result of a raster aggregation job and store it on the job.
+    The progress of the job is updated while the tiles are aggregated, and the
+    aggregation stops if the job is no longer running.
+
+    If celery is used, tile ranges with more than one part are aggregated in
+    parallel subtasks instead. The job is continued by a callback that merges
+    the partial results of the parts, see merge_aggregation.
+    """
+    aggregator = job_aggregator(aggregation)
+
+    parallel = getattr(settings, 'RASTER_USE_CELERY', False) and len(aggregator.task_tileranges()) > 1
+    if parallel and not aggregator.use_database([aggregator.formula]):
+        from raster.tasks import aggregate_parts
+        count = aggregator.grouping != 'continuous' or bool(aggregator.hist_range)
+        # Continuous groupings first merge the value range of all parts
+        aggregate_parts(aggregation.id, aggregator, count=count)
+        return
+
+    # Update the progress about every percent of the tiles
+    step = max(1, aggregation.tiles_total // 100)
+    state = {'done': 0, 'saved': 0}
+
+    def progress(tiles):
+        state['done'] += tiles
+        if state['done'] - state['saved'] < step:
+            return
+        state['saved'] = state['done']
+        updated = RasterAggregation.objects.filter(id=aggregation.id, status=RasterAggregation.RUNNING).update(
+            tiles_done=min(state['done'], aggregation.tiles_total),
+        )
+        if not updated:
+            raise RasterAggregationCancelled()
+
+    aggregator.progress = progress
+    finish_aggregation(aggregation.id, aggregation_result(aggregator))
+
+
+def merge_aggregation(aggregation_id, parts, count=True):
+    """
+    Merge the serialized partial results of the parts of a raster aggregation
+    job that were aggregated in subtasks. Merged value ranges of continuous
+    groupings start the value counts in the histogram range of the values,
+    merged value counts finish the job. Parts that were skipped because the
+    job is no longer running stop the aggregation.
+    """
+    if None in parts:
+        return
+
+    aggregation = RasterAggregation.objects.get(id=aggregation_id)
+    aggregator = job_aggregator(aggregation)
+
+    partial = AggregationPartial()
+    for partials in parts:
+        partial.merge(AggregationPartial.deserialize(partials[0]))
+
+    if count:
+        finish_aggregation(aggregation_id, aggregation_result(aggregator, partial))
+    else:
+        from raster.tasks import aggregate_parts
+        hist_range = None if partial.t0 == 0 else [float(partial.min_value), float(partial.max_value)]
+        aggregate_parts(aggregation_id, aggregator, hist_ranges=[hist_range])
@@ -1,11 +1,9 @@
+import hashlib
 import io
 import json
 import os
 import re
 import uuid
-import zipfile
-from datetime import datetime
-from tempfile import NamedTemporaryFile
 
 import numpy
 from PIL import Image
@@ -13,23 +11,37 @@ from PIL import Image
 from django.conf import settings
 from django.contrib.gis.gdal import GDALRaster
 from django.contrib.gis.gdal.raster.const import VSI_FILESYSTEM_BASE_PATH
-from django.contrib.gis.geos import Polygon
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Polygon
 from django.db.models import Max, Q
-from django.http import FileResponse, Http404, HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import slugify
+from django.urls import reverse
+from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
+from django.views.decorators.csrf import csrf_protect
 from django.views.generic import View
-from raster.algebra.const import ALGEBRA_PIXEL_TYPE_GDAL, BAND_INDEX_SEPARATOR
+from raster import tasks
+from raster.algebra.const import BAND_INDEX_SEPARATOR
 from raster.algebra.parser import RasterAlgebraParser
-from raster.const import EXPORT_MAX_PIXELS, IMG_ENHANCEMENTS, IMG_FORMATS, MAX_EXPORT_NAME_LENGTH, README_TEMPLATE
-from raster.exceptions import RasterAlgebraException
-from raster.models import Legend, RasterLayer, RasterLayerBandMetadata, RasterLayerMetadata
+from raster.colormaps import colormap_registry
+from raster.const import (
+    AGGREGATION_SYNC_TILES, EXPORT_FORMAT_COG, EXPORT_FORMATS, EXPORT_MAX_PIXELS, IMG_ENHANCEMENTS, IMG_FORMATS,
+    MAX_EXPORT_NAME_LENGTH
+)
+from raster.exceptions import RasterAggregationException, RasterAlgebraException
+from raster.export import archive_names, stream_archive
+from raster.models import (
+    Legend, RasterAggregation, RasterExport, RasterLayer, RasterLayerBandMetadata, RasterLayerMetadata
+)
 from raster.shortcuts import get_session_colormap
 from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
-from raster.tiles.lookup import get_raster_tile
-from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
-from raster.utils import band_data_to_image, colormap_to_rgba, pixel_value_from_point
+from raster.tiles.lookup import get_raster_tile, get_raster_tile_with_halo
+from raster.tiles.utils import tile_index_range
+from raster.utils import (
+    band_data_to_image, colormap_to_rgba, parse_byte_range, pixel_value_from_point, read_file_range
+)
+from raster.valuecount import Aggregator, aggregation_result
 
 
 class RasterView(View):
@@ -67,17 +79,22 @@ class RasterView(View):
 
                 # Try to get legend by id, name or from input layer
                 if isinstance(legend_input, int):
-                    legend = get_object_or_404(Legend, id=legend_input)
+                    colormap = colormap_registry.get(
+                        ('legend', legend_input),
+                        lambda: get_object_or_404(Legend, id=legend_input).colormap,
+                    )
                 else:
-                    legend = Legend.objects.filter(title__iexact=legend_input).first()
-                colormap = legend.colormap
+                    colormap = colormap_registry.get(
+                        ('title', legend_input.lower()),
+                        lambda: Legend.objects.filter(title__iexact=legend_input).first().colormap,
+                    )
 
         elif 'layer' in self.kwargs:
             # Get legend for the input layer.
-            legend = Legend.objects.filter(rasterlayer=self.kwargs.get('layer')).first()
-
-            if legend and hasattr(legend, 'colormap'):
-                colormap = legend.colormap
+            colormap = colormap_registry.get(
+                ('layer', str(self.kwargs.get('layer'))),
+                self.get_layer_legend_colormap,
+            )
 
         if not colormap:
             # Use a continous grayscale color scheme.
@@ -90,9 +107,12 @@ class RasterView(View):
             # Add layer level value range to continuous colormaps if it was
             # not provided manually.
             if 'continuous' in colormap and 'range' not in colormap:
-                meta = RasterLayerBandMetadata.objects.filter(rasterlayer_id=self.kwargs.get('layer')).first()
-                if meta:
-                    colormap['range'] = (meta.min, meta.max)
+                value_range = colormap_registry.get(
+                    ('range', str(self.kwargs.get('layer'))),
+                    self.get_layer_value_range,
+                )
+                if value_range:
+                    colormap['range'] = value_range
 
             # Filter by custom entries if requested
             if colormap and 'entries' in self.request.GET:
@@ -101,6 +121,23 @@ class RasterView(View):
 
         return colormap
 
+    def get_layer_legend_colormap(self):
+        """
+        Returns the colormap of the legend assigned to the requested layer.
+        """
+        legend = Legend.objects.filter(rasterlayer=self.kwargs.get('layer')).first()
+
+        if legend and hasattr(legend, 'colormap'):
+            return legend.colormap
+
+    def get_layer_value_range(self):
+        """
+        Returns the value range of the requested layer from band metadata.
+        """
+        meta = RasterLayerBandMetadata.objects.filter(rasterlayer_id=self.kwargs.get('layer')).first()
+        if meta:
+            return (meta.min, meta.max)
+
     def get_format(self):
         """
         Returns image format requested.
@@ -133,10 +170,11 @@ class RasterView(View):
             response['aggregation'] = json.dumps(stats)
             return response
 
-    def get_tile(self, layer_id, zlevel=None):
+    def get_tile(self, layer_id, zlevel=None, halo=0):
         """
         Returns a tile for rendering. If the tile does not exists, higher
-        level tiles are searched and warped to lower level if found.
+        level tiles are searched and warped to lower level if found. If a
+        halo is requested, the tile is padded with pixels from its neighbors.
         """
         if self.is_pixel_request:
             tilez = self.max_zoom
@@ -153,6 +191,9 @@ class RasterView(View):
             tilex = int(self.kwargs.get('x'))
             tiley = int(self.kwargs.get('y'))
 
+        if halo:
+            return get_raster_tile_with_halo(layer_id, tilez, tilex, tiley, halo)
+
         return get_raster_tile(layer_id, tilez, tilex, tiley)
 
     def get_layer(self):
@@ -232,8 +273,16 @@ class AlgebraView(RasterView):
             return self.request.GET.get('formula', None)
 
     def get(self, request, *args, **kwargs):
-        # Get layer ids
+        # Get formula from request
+        formula = self.get_formula()
+
+        # Get layer ids, skipping layers that the formula does not use
         ids = self.get_ids()
+        if formula:
+            ids = RasterAlgebraParser().referenced_layers(ids, formula)
+
+        # Neighborhood functions require tiles with a halo of neighbor pixels
+        halo = RasterAlgebraParser().get_halo(formula) if formula else 0
 
         # Prepare unique list of layer ids to be efficient if the same layer
         # is used multiple times (for band access for instance).
@@ -242,7 +291,7 @@ class AlgebraView(RasterView):
         # Get the tiles for each unique layer.
         tiles = {}
         for layerid in layerids:
-            tile = self.get_tile(layerid)
+            tile = self.get_tile(layerid, halo=halo)
             if tile:
                 tiles[layerid] = tile
             else:
@@ -255,9 +304,6 @@ class AlgebraView(RasterView):
         for name, layerid in ids.items():
             data[name] = tiles[layerid]
 
-        # Get formula from request
-        formula = self.get_formula()
-
         # Dispatch by request type. If a formula was provided, use raster
         # algebra otherwise look for rgb request.
         if formula:
@@ -274,10 +320,20 @@ class AlgebraView(RasterView):
     def get_algebra(self, data, formula):
         parser = RasterAlgebraParser()
 
+        # Neighborhood functions are evaluated on tiles with a halo
+        halo = parser.get_halo(formula)
+
+        # Pixel value and tif requests require the algebra result as raster.
+        # Image requests are rendered from the result data and its validity.
+        as_raster = self.is_pixel_request or self.kwargs.get('frmt') == 'tif'
+
         # Evaluate raster algebra expression, return 400 if not successful
         try:
             # Evaluate raster algebra expression
-            result = parser.evaluate_raster_algebra(data, formula)
+            if as_raster:
+                result = parser.evaluate_raster_algebra(data, formula, halo=halo)
+            else:
+                result, valid, nodata = parser.evaluate_raster_data(data, formula, halo=halo)
         except:
             raise RasterAlgebraException('Failed to evaluate raster algebra.')
 
@@ -302,20 +358,15 @@ class AlgebraView(RasterView):
             content_type = IMG_FORMATS['tif'][1]
             return HttpResponse(rast.vsi_buffer, content_type)
 
-        # Get array from algebra result
-        if result.bands[0].nodata_value is None:
-            result = result.bands[0].data()
-        else:
-            result = numpy.ma.masked_values(
-                result.bands[0].data(),
-                result.bands[0].nodata_value,
-            )
+        # Reshape the flat result data to the tile shape
+        orig = list(data.values())[0]
+        result = result.reshape(orig.height - 2 * halo, orig.width - 2 * halo)
 
         # Get colormap.
         colormap = self.get_colormap()
 
         # Render tile using the legend data
-        img, stats = band_data_to_image(result, colormap)
+        img, stats = band_data_to_image(result, colormap, valid, nodata)
 
         # Return rendered image
         return self.write_img_to_response(img, stats)
@@ -451,40 +502,11 @@ class LegendView(RasterView):
 
 
 class ExportView(AlgebraView):
-
-    def construct_raster(self, z, xmin, xmax, ymin, ymax):
-        """
-        Create an empty tif raster file on disk using the input tile range. The
-        new raster aligns with the xyz tile scheme and can be filled
-        sequentially with raster algebra results.
-        """
-        # Compute bounds and scale to construct raster.
-        bounds = []
-        for x in range(xmin, xmax + 1):
-            for y in range(ymin, ymax + 1):
-                bounds.append(tile_bounds(x, y, z))
-        bounds = [
-            min([bnd[0] for bnd in bounds]),
-            min([bnd[1] for bnd in bounds]),
-            max([bnd[2] for bnd in bounds]),
-            max([bnd[3] for bnd in bounds]),
-        ]
-        scale = tile_scale(z)
-        # Create tempfile.
-        raster_workdir = getattr(settings, 'RASTER_WORKDIR', None)
-        self.exportfile = NamedTemporaryFile(dir=raster_workdir, suffix='.tif')
-        # Instantiate raster using the tempfile path.
-        return GDALRaster({
-            'srid': WEB_MERCATOR_SRID,
-            'width': (xmax - xmin + 1) * WEB_MERCATOR_TILESIZE,
-            'height': (ymax - ymin + 1) * WEB_MERCATOR_TILESIZE,
-            'scale': (scale, -scale),
-            'origin': (bounds[0], bounds[3]),
-            'driver': 'tif',
-            'bands': [{'data': [0], 'nodata_value': 0}],
-            'name': self.exportfile.name,
-            'datatype': ALGEBRA_PIXEL_TYPE_GDAL,
-        })
+    """
+    A view to create raster algebra exports. Exports run as asynchronous jobs,
+    the view returns the status of the export job. Finished exports with
+    identical parameters and unchanged layers are reused.
+    """
 
     def get_tile_range(self):
         """
@@ -520,7 +542,7 @@ class ExportView(AlgebraView):
             ]
         return [zlevel, ] + tile_range
 
-    def write_colormap(self, zfile):
+    def get_colormap_file(self):
         # Try to get colormap
         colormap = self.get_colormap()
         # Set a simple header for this colormap
@@ -530,10 +552,13 @@ class ExportView(AlgebraView):
         # Add expressions and colors of the colormap
         for key, val in colormap.items():
             colorstr += str(key) + ',' + ','.join((str(x) for x in val)) + ',' + str(key) + '\n'
-        # Write colormap file
-        zfile.writestr('COLORMAP.txt', colorstr)
+        return colorstr
 
-    def write_readme(self, zfile):
+    def get_readme_data(self):
+        """
+        Returns the readme data of the export, the creation datetime is added
+        when the readme is written.
+        """
         # Get tile index range
         zoom, xmin, ymin, xmax, ymax = self.get_tile_range()
         # Construct layer names string
@@ -549,9 +574,7 @@ class ExportView(AlgebraView):
         description = self.request.GET.get('description', '')
         if description:
             description += '\n'
-        # Initiate metadata object
-        readmedata = {
-            'datetime': datetime.now().strftime('%Y-%m-%d at %H:%M'),
+        return {
             'url': self.request.build_absolute_uri(),
             'bbox': self.request.GET.get('bbox', 'Minimum bounding-box covering all layers.'),
             'formula': self.request.GET.get('formula'),
@@ -561,83 +584,301 @@ class ExportView(AlgebraView):
             'layers': layerstr,
             'description': description,
         }
-        # Write readme file
-        readme = README_TEMPLATE.format(**readmedata)
-        zfile.writestr('README.txt', readme)
 
-    def get(self, request):
-        # Initiate algebra parser
-        parser = RasterAlgebraParser()
-        # Get formula from request
-        formula = request.GET.get('formula')
-        # Get id list from request
-        ids = self.get_ids()
-        # Compute tile index range
-        zoom, xmin, ymin, xmax, ymax = self.get_tile_range()
-        # Check maximum size of target raster in pixels
-        max_pixels = getattr(settings, 'RASTER_EXPORT_MAX_PIXELS', EXPORT_MAX_PIXELS)
-        if WEB_MERCATOR_TILESIZE * (xmax - xmin) * WEB_MERCATOR_TILESIZE * (ymax - ymin) > max_pixels:
-            raise RasterAlgebraException('Export raster too large.')
-        # Construct an empty raster with the output dimensions
-        result_raster = self.construct_raster(zoom, xmin, xmax, ymin, ymax)
-        target = result_raster.bands[0]
-        # Get raster data as 1D arrays and store in dict that can be used
-        # for formula evaluation.
-        for xindex, x in enumerate(range(xmin, xmax + 1)):
-            for yindex, y in enumerate(range(ymin, ymax + 1)):
-                data = {}
-                for name, layerid in ids.items():
-                    tile = get_raster_tile(layerid, zoom, x, y)
-                    if tile:
-                        data[name] = tile
-                # Ignore this tile if data is not found for all layers
-                if len(data) != len(ids):
-                    continue
-                # Evaluate raster algebra expression, return 400 if not successful
-                try:
-                    # Evaluate raster algebra expression
-                    tile_result = parser.evaluate_raster_algebra(data, formula)
-                except:
-                    raise RasterAlgebraException('Failed to evaluate raster algebra.')
-                # Update nodata value on target
-                target.nodata_value = tile_result.bands[0].nodata_value
-                # Update results raster with algebra
-                target.data(
-                    data=tile_result.bands[0].data(),
-                    size=(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE),
-                    offset=(xindex * WEB_MERCATOR_TILESIZE, yindex * WEB_MERCATOR_TILESIZE),
-                )
-        # Create filename base with datetime stamp
+    def get_filename(self):
+        # Create filename base, the datetime stamp is added on export
         filename_base = 'algebra_export'
         # Add name slug to filename if provided
-        if request.GET.get('filename', ''):
+        if self.request.GET.get('filename', ''):
             # Sluggify name
-            slug = slugify(request.GET.get('filename'))
+            slug = slugify(self.request.GET.get('filename'))
             # Remove all unwanted characters
             slug = "".join([c for c in slug if re.match(r'\w|\-', c)])
             # Limit length of custom name slug
             slug = slug[:MAX_EXPORT_NAME_LENGTH]
             # Add name slug to filename base
             filename_base += '_' + slug
-        filename_base += '_{0}'.format(datetime.now().strftime('%Y_%m_%d_%H_%M'))
-        # Compress resulting raster file into a zip archive
-        raster_workdir = getattr(settings, 'RASTER_WORKDIR', None)
-        dest = NamedTemporaryFile(dir=raster_workdir, suffix='.zip')
-        dest_zip = zipfile.ZipFile(dest.name, 'w', allowZip64=True)
-        dest_zip.write(
-            filename=self.exportfile.name,
-            arcname=filename_base + '.tif',
-            compress_type=zipfile.ZIP_DEFLATED,
-        )
-        # Write README.txt and COLORMAP.txt files to zip file
-        self.write_readme(dest_zip)
-        self.write_colormap(dest_zip)
-        # Close zip file before returning
-        dest_zip.close()
-        # Create file based response containing zip file and return for download
-        response = FileResponse(
-            open(dest.name, 'rb'),
-            content_type='application/zip'
-        )
-        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename_base + '.zip')
+        return filename_base
+
+    def get(self, request):
+        # Get formula from request
+        formula = request.GET.get('formula')
+        # Get id list from request, skipping layers that the formula does not use
+        ids = RasterAlgebraParser().referenced_layers(self.get_ids(), formula)
+        # Compute tile index range
+        zoom, xmin, ymin, xmax, ymax = self.get_tile_range()
+        # Check maximum size of target raster in pixels
+        max_pixels = getattr(settings, 'RASTER_EXPORT_MAX_PIXELS', EXPORT_MAX_PIXELS)
+        if WEB_MERCATOR_TILESIZE * (xmax - xmin) * WEB_MERCATOR_TILESIZE * (ymax - ymin) > max_pixels:
+            raise RasterAlgebraException('Export raster too large.')
+        # Get the export format
+        export_format = request.GET.get('format', EXPORT_FORMATS[0])
+        if export_format not in EXPORT_FORMATS:
+            raise RasterAlgebraException('Export format is not valid.')
+        # Collect the export parameters, the modification dates of the layers
+        # identify the layer versions.
+        readme = self.get_readme_data()
+        parameters = {
+            'format': export_format,
+            'ids': ids,
+            'formula': formula,
+            'tile_range': [zoom, xmin, ymin, xmax, ymax],
+            'filename': self.get_filename(),
+            'colormap': self.get_colormap_file(),
+            'readme': readme,
+            'precision': RasterAlgebraParser().get_precision(),
+            'versions': {
+                str(layer.id): layer.modified.isoformat()
+                for layer in RasterLayer.objects.filter(id__in=self.get_ids().values())
+            },
+        }
+        # Stream the archive into the response without creating an export job
+        if request.GET.get('stream', ''):
+            if export_format == EXPORT_FORMAT_COG:
+                raise RasterAlgebraException('Cloud optimized GeoTIFF exports can not be streamed.')
+            filename_base, readme = archive_names(parameters)
+            response = StreamingHttpResponse(
+                stream_archive(parameters, filename_base, readme),
+                content_type='application/zip',
+            )
+            response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename_base + '.zip')
+            return response
+        # Compute the export key, ignoring the request url
+        key = json.dumps(dict(parameters, readme=dict(readme, url=None)), sort_keys=True)
+        key = hashlib.sha256(key.encode()).hexdigest()
+        # Reuse exports with the same key unless they failed or were cancelled
+        export = RasterExport.objects.filter(
+            key=key,
+            status__in=(RasterExport.PENDING, RasterExport.RUNNING, RasterExport.FINISHED),
+        ).order_by('-created').first()
+        if export is None:
+            export = RasterExport.objects.create(
+                key=key,
+                parameters=json.dumps(parameters),
+                tiles_total=(xmax - xmin + 1) * (ymax - ymin + 1),
+            )
+            tasks.export(export.id)
+            export.refresh_from_db()
+        return export_status_response(request, export)
+
+
+def export_status_response(request, export):
+    """
+    Returns the status of an export job as json, including the download url
+    of finished exports.
+    """
+    status = {
+        'id': export.id,
+        'status': export.get_status_display(),
+        'tiles_done': export.tiles_done,
+        'tiles_total': export.tiles_total,
+        'url': request.build_absolute_uri(reverse('export-status', kwargs={'export_id': export.id})),
+    }
+    if export.status == RasterExport.FINISHED:
+        status['download'] = request.build_absolute_uri(reverse('export-download', kwargs={'export_id': export.id}))
+    return HttpResponse(json.dumps(status), content_type='application/json')
+
+
+class ExportStatusView(View):
+    """
+    A view to get the status of an export job.
+    """
+
+    def get(self, request, export_id):
+        export = get_object_or_404(RasterExport, id=export_id)
+        return export_status_response(request, export)
+
+
+@method_decorator(csrf_protect, name='dispatch')
+class ExportCancelView(View):
+    """
+    A view to cancel a pending or running export job. Cancellation requires
+    the CSRF token, also without the CSRF middleware.
+    """
+
+    def post(self, request, export_id):
+        export = get_object_or_404(RasterExport, id=export_id)
+        RasterExport.objects.filter(
+            id=export.id,
+            status__in=(RasterExport.PENDING, RasterExport.RUNNING),
+        ).update(status=RasterExport.CANCELLED)
+        export.refresh_from_db()
+        return export_status_response(request, export)
+
+
+class ExportDownloadView(View):
+    """
+    A view to download the archive of a finished export job. Single byte
+    ranges are supported, such that cloud optimized GeoTIFFs can be read
+    remotely.
+    """
+
+    def get(self, request, export_id):
+        export = get_object_or_404(RasterExport, id=export_id, status=RasterExport.FINISHED)
+        # Cloud optimized GeoTIFFs are served without archive
+        content_type = IMG_FORMATS['tif'][1] if export.filename.endswith('.tif') else 'application/zip'
+        archive = export.archive.open('rb')
+        size = export.archive.size
+        # Serve the requested range of bytes, for remote reading of rasters
+        try:
+            byte_range = parse_byte_range(request.META.get('HTTP_RANGE', ''), size)
+        except ValueError:
+            archive.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+        if byte_range is None:
+            response = FileResponse(archive, content_type=content_type)
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_file_range(archive, start, end), status=206, content_type=content_type)
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, size)
+            response['Content-Length'] = str(end - start + 1)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(export.filename)
         return response
+
+
+class AggregationView(AlgebraView):
+    """
+    A view to compute value counts and statistics of raster algebra over an
+    area. Aggregations over a small number of tiles are computed in the
+    request and returned as json. Larger aggregations run as asynchronous
+    jobs, the view returns the status of the job. Finished aggregations with
+    identical parameters and unchanged layers are reused.
+    """
+
+    def get_geom(self):
+        """
+        Parse the geometry parameter from WKT, EWKT or GeoJSON. Geometries
+        without spatial reference are interpreted as WGS84 coordinates.
+        """
+        geom = self.request.GET.get('geom', None)
+        if not geom:
+            return None
+        try:
+            geom = GEOSGeometry(geom)
+        except (ValueError, GEOSException):
+            raise RasterAlgebraException('Geometry parameter is not valid.')
+        if geom.srid is None:
+            geom.srid = 4326
+        return geom
+
+    def get_aggregator(self):
+        formula = self.get_formula()
+        if not formula:
+            raise RasterAlgebraException('Formula parameter is required.')
+        # Get id list from request, skipping layers that the formula does not use
+        ids = RasterAlgebraParser().referenced_layers(self.get_ids(), formula)
+        if RasterLayer.objects.filter(id__in=ids.values()).count() < len(set(ids.values())):
+            raise Http404('Raster layer does not exist.')
+        # Establish zoom level, defaults to the highest zoom level within the
+        # aggregation tile budget
+        zoom = self.request.GET.get('zoom', None)
+        try:
+            zoom = int(zoom) if zoom else None
+        except ValueError:
+            raise RasterAlgebraException('Zoom parameter is not valid.')
+        try:
+            return Aggregator(
+                layer_dict=ids,
+                formula=formula,
+                zoom=zoom,
+                geom=self.get_geom(),
+                acres=self.request.GET.get('acres', '') in ('1', 'true', 'True'),
+                grouping=self.request.GET.get('grouping', 'auto'),
+            )
+        except RasterAggregationException as error:
+            raise RasterAlgebraException(str(error))
+
+    def get(self, request):
+        aggregator = self.get_aggregator()
+        tiles_total = aggregator.tile_count()
+        # Compute small aggregations directly and return the result
+        if tiles_total <= getattr(settings, 'RASTER_AGGREGATION_SYNC_TILES', AGGREGATION_SYNC_TILES):
+            try:
+                result = aggregation_result(aggregator)
+            except RasterAggregationException as error:
+                raise RasterAlgebraException(str(error))
+            return HttpResponse(json.dumps(result), content_type='application/json')
+        # Collect the aggregation parameters, the cache key of the aggregation
+        # identifies the layer versions and the colormap of legend groupings.
+        try:
+            version = aggregator.cache_key([aggregator.formula])
+        except RasterAggregationException as error:
+            raise RasterAlgebraException(str(error))
+        parameters = {
+            'aggregator': aggregator.task_parameters(),
+            'version': version,
+        }
+        key = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+        # Reuse aggregations with the same key unless they failed or were cancelled
+        aggregation = RasterAggregation.objects.filter(
+            key=key,
+            status__in=(RasterAggregation.PENDING, RasterAggregation.RUNNING, RasterAggregation.FINISHED),
+        ).order_by('-created').first()
+        if aggregation is None:
+            aggregation = RasterAggregation.objects.create(
+                key=key,
+                parameters=json.dumps(parameters),
+                tiles_total=tiles_total,
+            )
+            tasks.aggregation(aggregation.id)
+            aggregation.refresh_from_db()
+        return aggregation_status_response(request, aggregation)
+
+
+def aggregation_status_response(request, aggregation):
+    """
+    Returns the status of an aggregation job as json, including the result
+    url of finished aggregations.
+    """
+    kwargs = {'aggregation_id': aggregation.id}
+    status = {
+        'id': aggregation.id,
+        'status': aggregation.get_status_display(),
+        'tiles_done': aggregation.tiles_done,
+        'tiles_total': aggregation.tiles_total,
+        'url': request.build_absolute_uri(reverse('aggregation-status', kwargs=kwargs)),
+    }
+    if aggregation.status == RasterAggregation.FINISHED:
+        status['result'] = request.build_absolute_uri(reverse('aggregation-result', kwargs=kwargs))
+    return HttpResponse(json.dumps(status), content_type='application/json')
+
+
+class AggregationStatusView(View):
+    """
+    A view to get the status of an aggregation job.
+    """
+
+    def get(self, request, aggregation_id):
+        aggregation = get_object_or_404(RasterAggregation, id=aggregation_id)
+        return aggregation_status_response(request, aggregation)
+
+
+@method_decorator(csrf_protect, name='dispatch')
+class AggregationCancelView(View):
+    """
+    A view to cancel a pending or running aggregation job. Cancellation
+    requires the CSRF token, also without the CSRF middleware.
+    """
+
+    def post(self, request, aggregation_id):
+        aggregation = get_object_or_404(RasterAggregation, id=aggregation_id)
+        RasterAggregation.objects.filter(
+            id=aggregation.id,
+            status__in=(RasterAggregation.PENDING, RasterAggregation.RUNNING),
+        ).update(status=RasterAggregation.CANCELLED)
+        aggregation.refresh_from_db()
+        return aggregation_status_response(request, aggregation)
+
+
+class AggregationResultView(View):
+    """
+    A view to get the result of a finished aggregation job, which is stored
+    as json.
+    """
+
+    def get(self, request, aggregation_id):
+        aggregation = get_object_or_404(RasterAggregation, id=aggregation_id, status=RasterAggregation.FINISHED)
+        return HttpResponse(aggregation.result, content_type='application/json')
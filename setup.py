@@ -19,7 +19,7 @@ setup(
     long_description=long_description,
     long_description_content_type='text/x-rst',
     license='BSD',
-    packages=find_packages(exclude=('tests', )),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     include_package_data=True,
     install_requires=[
         'Django>=2.0',
@@ -30,6 +30,9 @@ setup(
         'pyparsing>=2.2.0',
         'boto3>=1.7.9',
     ],
+    extras_require={
+        'numexpr': ['numexpr>=2.6'],
+    },
     keywords=['django', 'raster', 'gis', 'gdal', 'celery', 'geo', 'spatial'],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from raster.models import RasterAggregation
+from tests.raster_testcase import RasterTestCase
+
+
+class RasterAggregationViewTests(RasterTestCase):
+
+    def request_aggregation(self, **params):
+        # Request the aggregation of the test layer at its highest zoom level
+        params = dict({'layers': 'a={0}'.format(self.rasterlayer.id), 'formula': 'a', 'zoom': 11}, **params)
+        return self.client.get(reverse('aggregation'), params)
+
+    def test_aggregation_sync(self):
+        response = self.request_aggregation()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        result = response.json()
+        self.assertEqual(result['zoom'], 11)
+        self.assertEqual(
+            result['value_count'],
+            {str(key): val for key, val in self.expected_totals.items()}
+        )
+        self.assertEqual(result['statistics']['min'], min(self.expected_totals))
+        self.assertEqual(result['statistics']['max'], max(self.expected_totals))
+        self.assertFalse(RasterAggregation.objects.exists())
+
+    def test_aggregation_geom(self):
+        # A geometry covering all tiles counts every pixel
+        geom = 'POLYGON((-90 10,-27 10,-27 45,-90 45,-90 10))'
+        response = self.request_aggregation(geom=geom)
+        result = response.json()
+        self.assertEqual(
+            result['value_count'],
+            {str(key): val for key, val in self.expected_totals.items()}
+        )
+
+    def test_aggregation_acres(self):
+        geom = 'POLYGON((-90 10,-27 10,-27 45,-90 45,-90 10))'
+        expected = {str(key): val for key, val in self.expected_totals.items()}
+        for value in ('false', '0', ''):
+            response = self.request_aggregation(geom=geom, acres=value)
+            self.assertEqual(response.json()['value_count'], expected)
+        response = self.request_aggregation(geom=geom, acres='true')
+        result = response.json()['value_count']
+        self.assertNotEqual(result, expected)
+
+    def test_aggregation_invalid_parameters(self):
+        self.assertEqual(self.request_aggregation(geom='invalid').status_code, 400)
+        self.assertEqual(self.request_aggregation(grouping='1234').status_code, 400)
+        with override_settings(RASTER_AGGREGATION_MAX_TILES=1):
+            self.assertEqual(self.request_aggregation().status_code, 400)
+
+    @override_settings(RASTER_AGGREGATION_SYNC_TILES=1)
+    def test_aggregation_job(self):
+        response = self.request_aggregation()
+        self.assertEqual(response.status_code, 200)
+        status = response.json()
+        self.assertEqual(status['status'], 'Finished')
+        self.assertEqual(status['tiles_done'], 4)
+        self.assertEqual(status['tiles_total'], 4)
+        # Get the result of the job
+        response = self.client.get(status['result'])
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(
+            result['value_count'],
+            {str(key): val for key, val in self.expected_totals.items()}
+        )
+        # The status url returns the same status
+        self.assertEqual(self.client.get(status['url']).json(), status)
+        # Identical requests reuse the job
+        self.assertEqual(self.request_aggregation().json()['id'], status['id'])
+        self.assertEqual(RasterAggregation.objects.count(), 1)
+        # Finished jobs can not be cancelled
+        url = reverse('aggregation-cancel', kwargs={'aggregation_id': status['id']})
+        self.assertEqual(self.client.post(url).json()['status'], 'Finished')
+
+    @override_settings(RASTER_AGGREGATION_SYNC_TILES=1)
+    def test_aggregation_job_legend_change(self):
+        status = self.request_aggregation(grouping=self.legend.id).json()
+        self.assertEqual(self.request_aggregation(grouping=self.legend.id).json()['id'], status['id'])
+        # Editing the legend entries creates a new job
+        entry = self.legend.legendentry_set.first()
+        entry.expression = '4'
+        entry.save()
+        self.assertNotEqual(self.request_aggregation(grouping=self.legend.id).json()['id'], status['id'])
+
+    @override_settings(RASTER_AGGREGATION_SYNC_TILES=1)
+    def test_aggregation_job_cancelled(self):
+        aggregation = RasterAggregation.objects.create(key='cancelled', parameters='{}')
+        url = reverse('aggregation-cancel', kwargs={'aggregation_id': aggregation.id})
+        self.assertEqual(self.client.post(url).json()['status'], 'Cancelled')
+        # Cancelled jobs have no result
+        url = reverse('aggregation-result', kwargs={'aggregation_id': aggregation.id})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_aggregation_cancel_csrf(self):
+        aggregation = RasterAggregation.objects.create(key='csrf', parameters='{}')
+        url = reverse('aggregation-cancel', kwargs={'aggregation_id': aggregation.id})
+        client = Client(enforce_csrf_checks=True)
+        # Requests without the token are rejected
+        self.assertEqual(client.post(url).status_code, 403)
+        aggregation.refresh_from_db()
+        self.assertEqual(aggregation.status, RasterAggregation.PENDING)
+        # Requests with the token of the cookie cancel the job
+        token = 'a' * 32
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+        response = client.post(url, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.json()['status'], 'Cancelled')
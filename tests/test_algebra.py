@@ -65,6 +65,86 @@ class RasterAlgebraParserTests(TestCase):
         result = parser.evaluate_raster_algebra({'x': self.data.pop('z')}, 'x')
         self.assertEqual(result.bands[0].data().ravel().tolist(), [30, 31, 32, 33])
 
+    def test_algebra_parser_raster_data(self):
+        parser = RasterAlgebraParser()
+        result, valid, nodata = parser.evaluate_raster_data(self.data2, 'x + y')
+        self.assertEqual(result.tolist(), [10, 32, 34, 36])
+        self.assertEqual(valid.tolist(), [False, True, True, True])
+        self.assertEqual(nodata, 10)
+
+    def test_algebra_parser_float32_precision(self):
+        parser = RasterAlgebraParser(precision='float32')
+        result = parser.evaluate_raster_algebra(self.data, 'x*(x>11) + 2*y + 3*z*(z==30)')
+        self.assertEqual(result.bands[0].datatype(), 6)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [10, 10, 14, 15])
+
+    def test_algebra_parser_auto_precision(self):
+        parser = RasterAlgebraParser(precision='auto')
+        # Byte sums are stored as unsigned 16 bit integers.
+        result = parser.evaluate_raster_algebra(self.data2, 'x + y')
+        self.assertEqual(result.bands[0].datatype(), 2)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [10, 32, 34, 36])
+        # Fractional results are stored as floats.
+        result = parser.evaluate_raster_algebra(self.data2, 'x / 4')
+        self.assertEqual(result.bands[0].datatype(), 7)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [5, 5.25, 5.5, 5.75])
+        # Comparisons are stored as bytes with a distinct nodata value.
+        result = parser.evaluate_raster_algebra(self.data2, 'y > 11')
+        self.assertEqual(result.bands[0].datatype(), 1)
+        self.assertEqual(result.bands[0].nodata_value, 255)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [255, 0, 1, 1])
+
+    def test_algebra_parser_multi_formula(self):
+        formulas = ['x*(x>11) + 2*y', 'x*(x>11) + 3*z', 'z > 31']
+        for precision in ('float64', 'auto'):
+            parser = RasterAlgebraParser(precision=precision)
+            results = parser.evaluate_raster_data_multi(self.data, formulas)
+            for formula, (result, valid, nodata) in zip(formulas, results):
+                expected = RasterAlgebraParser(precision=precision).evaluate_raster_data(self.data, formula)
+                self.assertEqual(result.tolist(), expected[0].tolist())
+                self.assertEqual(result.dtype, expected[0].dtype)
+                self.assertEqual(nodata, expected[2])
+
+    def test_algebra_parser_result_datatype(self):
+        # Datatypes and nodata values are inferred without evaluating the data
+        dtypes = {'x:0': 'uint8', 'y:1': 'uint8'}
+        nodata_values = {'x:0': 10, 'y:1': 10}
+        for precision in ('float64', 'float32', 'auto'):
+            for formula in ('x + y', 'x / 4', 'y > 11', 'x', 'x + 300'):
+                parser = RasterAlgebraParser(precision=precision)
+                result, valid, nodata = parser.evaluate_raster_data(self.data2, formula)
+                datatype, dtype, expected_nodata = parser.get_result_datatype(formula, dtypes, nodata_values)
+                self.assertEqual(result.dtype, dtype)
+                self.assertEqual(nodata, expected_nodata)
+
+    def test_algebra_parser_halo(self):
+        parser = RasterAlgebraParser()
+        self.assertEqual(parser.get_halo('x + 1'), 0)
+        self.assertEqual(parser.get_halo('focalmean(focalmax(x)) + slope(y)'), 2)
+        # Evaluating on a raster with a halo crops the result.
+        rast = GDALRaster({
+            'datatype': 1, 'driver': 'MEM', 'width': 4, 'height': 4, 'srid': 3086,
+            'origin': (500000, 400000), 'scale': (100, -100),
+            'bands': [{'data': range(16), 'nodata_value': 5}],
+        })
+        result = parser.evaluate_raster_algebra({'x': rast}, 'focalmax(x)', halo=1)
+        self.assertEqual((result.width, result.height), (2, 2))
+        self.assertEqual((result.origin.x, result.origin.y), (500100, 399900))
+        self.assertEqual(result.bands[0].nodata_value, 5)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [5, 11, 14, 15])
+
+    def test_algebra_parser_referenced_layers(self):
+        parser = RasterAlgebraParser()
+        # Unreferenced bands are not read, the band index of key a is invalid.
+        data = dict(self.data, **{'a:5': self.data['z']})
+        result = parser.evaluate_raster_algebra(data, 'x*(x>11) + 2*y + 3*z*(z==30)')
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [10, 10, 14, 15])
+        layers = {'x:1': 1, 'y': 2, 'z': 3}
+        self.assertEqual(parser.referenced_layers(layers, 'x + z*(2-2)'), {'x:1': 1, 'z': 3})
+        # Invalid formulas and constant formulas keep all layers.
+        self.assertEqual(RasterAlgebraParser().referenced_layers(layers, ''), layers)
+        self.assertEqual(parser.referenced_layers(layers, '1 + 2'), layers)
+
 
 class RasterAlgebraViewTests(RasterTestCase):
 
@@ -73,6 +153,12 @@ class RasterAlgebraViewTests(RasterTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIsExpectedTile(response.content, 'test_algebra_basic')
 
+    def test_neighborhood_algebra_request(self):
+        response = self.client.get(self.algebra_tile_url + '?layers=a={0}&formula=focalmean(a)'.format(self.rasterlayer.id))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.pixel_url + '?layers=a={0}&formula=focalmax(a)'.format(self.rasterlayer.id))
+        self.assertEqual(response.status_code, 200)
+
     def test_undeclared_variable_name_error(self):
         response = self.client.get(self.algebra_tile_url + '?layers=a={0}&formula=a*b'.format(self.rasterlayer.id))
         self.assertEqual(response.status_code, 400)
@@ -6,8 +6,14 @@ from zipfile import ZipFile
 
 import numpy
 
+from django.conf import settings
 from django.contrib.gis.gdal import GDALRaster
+from django.test import Client
+from django.test.utils import override_settings
 from django.urls import reverse
+from raster.export import export_datatype
+from raster.models import RasterExport
+from raster.tasks import export_raster
 from tests.raster_testcase import RasterTestCase
 
 
@@ -18,7 +24,7 @@ class RasterAlgebraViewTests(RasterTestCase):
         if hasattr(self, 'tmpdir'):
             shutil.rmtree(self.tmpdir)
 
-    def get_export(self, bbox=None, colormap=None, description=None, name=None, zoom=None):
+    def request_export(self, bbox=None, colormap=None, description=None, name=None, zoom=None, frmt=None, stream=False):
         # Setup the Get export url
         url = reverse('export')
         # Request export for a simple algebra formula
@@ -33,8 +39,21 @@ class RasterAlgebraViewTests(RasterTestCase):
             url += '&filename=' + name
         if zoom:
             url += '&zoom={}'.format(zoom)
-        # Request url and return response
-        return self.client.get(url)
+        if frmt:
+            url += '&format={}'.format(frmt)
+        if stream:
+            url += '&stream=1'
+        # Request url and return response, storing the archive in the media root
+        with self.settings(MEDIA_ROOT=self.media_root):
+            return self.client.get(url)
+
+    def get_export(self, **kwargs):
+        # Request the export and download the archive of the finished export
+        response = self.request_export(**kwargs)
+        if response.status_code != 200:
+            return response
+        with self.settings(MEDIA_ROOT=self.media_root):
+            return self.client.get(response.json()['download'])
 
     def unzip_response(self, response):
         # Create tempdir, extract result into it
@@ -42,9 +61,14 @@ class RasterAlgebraViewTests(RasterTestCase):
         self.zf = ZipFile(io.BytesIO(b''.join(response.streaming_content)))
         self.zf.extractall(self.tmpdir)
 
+    def exported_raster_path(self):
+        # Return the path of the extracted raster file
+        name = next(info.filename for info in self.zf.filelist if info.filename.endswith('.tif'))
+        return os.path.join(self.tmpdir, name)
+
     def check_exported_raster(self):
         # Open result as GDALRaster
-        rst = GDALRaster(os.path.join(self.tmpdir, self.zf.filelist[0].filename))
+        rst = GDALRaster(self.exported_raster_path())
         # Size is 512x512
         self.assertEqual(rst.width, 512)
         self.assertEqual(rst.height, 512)
@@ -111,3 +135,137 @@ class RasterAlgebraViewTests(RasterTestCase):
         self.assertIn('Zoom level: 3', readme)
         self.assertIn('Tile index range x: 2 - 2', readme)
         self.assertIn('Tile index range y: 3 - 3', readme)
+
+    def test_export_single_worker(self):
+        response = self.get_export()
+        self.unzip_response(response)
+        rst = GDALRaster(self.exported_raster_path())
+        expected = rst.bands[0].data()
+        # Evaluate the tiles sequentially, the result is identical
+        RasterExport.objects.all().delete()
+        with override_settings(RASTER_EXPORT_WORKERS=1):
+            response = self.get_export()
+        shutil.rmtree(self.tmpdir)
+        self.unzip_response(response)
+        rst = GDALRaster(self.exported_raster_path())
+        numpy.testing.assert_equal(rst.bands[0].data(), expected)
+
+    @override_settings(RASTER_ALGEBRA_PRECISION='auto')
+    def test_export_precision(self):
+        # The export raster has the result datatype of the algebra
+        response = self.request_export(stream=True)
+        self.unzip_response(response)
+        self.check_exported_raster()
+        rst = GDALRaster(self.exported_raster_path())
+        self.assertEqual(rst.bands[0].datatype(), self.tile.rast.bands[0].datatype())
+        # The nodata value is the one of the layer, not of the last tile
+        self.assertEqual(rst.bands[0].nodata_value, self.tile.rast.bands[0].nodata_value)
+
+    @override_settings(RASTER_ALGEBRA_PRECISION='auto')
+    def test_export_datatype(self):
+        # Datatypes and nodata values are inferred from the formula
+        ids = {'a': self.rasterlayer.id}
+        nodata = self.tile.rast.bands[0].nodata_value
+        self.assertEqual(export_datatype(ids, 'a'), (1, 'uint8', nodata))
+        self.assertEqual(export_datatype(ids, 'a + 300'), (2, 'uint16', nodata))
+        self.assertEqual(export_datatype(ids, 'a > 2'), (1, 'uint8', 255))
+        self.assertEqual(export_datatype(ids, 'a / 2')[1], 'float64')
+        with override_settings(RASTER_ALGEBRA_PRECISION='float64'):
+            self.assertEqual(export_datatype(ids, 'a > 2'), (7, 'float64', 255))
+
+    def test_export_status(self):
+        response = self.request_export()
+        self.assertEqual(response.status_code, 200)
+        status = response.json()
+        self.assertEqual(status['status'], 'Finished')
+        self.assertEqual(status['tiles_done'], status['tiles_total'])
+        self.assertEqual(status['tiles_total'], 4)
+        # The status endpoint reports the same status
+        response = self.client.get(status['url'])
+        self.assertEqual(response.json(), status)
+
+    def test_export_reuse(self):
+        first = self.request_export().json()
+        self.assertEqual(self.request_export().json()['id'], first['id'])
+        self.assertEqual(RasterExport.objects.count(), 1)
+        # Different parameters create a new export
+        self.assertNotEqual(self.request_export(zoom=3).json()['id'], first['id'])
+        # Changing the layer creates a new export
+        self.rasterlayer.save()
+        self.assertNotEqual(self.request_export().json()['id'], first['id'])
+
+    def test_export_cancel(self):
+        export = RasterExport.objects.create(key='test', parameters='{}', tiles_total=4)
+        response = self.client.post(reverse('export-cancel', kwargs={'export_id': export.id}))
+        self.assertEqual(response.json()['status'], 'Cancelled')
+        self.assertNotIn('download', response.json())
+        # Cancelled exports are not started
+        export_raster(export.id)
+        export.refresh_from_db()
+        self.assertEqual(export.status, RasterExport.CANCELLED)
+        # Unfinished exports can not be downloaded
+        response = self.client.get(reverse('export-download', kwargs={'export_id': export.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_export_cancel_csrf(self):
+        export = RasterExport.objects.create(key='csrf', parameters='{}', tiles_total=4)
+        url = reverse('export-cancel', kwargs={'export_id': export.id})
+        client = Client(enforce_csrf_checks=True)
+        # Requests without the token are rejected
+        self.assertEqual(client.post(url).status_code, 403)
+        export.refresh_from_db()
+        self.assertEqual(export.status, RasterExport.PENDING)
+        # Requests with the token of the cookie cancel the export
+        token = 'a' * 32
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+        response = client.post(url, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.json()['status'], 'Cancelled')
+
+    def test_cog_export(self):
+        response = self.get_export(frmt='cog')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/tiff')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        content = b''.join(response.streaming_content)
+        self.tmpdir = mkdtemp()
+        path = os.path.join(self.tmpdir, 'export.tif')
+        with open(path, 'wb') as cog:
+            cog.write(content)
+        rst = GDALRaster(path)
+        self.assertEqual(rst.width, 512)
+        numpy.testing.assert_equal(
+            rst.bands[0].data(size=(256, 256)),
+            self.tile.rast.bands[0].data()
+        )
+        # The raster is tiled and has overviews from the tile pyramid
+        self.assertIn('Block=256x256', rst.info)
+        self.assertIn('Overviews: 256x256', rst.info)
+        # Byte ranges of the raster can be requested
+        url = self.request_export(frmt='cog').json()['download']
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(url, HTTP_RANGE='bytes=10-109')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 10-109/{}'.format(len(content)))
+            self.assertEqual(b''.join(response.streaming_content), content[10:110])
+            response = self.client.get(url, HTTP_RANGE='bytes={}-'.format(len(content)))
+            self.assertEqual(response.status_code, 416)
+
+    def test_export_invalid_format(self):
+        response = self.request_export(frmt='png')
+        self.assertEqual(response.status_code, 400)
+
+    def test_streamed_export(self):
+        response = self.request_export(stream=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertIn('.zip', response['Content-Disposition'])
+        self.unzip_response(response)
+        # The readme is streamed ahead of the raster
+        self.assertEqual(self.zf.filelist[0].filename, 'README.txt')
+        self.check_exported_raster()
+        # Streamed exports do not create export jobs
+        self.assertEqual(RasterExport.objects.count(), 0)
+
+    def test_streamed_cog_export(self):
+        response = self.request_export(frmt='cog', stream=True)
+        self.assertEqual(response.status_code, 400)
@@ -1,7 +1,12 @@
+from unittest import skipUnless
+
 import numpy
 
 from django.test import TestCase
-from raster.algebra.parser import FormulaParser
+from raster.algebra import fused
+from raster.algebra.const import NUMEXPR_BACKEND, NUMPY_BACKEND
+from raster.algebra.optimizer import optimize
+from raster.algebra.parser import FormulaParser, compile_formula
 from raster.exceptions import RasterAlgebraException
 
 
@@ -248,6 +253,107 @@ class FormulaParserTests(TestCase):
         self.assertEqual(self.parser.evaluate({'x': 3}), -3)
         self.assertEqual(self.parser.evaluate({'x': 4}), -4)
 
+    def test_compiled_formula_cache(self):
+        self.parser.evaluate({'x': 1}, 'x * 3 + 1')
+        hits = compile_formula.cache_info().hits
+        # A new parser reuses the compiled expression stack.
+        self.assertEqual(FormulaParser().evaluate({'x': 2}, 'x*3 + 1'), 7)
+        self.assertEqual(compile_formula.cache_info().hits, hits + 1)
+        # The cached expression stack is not consumed by evaluation.
+        self.assertEqual(compile_formula('x*3+1'), ('x', '3', '*', '1', '+'))
+
+    @skipUnless(fused.is_available(), 'Numexpr is not installed')
+    def test_numexpr_backend(self):
+        data = {
+            'a': numpy.array([2, 4, 6, 0], dtype='float64'),
+            'b': numpy.array([True, False, True, False]),
+            'x': numpy.ma.masked_values([1.2, 0, -1.2, 5], 5),
+            'y': numpy.ma.masked_values([0, 1, 0, 3], 1),
+        }
+        formulas = (
+            'x + y', 'x / (x + y)', '(a - x) / (a + x) > 0.2', 'log(a) + sin(x)', 'b & (x > 0)',
+            '!b * a', 'x*(x>1) + 2*y + 3*a*(a==4)', 'a / 0', 'round(x) + a', '~x + y', 'x == NULL',
+        )
+        for formula in formulas:
+            expected = FormulaParser(backend=NUMPY_BACKEND).evaluate(dict(data), formula)
+            result = FormulaParser(backend=NUMEXPR_BACKEND).evaluate(dict(data), formula)
+            self.assertEqual(
+                numpy.ma.getmaskarray(result).tolist(),
+                numpy.ma.getmaskarray(expected).tolist(),
+            )
+            numpy.testing.assert_array_equal(numpy.ma.filled(result), numpy.ma.filled(expected))
+
+    def test_evaluate_valid(self):
+        x = numpy.array([1.2, 0, -1.2, 5])
+        y = numpy.array([0, 1, 0, 3], dtype='float64')
+        data = {'a': numpy.array([2, 4, 6, 0], dtype='float64'), 'x': x, 'y': y}
+        valid = {'x': x != 5, 'y': y != 1}
+        masked = {'a': data['a'], 'x': numpy.ma.masked_values(x, 5), 'y': numpy.ma.masked_values(y, 1)}
+        formulas = (
+            'x + y', 'x / y', 'log(x) + a', 'x*(x>1) + 2*y', '~x + y', 'x == NULL', '+x * y', 'a / 0', 'y * max(x)',
+        )
+        for formula in formulas:
+            expected = FormulaParser().evaluate(dict(masked), formula)
+            result, result_valid = FormulaParser().evaluate_valid(dict(data), valid, formula, fill_values={'x': 5})
+            if result_valid is None:
+                result_valid = numpy.ones(result.shape, dtype=bool)
+            self.assertEqual(result_valid.tolist(), numpy.logical_not(numpy.ma.getmaskarray(expected)).tolist())
+            numpy.testing.assert_array_equal(result[result_valid], numpy.ma.getdata(expected)[result_valid])
+
+    def test_optimize(self):
+        # Constant subexpressions are folded.
+        optimized = optimize(compile_formula('2*3+a*(1/4)-sin(PI/2)'))
+        self.assertEqual(optimized.stack, ('6.0', 'a', '0.25', '*', '+', '1.0', '-'))
+        self.assertEqual(optimized.variables, ('a', ))
+        # Repeated subexpressions are shared.
+        optimized = optimize(compile_formula('(a-b)/(a+b)*((a-b)/(a+b)>0.5)'))
+        self.assertEqual(sorted(optimized.shared), [6, 13])
+        self.assertEqual(optimized.starts[13], 7)
+        # Null comparisons are not folded.
+        self.assertEqual(optimize(compile_formula('a==NULL')).stack, ('a', 'NULL', '=='))
+
+    def test_optimized_evaluation(self):
+        self.data = {'a': numpy.arange(5) + 1.0, 'b': numpy.ones(5)}
+        ndvi = (self.data['a'] - 1) / (self.data['a'] + 1)
+        self.assertFormulaResult('(a-b)/(a+b)*((a-b)/(a+b)>0.5)', ndvi * (ndvi > 0.5))
+        self.assertFormulaResult('(a+b)^2-log(a+b)+2*3', (self.data['a'] + 1) ** 2 - numpy.log(self.data['a'] + 1) + 6)
+        masked = {'a': numpy.ma.masked_values(self.data['a'], 3), 'b': self.data['b']}
+        result = self.parser.evaluate(dict(masked), 'log(a-b)*log(a-b)')
+        self.assertEqual(numpy.ma.getmaskarray(result).tolist(), [True, False, True, False, False])
+        self.assertEqual(self.parser.referenced_variables('a + 0*b + 1/4'), ('a', 'b'))
+
+    def test_evaluate_valid_multi(self):
+        data = {'a': numpy.array([2, 4, 6, 0], dtype='float64'), 'b': numpy.array([1, 2, 0, 3], dtype='float64')}
+        valid = {'b': data['b'] != 0}
+        formulas = ['(a-b)/(a+b)', '(a-b)/(a+b) > 0.3', 'a+b']
+        results = FormulaParser().evaluate_valid_multi(data, valid, formulas)
+        self.assertEqual(len(results), 3)
+        for formula, (result, result_valid) in zip(formulas, results):
+            expected, expected_valid = FormulaParser().evaluate_valid(dict(data), valid, formula)
+            self.assertEqual(result.tolist(), expected.tolist())
+            self.assertEqual(result_valid.tolist(), expected_valid.tolist())
+
+    def test_neighborhood_functions(self):
+        data = {'x': numpy.arange(9, dtype='float64').reshape(3, 3)}
+        expected = {
+            'focalmax(x)': [[4, 5, 5], [7, 8, 8], [7, 8, 8]],
+            'focalmin(x)': [[0, 0, 1], [0, 0, 1], [3, 3, 4]],
+            'focalsum(x)': [[12, 18, 24], [30, 36, 42], [48, 54, 60]],
+            'focalmajority(x > 3)': [[0, 0, 0], [0, 1, 1], [1, 1, 1]],
+        }
+        for formula, value in expected.items():
+            numpy.testing.assert_allclose(self.parser.evaluate(data, formula), value)
+        # The slope of the plane in the center of the window
+        self.assertAlmostEqual(self.parser.evaluate(data, 'slope(x)')[1, 1], numpy.degrees(numpy.arctan(numpy.hypot(1, 3))))
+        # Masked values are ignored by the focal statistics.
+        result = self.parser.evaluate({'x': numpy.ma.masked_values(data['x'], 4)}, 'focalmax(x)')
+        self.assertEqual(result.mask.tolist(), [[False] * 3, [False, True, False], [False] * 3])
+        self.assertEqual(result[0].tolist(), [3, 5, 5])
+        # Flat data requires a shape.
+        msg = 'Neighborhood functions require two dimensional data.'
+        with self.assertRaisesMessage(RasterAlgebraException, msg):
+            self.parser.evaluate({'x': [1, 2, 3]}, 'focalmean(x)')
+
     def test_statistics_functions(self):
         d = self.data = {'x': numpy.random.rand(10), 'y': range(3)}
         self.assertFormulaResult('min(x)', numpy.min(d['x']))
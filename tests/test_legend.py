@@ -1,6 +1,7 @@
 import json
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from raster.colormaps import ColormapRegistry, colormap_registry
 from raster.models import Legend, LegendEntry, LegendSemantics
 
 
@@ -51,3 +52,55 @@ class RasterLegendTests(TestCase):
     def test_raster_legend_entry_list_change_signal_on_legend_delete(self):
         # Check if legend signals work when deleting a legend.
         self.leg.delete()
+
+    def test_colormap_registry_cleared_on_legend_entry_change(self):
+        colormap = colormap_registry.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        self.assertEqual(colormap['1'], (18, 52, 86, 255))
+        self.assertEqual(len(colormap_registry), 1)
+        self.ent1.color = '#000000'
+        self.ent1.save()
+        self.assertEqual(len(colormap_registry), 0)
+        self.leg.refresh_from_db()
+        colormap = colormap_registry.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        self.assertEqual(colormap['1'], (0, 0, 0, 255))
+
+    def test_colormap_registry_cleared_on_semantics_change(self):
+        colormap_registry.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        self.sem1.name = 'Fire'
+        self.sem1.save()
+        self.assertEqual(len(colormap_registry), 0)
+
+    def test_colormap_registry_returns_copies(self):
+        colormap = colormap_registry.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        colormap.pop('1')
+        colormap = colormap_registry.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        self.assertIn('1', colormap)
+
+    def test_colormap_registry_skips_misses(self):
+        self.assertIsNone(colormap_registry.get(('layer', '-1'), lambda: None))
+        self.assertIsNone(colormap_registry.get(('range', 'nope'), lambda: None))
+        self.assertEqual(len(colormap_registry), 0)
+
+    @override_settings(RASTER_COLORMAP_REGISTRY_SIZE=2)
+    def test_colormap_registry_drops_least_recently_used(self):
+        registry = ColormapRegistry()
+        registry.get('a', lambda: {'1': 'a'})
+        registry.get('b', lambda: {'1': 'b'})
+        # Use the first colormap again, such that the second one is dropped
+        registry.get('a', lambda: {'1': 'a'})
+        registry.get('c', lambda: {'1': 'c'})
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.get('a', lambda: {'1': 'x'}), {'1': 'a'})
+        self.assertEqual(registry.get('b', lambda: {'1': 'x'}), {'1': 'x'})
+
+    def test_colormap_registry_cleared_in_other_processes(self):
+        # Registries of other processes share the version in the cache
+        other = ColormapRegistry()
+        other.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        self.assertEqual(len(other), 1)
+        self.ent1.color = '#000000'
+        self.ent1.save()
+        self.assertEqual(len(other), 0)
+        self.leg.refresh_from_db()
+        colormap = other.get(('legend', self.leg.id), lambda: self.leg.colormap)
+        self.assertEqual(colormap['1'], (0, 0, 0, 255))
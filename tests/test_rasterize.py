@@ -71,3 +71,16 @@ class RasterizeGeometryTests(TestCase):
         self.assertEqual(self.rast.bands[0].data().ravel().tolist(), [0, 1, 2, 3])
         # Target raster is incremented. This might fail on older GDAL versions.
         self.assertEqual(result.bands[0].data().ravel().tolist(), [0, 1, 2, 102])
+
+    def test_rasterize_geometry_list(self):
+        first = OGRGeometry.from_bbox((500000.0, 399900.0, 500100.0, 400000.0))
+        first.srid = 3086
+        second = OGRGeometry.from_bbox((500000.0, 399800.0, 500200.0, 399900.0))
+        second.srid = 3086
+        # Every geometry is burned with its own value into a raster of the requested type.
+        result = rasterize([first, second], self.rast, burn_value=[300, 7], datatype=5)
+        self.assertEqual(result.bands[0].datatype(), 5)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [300, 0, 7, 7])
+        # A single burn value is used for all geometries.
+        result = rasterize([first, second], self.rast)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [1, 0, 1, 1])
@@ -1,10 +1,14 @@
 import numpy
 
 from django.contrib.gis.gdal import GDALRaster, OGRGeometry
+from django.contrib.gis.geos import Point
 from django.test import TestCase
 from raster.exceptions import RasterException
-from raster.tiles.utils import tile_bounds, tile_index_range
-from raster.utils import colormap_to_rgba, hex_to_rgba, pixel_value_from_point, rescale_to_channel_range
+from raster.tiles.utils import boundary_tiles, classify_tiles, tile_bounds, tile_index_range
+from raster.utils import (
+    band_data_to_image, colormap_to_rgba, hex_to_rgba, parse_byte_range, pixel_value_from_point,
+    rescale_to_channel_range
+)
 
 
 class TestUtils(TestCase):
@@ -68,6 +72,22 @@ class TestUtils(TestCase):
         self.assertEqual(idx[2] - idx[0], 2 ** 3 - 1)
         self.assertEqual(idx[3] - idx[1], 2 ** 3 - 1)
 
+    def test_boundary_tiles(self):
+        # Ring shaped geometry with tiles inside, outside and on the boundary
+        geom = Point(0, 0, srid=3857).buffer(4e5).difference(Point(0, 0).buffer(2e5))
+        for zoom in (5, 8, 10):
+            tilerange = tile_index_range(geom.extent, zoom)
+            tiles = [
+                (tilex, tiley)
+                for tilex in range(tilerange[0], tilerange[2] + 1)
+                for tiley in range(tilerange[1], tilerange[3] + 1)
+            ]
+            outside, inside = classify_tiles(geom, tiles, zoom)
+            self.assertEqual(boundary_tiles(geom, tilerange, zoom), set(tiles) - outside - inside)
+        self.assertTrue(inside)
+        self.assertTrue(outside)
+        self.assertEqual(boundary_tiles(geom, (3, 3, 2, 2), zoom), set())
+
     def test_channel_rescale(self):
         data = numpy.array([0, 0.5, 1], dtype='float')
         numpy.testing.assert_equal(
@@ -87,6 +107,18 @@ class TestUtils(TestCase):
             [60, 40, 50]
         )
 
+    def test_band_data_to_image_with_validity(self):
+        data = numpy.array([[1, 2], [3, 4]], dtype='float64')
+        valid = numpy.array([[True, True], [False, True]])
+        colormap = {1: (255, 0, 0, 255), 'x>2': (0, 0, 255, 255)}
+        img, stats = band_data_to_image(data, colormap, valid, 3)
+        self.assertEqual(stats, {1: 1, 'x>2': 1})
+        # The result is the same as for masked arrays.
+        masked_img, masked_stats = band_data_to_image(numpy.ma.masked_values(data, 3), colormap)
+        self.assertEqual(stats, masked_stats)
+        self.assertEqual(list(img.getdata()), list(masked_img.getdata()))
+        self.assertEqual(img.getpixel((0, 1)), (0, 0, 0, 0))
+
     def test_get_pixel_value(self):
         raster = GDALRaster({'width': 5, 'height': 5, 'srid': 4326, 'bands': [{'data': range(25)}], 'origin': (2, 2), 'scale': (1, 1)})
 
@@ -141,3 +173,17 @@ class TestUtils(TestCase):
         point = OGRGeometry('SRID=4326;POINT(3 1)')
         result = pixel_value_from_point(raster, point)
         self.assertEqual(result, 6)
+
+    def test_parse_byte_range(self):
+        self.assertEqual(parse_byte_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_byte_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_byte_range('bytes=900-2000', 1000), (900, 999))
+        self.assertEqual(parse_byte_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_byte_range('bytes=-2000', 1000), (0, 999))
+        # Missing, invalid and multiple ranges are ignored
+        self.assertIsNone(parse_byte_range('', 1000))
+        self.assertIsNone(parse_byte_range('bytes=-', 1000))
+        self.assertIsNone(parse_byte_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(parse_byte_range('lines=0-1', 1000))
+        with self.assertRaises(ValueError):
+            parse_byte_range('bytes=1000-', 1000)
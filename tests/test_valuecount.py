@@ -1,16 +1,40 @@
+import json
 import sys
+from collections import Counter
+from io import StringIO
 from unittest import skipUnless
 
 import numpy
 
 from django.contrib.gis.geos import Polygon
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from raster import tasks
 from raster.exceptions import RasterAggregationException
+from raster.models import RasterAggregation, RasterLayer, RasterTile
 from raster.tiles.const import WEB_MERCATOR_SRID
-from raster.tiles.utils import tile_scale
-from raster.valuecount import Aggregator
+from raster.tiles.lookup import get_raster_tile, get_raster_tile_with_halo, stream_raster_tiles
+from raster.tiles.utils import boundary_tiles, tile_index_range, tile_scale
+from raster.valuecount import AggregationPartial, Aggregator, aggregation_result, count_pairs, count_unique
 
 from .raster_testcase import RasterTestCase
 
+# Clipped value count query before the tiles were selected by index range
+TRANSFORMED_VALUE_COUNT_SQL = """
+WITH tiles_for_agg AS (
+    SELECT ST_ValueCount(ST_Clip(ST_Transform(rast, %(geom_srid)s), ST_GeomFromEWKT(%(geom_ewkt)s))) AS vcresult
+    FROM raster_rastertile
+    WHERE ST_Intersects(rast, ST_Transform(ST_GeomFromEWKT(%(geom_ewkt)s), %(rast_srid)s))
+    AND rasterlayer_id = %(rasterlayer_id)s
+    AND tilez = %(zoom)s
+)
+SELECT (vcresult).value, SUM((vcresult).count) AS count
+FROM tiles_for_agg
+GROUP BY (vcresult).value
+"""
+
 
 class RasterValueCountTests(RasterTestCase):
 
@@ -341,13 +365,512 @@ class RasterAggregatorTests(RasterTestCase):
             },
         )
 
-    def test_memory_efficient_error(self):
-        msg = 'Secify a histogram range for memory efficient continuous aggregation.'
-        with self.assertRaisesMessage(RasterAggregationException, msg):
+    def test_memory_efficient_continuous(self):
+        # Continuous histograms without range are binned over the range of the values
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            grouping='continuous',
+            memory_efficient=True,
+        )
+        counts = agg.value_count()
+        self.assertEqual(sorted(counts.values()), sorted(self.continuous_expected_histogram.values()))
+        # The range is computed without tile summaries
+        RasterTile.objects.update(summary_count=None)
+        self.assertDictEqual(agg.value_count(), counts)
+
+    def test_quantiles(self):
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            grouping='discrete',
+        )
+        values = numpy.concatenate([numpy.repeat(k, v) for k, v in sorted(self.expected_totals.items())])
+        fractions = [0, 0.01, 0.25, 0.5, 0.75, 0.99, 1]
+        quantiles = agg.quantiles(fractions)
+        self.assertEqual(quantiles[0], values.min())
+        self.assertEqual(quantiles[-1], values.max())
+        # The estimates are close to the exact quantiles by rank
+        for fraction, quantile in zip(fractions, quantiles):
+            ranks = numpy.searchsorted(values, [quantile - 0.5, quantile + 0.5]) / values.size
+            self.assertTrue(ranks[0] - 0.01 <= fraction <= ranks[1] + 0.01)
+        self.assertEqual(agg._stats_t0, values.size)
+        # Constant formulas have constant quantiles
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a * 0 + 100',
+            grouping='discrete',
+        )
+        self.assertEqual(agg.quantiles([0.5]), [100])
+
+    def test_multi_formula(self):
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id, 'b': self.rasterlayer.id},
+            formula='a',
+            grouping='discrete',
+        )
+        counts = agg.value_count_multi(['a', 'b * (a > 2)', 'a'])
+        self.assertEqual(len(counts), 3)
+        self.assertDictEqual(counts[0], {str(k): v for k, v in self.expected_totals.items()})
+        self.assertDictEqual(counts[2], counts[0])
+        self.assertEqual(counts[1]['0'], sum(v for k, v in self.expected_totals.items() if k <= 2))
+        stats = agg.statistics_multi(['a', 'a * 2'])
+        self.assertEqual(stats[0], agg.statistics())
+        self.assertEqual(stats[1][:2], (2 * stats[0][0], 2 * stats[0][1]))
+        self.assertAlmostEqual(stats[1][2], 2 * stats[0][2])
+
+    def test_aggregation_subtasks(self):
+        for grouping in ('discrete', 'continuous', self.legend.id):
             agg = Aggregator(
                 layer_dict={'a': self.rasterlayer.id},
                 formula='a',
-                grouping='continuous',
-                memory_efficient=True,
+                grouping=grouping,
             )
-            agg.value_count()
+            expected = aggregation_result(agg)
+            aggregation = RasterAggregation.objects.create(
+                key=str(grouping),
+                parameters=json.dumps({'aggregator': agg.task_parameters()}),
+                tiles_total=agg.tile_count(),
+            )
+            # Aggregate every row of tiles of the job in a separate subtask
+            with override_settings(RASTER_AGGREGATION_TASK_TILES=1):
+                self.assertEqual(len(agg.task_tileranges()), 2)
+                # Aggregators compute locally
+                self.assertEqual(aggregation_result(agg), expected)
+                tasks.aggregation(aggregation.id)
+            aggregation.refresh_from_db()
+            self.assertEqual(aggregation.status, RasterAggregation.FINISHED)
+            self.assertEqual(aggregation.tiles_done, aggregation.tiles_total)
+            self.assertEqual(json.loads(aggregation.result), expected)
+        # Parts of jobs that are no longer running are skipped
+        parameters = agg.task_parameters()
+        self.assertIsNone(tasks.aggregate_tiles(parameters, ['a'], agg.tilerange, aggregation_id=aggregation.id))
+        # Evaluate the tiles sequentially
+        with override_settings(RASTER_AGGREGATION_WORKERS=1):
+            self.assertEqual(aggregation_result(agg), expected)
+
+    def test_aggregation_partial_merge(self):
+        first = AggregationPartial()
+        first.counts.update({numpy.float64(1): 2, (numpy.float64(0), numpy.float64(1.5)): 3})
+        first.push_stats(numpy.array([1, 2, 3]))
+        second = AggregationPartial()
+        second.counts.update({numpy.float64(1): 4})
+        second.push_stats(numpy.array([0, 5]))
+        first.merge(AggregationPartial.deserialize(second.serialize()))
+        self.assertEqual(first.counts[numpy.float64(1)], 6)
+        self.assertEqual((first.t0, first.t1, first.t2), (5, 11, 39))
+        self.assertEqual((first.min_value, first.max_value), (0, 5))
+        # Quantile sketches are merged with the partials
+        first = AggregationPartial(sketch=True)
+        first.sketch.push(numpy.arange(100))
+        second = AggregationPartial(sketch=True)
+        second.sketch.push(numpy.arange(100, 200))
+        first.merge(AggregationPartial.deserialize(second.serialize()))
+        self.assertEqual(first.sketch.count, 200)
+        self.assertEqual(first.sketch.quantiles([0, 0.5, 1]), [0, 99.5, 199])
+
+    def test_tile_summaries(self):
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            grouping='discrete',
+        )
+        self.assertTrue(agg.tile_summaries(['a']))
+        # Formulas other than single layers are evaluated on the tile data
+        self.assertEqual(agg.tile_summaries(['a * 2']), {})
+        expected = agg.value_count()
+        stats = agg.statistics(reset=True)
+        # Aggregate the same tiles without summaries
+        RasterTile.objects.update(summary_count=None)
+        self.assertEqual(agg.tile_summaries(['a']), {})
+        self.assertDictEqual(agg.value_count(), expected)
+        for dat in zip(agg.statistics(reset=True), stats):
+            self.assertAlmostEqual(dat[0], dat[1])
+
+    def test_tile_summaries_precision(self):
+        agg = Aggregator(layer_dict={'a': self.rasterlayer.id}, formula='a', grouping='discrete', engine='postgis')
+        # Summaries and the database keep the values of the categorical layer
+        for precision in ('float32', 'auto'):
+            with override_settings(RASTER_ALGEBRA_PRECISION=precision):
+                self.assertTrue(agg.tile_summaries(['a']))
+                self.assertTrue(agg.use_database(['a']))
+        # Continuous layers are rounded in float32
+        RasterLayer.objects.filter(id=self.rasterlayer.id).update(datatype='co')
+        agg = Aggregator(layer_dict={'a': self.rasterlayer.id}, formula='a', grouping='discrete', engine='postgis')
+        with override_settings(RASTER_ALGEBRA_PRECISION='float32'):
+            self.assertEqual(agg.tile_summaries(['a']), {})
+            self.assertFalse(agg.use_database(['a']))
+        with override_settings(RASTER_ALGEBRA_PRECISION='auto'):
+            self.assertTrue(agg.tile_summaries(['a']))
+
+    def test_aggregation_precision(self):
+        kwargs = dict(layer_dict={'a': self.rasterlayer.id}, formula='a', zoom=11, grouping='discrete')
+        agg = Aggregator(**kwargs)
+        expected = agg.value_count()
+        stats = agg.statistics()
+        # Aggregate the tile data of the byte layer in the precision of the layer
+        RasterTile.objects.update(summary_count=None)
+        for precision in ('float32', 'auto'):
+            with override_settings(RASTER_ALGEBRA_PRECISION=precision):
+                agg = Aggregator(**kwargs)
+                self.assertDictEqual(agg.value_count(), expected)
+                for value, expected_value in zip(agg.statistics(), stats):
+                    self.assertAlmostEqual(value, expected_value)
+                # Zonal statistics sum the squares of the values in float64
+                zone = Polygon.from_bbox((-90, 10, -27, 45))
+                zone.srid = 4326
+                for value, expected_value in zip(agg.zonal_statistics({'all': zone})['all'], stats):
+                    self.assertAlmostEqual(value, expected_value)
+
+    def test_tile_summary_update(self):
+        tile = self.rasterlayer.rastertile_set.filter(tilez=11).first()
+        self.assertEqual(tile.summary_count[0], sum(count for band, value, count in tile.summary_value_counts))
+        # Saving a tile updates its summary
+        tile.rast.bands[0].data([0], shape=(1, 1))
+        tile.rast.bands[0].nodata_value = 0
+        # The kind of summary is taken from the tile, without reading the layer
+        with self.assertNumQueries(1):
+            tile.save()
+        tile.refresh_from_db()
+        self.assertEqual(tile.summary_count, [0])
+        self.assertEqual(tile.summary_min, [None])
+        self.assertEqual(tile.summary_value_counts, [])
+
+    def test_summarize_tiles_command(self):
+        fields = RasterTile.SUMMARY_FIELDS
+        expected = list(RasterTile.objects.order_by('rid').values_list(*fields))
+        RasterTile.objects.update(**{field: None for field in fields})
+        # Tiles without summaries are not summarized when saved
+        tile = RasterTile.objects.first()
+        tile.save()
+        tile.refresh_from_db()
+        self.assertIsNone(tile.summary_count)
+        # The command fills in the missing summaries
+        call_command('summarize_tiles', batch_size=3, stdout=StringIO())
+        self.assertEqual(list(RasterTile.objects.order_by('rid').values_list(*fields)), expected)
+
+    def test_summarize_tiles_aggregation(self):
+        RasterTile.objects.update(**{field: None for field in RasterTile.SUMMARY_FIELDS})
+        agg = Aggregator(layer_dict={'a': self.rasterlayer.id}, formula='a', grouping='discrete', zoom=11)
+        # Aggregate the tiles without summaries from their data
+        self.assertEqual(agg.tile_summaries(['a']), {})
+        expected = agg.value_count()
+        stats = agg.statistics(reset=True)
+        call_command('summarize_tiles', self.rasterlayer.id, stdout=StringIO())
+        # Aggregate the backfilled summaries of the discrete layer
+        self.assertEqual(len(agg.tile_summaries(['a'])), self.rasterlayer.rastertile_set.filter(tilez=11).count())
+        self.assertDictEqual(agg.value_count(), expected)
+        for value, expected_value in zip(agg.statistics(reset=True), stats):
+            self.assertAlmostEqual(value, expected_value)
+
+    def test_classify_tiles(self):
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        xmin, ymin, xmax, ymax = tile.rast.extent
+        width, height = xmax - xmin, ymax - ymin
+        # Triangle covering the upper left tile, but not the lower right tile
+        geom = Polygon((
+            (xmin - 100, ymax + 100),
+            (xmax + 0.9 * width, ymax + 100),
+            (xmin - 100, ymin - 0.9 * height),
+            (xmin - 100, ymax + 100),
+        ), srid=WEB_MERCATOR_SRID)
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            zoom=11,
+            geom=geom,
+            grouping='discrete',
+        )
+        outside, inside = agg.classify_tiles()
+        self.assertIn((552, 858), inside)
+        self.assertIn((553, 859), outside)
+        expected = agg.value_count()
+        # Masking all tiles by the rasterized geometry gives the same counts
+        agg._tile_classes = (agg._tile_classes[0], (set(), set()))
+        self.assertDictEqual(agg.value_count(), expected)
+
+    def test_db_value_count_tile_classes(self):
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        bbox = Polygon.from_bbox(tile.rast.extent)
+        bbox.srid = WEB_MERCATOR_SRID
+        xmin, ymin, xmax, ymax = tile.rast.extent
+        triangle = Polygon(((xmin, ymin), (xmax, ymax), (xmin, ymax), (xmin, ymin)), srid=WEB_MERCATOR_SRID)
+        # The tile is inside the bbox, on the boundary of the triangle and
+        # in the hole of the ring.
+        geoms = {
+            'inside': bbox,
+            'boundary': triangle,
+            'outside': bbox.buffer(xmax - xmin).difference(bbox.buffer(1)),
+        }
+        for name, geom in geoms.items():
+            clip = boundary_tiles(geom, tile_index_range(geom.extent, 11), 11)
+            self.assertEqual((552, 858) in clip, name == 'boundary')
+            with connection.cursor() as cursor:
+                cursor.execute(TRANSFORMED_VALUE_COUNT_SQL, {
+                    'geom_ewkt': geom.ewkt,
+                    'geom_srid': WEB_MERCATOR_SRID,
+                    'rast_srid': WEB_MERCATOR_SRID,
+                    'rasterlayer_id': self.rasterlayer.id,
+                    'zoom': 11,
+                })
+                expected = {int(value): int(count) for value, count in cursor.fetchall() if value is not None}
+            self.assertDictEqual(self.rasterlayer.db_value_count(geom, zoom=11), expected)
+        # Areas are given in the pixel size of the tiles
+        areas = self.rasterlayer.db_value_count(bbox, area=True, zoom=11)
+        for value, count in self.rasterlayer.db_value_count(bbox, zoom=11).items():
+            self.assertAlmostEqual(areas[value], count * tile_scale(11) ** 2)
+
+    def test_db_value_count_prefilter(self):
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        geom = Polygon.from_bbox(tile.rast.extent).buffer(1000)
+        geom.srid = WEB_MERCATOR_SRID
+        # Read the layer extent beforehand
+        self.rasterlayer.extent()
+        with CaptureQueriesContext(connection) as queries:
+            self.rasterlayer.db_value_count(geom, zoom=11)
+        # A single query without transforming the tiles
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('ST_Transform', queries[0]['sql'])
+        self.assertIn('tilex BETWEEN', queries[0]['sql'])
+        # Geometries outside of the layer are not queried
+        far = Polygon.from_bbox((0, 0, 1000, 1000))
+        far.srid = WEB_MERCATOR_SRID
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.rasterlayer.db_value_count(far, zoom=11), {})
+        self.assertEqual(len(queries), 0)
+
+    def test_tile_index_migration(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, RasterTile._meta.db_table)
+        self.assertTrue(constraints['rastertile_layer_zxy_idx']['index'])
+        self.assertEqual(
+            constraints['rastertile_layer_zxy_idx']['columns'],
+            ['rasterlayer_id', 'tilez', 'tilex', 'tiley'],
+        )
+
+    def test_count_unique(self):
+        for data in (numpy.array([3, -2, 3, 7.0]), numpy.array([1.5, 1.5, 2]), numpy.array([0, 1e9, 0])):
+            expected = numpy.unique(data, return_counts=True)
+            values, counts = count_unique(data)
+            numpy.testing.assert_equal(values, expected[0])
+            numpy.testing.assert_equal(counts, expected[1])
+        first, second, counts = count_pairs(numpy.array([1, 2, 1, 1.0]), numpy.array([-1, 5, -1, 3.0]))
+        self.assertEqual(list(zip(first, second, counts)), [(1, -1, 2), (1, 3, 1), (2, 5, 1)])
+        first, second, counts = count_pairs(numpy.array([0.5, 0.5]), numpy.array([1, 1.0]))
+        self.assertEqual(list(zip(first, second, counts)), [(0.5, 1, 2)])
+
+    def test_crosstab(self):
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id, 'b': self.rasterlayer.id},
+            formula='a',
+        )
+        # The crosstab of a layer with itself is diagonal
+        self.assertDictEqual(
+            agg.crosstab('a', 'b'),
+            {str(k): {str(k): v} for k, v in self.expected_totals.items()},
+        )
+        crosstab = agg.crosstab('a', 'b * (b > 2)')
+        self.assertDictEqual(crosstab['2'], {'0': self.expected_totals[2]})
+        self.assertDictEqual(crosstab['5'], {'5': self.expected_totals[5]})
+
+    def test_zonal_statistics(self):
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        xmin, ymin, xmax, ymax = tile.rast.extent
+        width, height = xmax - xmin, ymax - ymin
+        zones = {
+            'inside': Polygon.from_bbox((xmin + 0.1 * width, ymin + 0.1 * height, xmin + 0.6 * width, ymax)),
+            'boundary': Polygon.from_bbox((xmax - 0.2 * width, ymin - 0.5 * height, xmax + 0.5 * width, ymax)),
+            'empty': Polygon.from_bbox((xmin - 5 * width, ymax + 4 * height, xmin - 4 * width, ymax + 5 * height)),
+        }
+        for zone in zones.values():
+            zone.srid = WEB_MERCATOR_SRID
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            zoom=11,
+            grouping='discrete',
+        )
+        counts = agg.zonal_value_count(zones)
+        stats = agg.zonal_statistics(zones)
+        # The zones are aggregated as separate clip geometries
+        for name, geom in zones.items():
+            zone_agg = Aggregator(
+                layer_dict={'a': self.rasterlayer.id},
+                formula='a',
+                zoom=11,
+                geom=geom,
+                grouping='discrete',
+            )
+            self.assertDictEqual(counts[name], zone_agg.value_count())
+            for value, expected in zip(stats[name], zone_agg.statistics()):
+                self.assertAlmostEqual(value, expected)
+        self.assertEqual(counts['empty'], {})
+        self.assertEqual(stats['empty'], (None, None, None, None))
+
+    def test_zonal_overlapping_zones(self):
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        xmin, ymin, xmax, ymax = tile.rast.extent
+        width, height = xmax - xmin, ymax - ymin
+        # Two zones that overlap across the tile boundary
+        zones = {
+            'left': Polygon.from_bbox((xmin + 0.1 * width, ymin - 0.5 * height, xmax + 0.3 * width, ymax)),
+            'right': Polygon.from_bbox((xmin + 0.5 * width, ymin - 0.2 * height, xmax + 0.6 * width, ymax)),
+        }
+        for zone in zones.values():
+            zone.srid = WEB_MERCATOR_SRID
+        kwargs = dict(layer_dict={'a': self.rasterlayer.id}, formula='a', zoom=11, grouping='discrete', acres=False)
+        counts = Aggregator(**kwargs).zonal_value_count(zones)
+        # The pixels in the overlap are counted in both zones
+        for name, geom in zones.items():
+            expected = Aggregator(geom=geom, **kwargs).value_count()
+            self.assertDictEqual(counts[name], expected)
+            self.assertEqual(sum(counts[name].values()), sum(expected.values()))
+
+    def test_approximate_aggregation(self):
+        agg = Aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            zoom=11,
+            grouping='discrete',
+        )
+        # Samples that cover the tile range are exact
+        counts, errors = agg.approximate_value_count(max_pixels=10 ** 9)
+        self.assertDictEqual(counts, {str(k): v for k, v in self.expected_totals.items()})
+        self.assertEqual(set(errors.values()), {0})
+        stats, error = agg.approximate_statistics(max_pixels=10 ** 9)
+        for value, expected in zip(stats, agg.statistics()):
+            self.assertAlmostEqual(value, expected)
+        self.assertEqual(error, 0)
+        # Estimates from a sample of two of the four tiles
+        tiles, population_size = agg.sample_tiles(max_pixels=2 * 256 * 256, seed=1)
+        self.assertEqual((len(tiles), population_size), (2, 4))
+        tile_counts = Counter()
+        for tile in RasterTile.objects.filter(rasterlayer=self.rasterlayer, tilez=11):
+            if (tile.tilex, tile.tiley) in tiles:
+                tile_counts.update(dict(zip(*numpy.unique(tile.rast.bands[0].data(), return_counts=True))))
+        counts, errors = agg.approximate_value_count(max_pixels=2 * 256 * 256, seed=1)
+        self.assertDictEqual(counts, {str(k): 2 * v for k, v in tile_counts.items() if k != 255})
+        self.assertTrue(all(error >= 0 for error in errors.values()))
+        self.assertEqual(agg.approximate_value_count(max_pixels=2 * 256 * 256, seed=1), (counts, errors))
+
+    def test_zoom_tile_budget(self):
+        agg = Aggregator(layer_dict={'a': self.rasterlayer.id}, formula='a')
+        self.assertEqual((agg.zoom, agg.tile_count()), (11, 4))
+        # The highest zoom level within the tile budget is selected
+        agg = Aggregator(layer_dict={'a': self.rasterlayer.id}, formula='a', max_tiles=3)
+        self.assertLess(agg.zoom, 11)
+        self.assertLessEqual(agg.tile_count(), 3)
+        self.assertEqual(agg.task_parameters()['max_tiles'], 3)
+        # Explicit zoom levels over the budget are refused
+        msg = 'The aggregation area covers 4 tiles at zoom level 11, more than the maximum of 3 tiles.'
+        with override_settings(RASTER_AGGREGATION_MAX_TILES=3):
+            with self.assertRaisesMessage(RasterAggregationException, msg):
+                Aggregator(layer_dict={'a': self.rasterlayer.id}, formula='a', zoom=11)
+
+    @override_settings(
+        CACHES={'aggregations': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        RASTER_AGGREGATION_CACHE='aggregations',
+    )
+    def test_aggregation_cache(self):
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        xmin, ymin, xmax, ymax = tile.rast.extent
+        geom = Polygon(((xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymin)), srid=WEB_MERCATOR_SRID)
+        kwargs = dict(layer_dict={'a': self.rasterlayer.id}, formula='a', zoom=11, grouping='discrete')
+        agg = Aggregator(geom=geom, **kwargs)
+        expected = agg.value_count()
+        stats = agg.statistics()
+        # Equivalent geometries share the cache entries
+        equivalent = Polygon(((xmax, ymax), (xmin, ymin), (xmax, ymin), (xmax, ymax)), srid=WEB_MERCATOR_SRID)
+        self.assertEqual(Aggregator(geom=equivalent, **kwargs).cache_key(['a']), agg.cache_key(['a']))
+        self.assertNotEqual(Aggregator(**kwargs).cache_key(['a']), agg.cache_key(['a']))
+        # Cached results are returned without reading the tiles
+        RasterTile.objects.filter(rasterlayer=self.rasterlayer).delete()
+        agg = Aggregator(geom=equivalent, **kwargs)
+        self.assertDictEqual(agg.value_count(), expected)
+        self.assertEqual(agg.statistics(reset=True), stats)
+        # Modified layers are aggregated again
+        RasterLayer.objects.filter(id=self.rasterlayer.id).update(modified=timezone.now())
+        self.assertDictEqual(agg.value_count(), {})
+
+    def test_stream_raster_tiles(self):
+        tiles = [(552, 859), (553, 858), (552, 858), (553, 859)]
+        # The tiles are read in one query and yielded row by row
+        with CaptureQueriesContext(connection) as queries:
+            result = list(stream_raster_tiles(self.rasterlayer.id, 11, tiles))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([index for index, rast in result], [(552, 858), (553, 858), (552, 859), (553, 859)])
+        for (tilex, tiley), rast in result:
+            tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=tilex, tiley=tiley)
+            numpy.testing.assert_array_equal(rast.bands[0].data(), tile.rast.bands[0].data())
+        # Tiles with halos are padded with their neighbors
+        result = dict(stream_raster_tiles(self.rasterlayer.id, 11, [(553, 859)], halo=2))
+        self.assertEqual(result[(553, 859)].width, 260)
+        numpy.testing.assert_array_equal(
+            result[(553, 859)].bands[0].data()[:2, :2],
+            self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858).rast.bands[0].data()[-2:, -2:],
+        )
+        # Tiles that are missing at the zoom level are warped from ancestors
+        result = dict(stream_raster_tiles(self.rasterlayer.id, 12, [(1104, 1716), (1105, 1717)]))
+        self.assertEqual(sorted(result), [(1104, 1716), (1105, 1717)])
+        self.assertEqual(result[(1104, 1716)].scale.x, tile_scale(12))
+
+    def test_halo_above_max_zoom(self):
+        # The left neighbor of the tile is warped from a different ancestor
+        left = get_raster_tile(self.rasterlayer.id, 12, 1105, 1717).bands[0].data()
+        tile = get_raster_tile(self.rasterlayer.id, 12, 1106, 1717).bands[0].data()
+        padded = get_raster_tile_with_halo(self.rasterlayer.id, 12, 1106, 1717, 2)
+        self.assertEqual(padded.width, 260)
+        # The halo continues the neighbor instead of replicating the edge
+        numpy.testing.assert_array_equal(padded.bands[0].data()[2:-2, :2], left[:, -2:])
+        numpy.testing.assert_array_equal(padded.bands[0].data()[2:-2, 2:-2], tile)
+        result = dict(stream_raster_tiles(self.rasterlayer.id, 12, [(1106, 1717)], halo=2))
+        numpy.testing.assert_array_equal(result[(1106, 1717)].bands[0].data(), padded.bands[0].data())
+
+    def test_database_engine(self):
+        kwargs = dict(layer_dict={'a': self.rasterlayer.id}, formula='a', zoom=11)
+        for grouping in ('discrete', 'continuous', self.legend.id, self.legend_with_expression.id):
+            expected = Aggregator(grouping=grouping, **kwargs)
+            agg = Aggregator(grouping=grouping, engine='postgis', **kwargs)
+            self.assertTrue(agg.use_database(['a']))
+            self.assertDictEqual(agg.value_count(), expected.value_count())
+            for value, expected_value in zip(agg.statistics(), expected.statistics()):
+                self.assertAlmostEqual(value, expected_value)
+        # Clipped aggregations in the database select pixels by their center
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        geom = Polygon.from_bbox(tile.rast.extent)
+        geom.srid = WEB_MERCATOR_SRID
+        agg = Aggregator(geom=geom.clone(), grouping='discrete', engine='postgis', **kwargs)
+        self.assertFalse(agg.use_database(['a']))
+        agg = Aggregator(geom=geom.clone(), grouping='discrete', engine='postgis', all_touched=False, **kwargs)
+        self.assertTrue(agg.use_database(['a']))
+        values, counts = numpy.unique(tile.rast.bands[0].data(), return_counts=True)
+        expected = {str(value): count * tile_scale(11) ** 2 * 0.000247105381 for value, count in zip(values, counts)}
+        expected.pop('255')
+        self.assertEqual(agg.value_count().keys(), expected.keys())
+        for key, value in agg.value_count().items():
+            self.assertAlmostEqual(value, expected[key], 5)
+        # Other formulas are aggregated in python
+        self.assertFalse(Aggregator(engine='postgis', **kwargs).use_database(['a * 2']))
+        # The auto engine uses the database for large tile ranges
+        with override_settings(RASTER_AGGREGATION_ENGINE='auto', RASTER_AGGREGATION_DATABASE_TILES=4):
+            self.assertTrue(Aggregator(**kwargs).use_database(['a']))
+            self.assertFalse(Aggregator(**dict(kwargs, zoom=9)).use_database(['a']))
+            # Continuous value counts are binned in python
+            self.assertFalse(Aggregator(grouping='continuous', **kwargs).use_database(['a']))
+            self.assertTrue(Aggregator(grouping='continuous', **kwargs).use_database(['a'], count=False))
+        with self.assertRaises(RasterAggregationException):
+            Aggregator(engine='spark', **kwargs)
+
+    def test_database_histogram(self):
+        kwargs = dict(layer_dict={'a': self.rasterlayer.id}, formula='a', grouping='continuous', zoom=11)
+        maximum = Aggregator(**kwargs).statistics()[1]
+        # The maximum is on the upper edge of the last bin
+        for hist_range in ((0.5, 8), (0, maximum), (2, 3.5)):
+            expected = Aggregator(hist_range=hist_range, **kwargs)
+            agg = Aggregator(hist_range=hist_range, engine='postgis', **kwargs)
+            self.assertTrue(agg.use_database(['a']))
+            self.assertDictEqual(agg.value_count(), expected.value_count())
+            for value, expected_value in zip(agg.statistics(), expected.statistics()):
+                self.assertAlmostEqual(value, expected_value)
+            # No values are dropped from the histogram
+            self.assertEqual(sum(agg.value_count().values()), agg._stats_t0)